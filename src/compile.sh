@@ -1 +1,2 @@
-g++ -shared -fPIC -O3 -g -o libNativeCPURenderer.so libNativeCPURenderer.cpp -lavcodec -lavformat -lavutil -lswscale
\ No newline at end of file
+g++ -shared -fPIC -O3 -g -pthread -o libNativeCPURenderer.so libNativeCPURenderer.cpp -lavcodec -lavformat -lavutil -lswscale
+python3 -c "import sys, libNativeCPURendererPybind as m; sys.exit('\n'.join(m.check_signatures()) or None)"
\ No newline at end of file
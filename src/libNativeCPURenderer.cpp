@@ -1,18 +1,283 @@
 #include "libNativeCPURenderer.h"
 
+template <i32 Format> struct PixelStorage;
+
+template <> struct PixelStorage<PIXEL_FORMAT_F64> {
+    typedef f64 T;
+    static const bool premultiplied = false;
+    static inline f64 Load(T v) { return v; }
+    static inline T Store(f64 v) { return v; }
+};
+
+template <> struct PixelStorage<PIXEL_FORMAT_F32> {
+    typedef f32 T;
+    static const bool premultiplied = false;
+    static inline f64 Load(T v) { return v; }
+    static inline T Store(f64 v) { return (f32)v; }
+};
+
+template <> struct PixelStorage<PIXEL_FORMAT_U8_PREMULTIPLIED> {
+    typedef iu8 T;
+    static const bool premultiplied = true;
+    static inline f64 Load(T v) { return v * (1.0 / 255.0); }
+    static inline T Store(f64 v) { return (iu8)((v < 0 ? 0 : (v > 1 ? 1 : v)) * 255.0 + 0.5); }
+};
+
+// Calls fn with a PixelStorage instance matching the runtime format, so draw paths are compiled once per format.
+template <typename Fn> inline void WithPixelFormat(i32 pixelFormat, Fn fn) {
+    switch (pixelFormat) {
+        case PIXEL_FORMAT_F32: fn(PixelStorage<PIXEL_FORMAT_F32>()); break;
+        case PIXEL_FORMAT_U8_PREMULTIPLIED: fn(PixelStorage<PIXEL_FORMAT_U8_PREMULTIPLIED>()); break;
+        default: fn(PixelStorage<PIXEL_FORMAT_F64>()); break;
+    }
+}
+
+// Same as WithPixelFormat for a destination context and a source texture.
+template <typename Fn> inline void WithPixelFormats(i32 ctxPixelFormat, i32 texPixelFormat, Fn fn) {
+    WithPixelFormat(ctxPixelFormat, [&](auto cs) {
+        WithPixelFormat(texPixelFormat, [&](auto ts) { fn(cs, ts); });
+    });
+}
+
+// Reads one pixel as straight (non-premultiplied) color.
+template <typename S> inline void LoadPixel(
+    const typename S::T* p, bool enableAlpha,
+    f64 *out_r, f64 *out_g, f64 *out_b, f64 *out_a
+) {
+    *out_r = S::Load(p[0]);
+    *out_g = S::Load(p[1]);
+    *out_b = S::Load(p[2]);
+    if (!enableAlpha) return;
+
+    *out_a = S::Load(p[3]);
+    if (S::premultiplied && *out_a > 0) {
+        *out_r /= *out_a;
+        *out_g /= *out_a;
+        *out_b /= *out_a;
+    }
+}
+
+// Writes one pixel from straight color.
+template <typename S> inline void StorePixel(
+    typename S::T* p, bool enableAlpha,
+    f64 r, f64 g, f64 b, f64 a
+) {
+    if (S::premultiplied && enableAlpha) {
+        r *= a;
+        g *= a;
+        b *= a;
+    }
+
+    p[0] = S::Store(r);
+    p[1] = S::Store(g);
+    p[2] = S::Store(b);
+    if (enableAlpha) p[3] = S::Store(a);
+}
+
+i64 GetPixelFormatSize(i32 pixelFormat) {
+    i64 size = sizeof(f64);
+    WithPixelFormat(pixelFormat, [&](auto s) { size = sizeof(typename decltype(s)::T); });
+    return size;
+}
+
+// Live and peak bytes plus object count per MEMORY_KIND_*, the last entry totals them. Bytes are what pooled
+// buffers and mapped files take while an object holds them, released buffers waiting in the pool are not counted.
+static MemoryCounters memoryCounters[MEMORY_KIND_COUNT + 1];
+static std::atomic<i64> memorySoftLimit;
+
+static void UpdateMemoryPeak(MemoryCounters& counters, i64 live) {
+    i64 peak = counters.peakBytes.load(std::memory_order_relaxed);
+    while (live > peak && !counters.peakBytes.compare_exchange_weak(peak, live, std::memory_order_relaxed));
+}
+
+static void AddMemoryUsage(i32 kind, i64 bytes) {
+    MemoryCounters& total = memoryCounters[MEMORY_KIND_COUNT];
+    UpdateMemoryPeak(memoryCounters[kind], memoryCounters[kind].liveBytes.fetch_add(bytes, std::memory_order_relaxed) + bytes);
+    UpdateMemoryPeak(total, total.liveBytes.fetch_add(bytes, std::memory_order_relaxed) + bytes);
+}
+
+static void CountMemoryObject(i32 kind, i64 delta) {
+    memoryCounters[kind].objects.fetch_add(delta, std::memory_order_relaxed);
+    memoryCounters[MEMORY_KIND_COUNT].objects.fetch_add(delta, std::memory_order_relaxed);
+}
+
+// Pixel, sample and WAV buffers come from per size class free lists, so frames, textures and clips of one size
+// reuse memory instead of going back to the allocator each time. Up to limit bytes of released buffers are kept.
+// Every buffer carries a reference count, a texture sharing a context's pixels holds one so either side can go
+// first.
+static BufferPool* GetBufferPool() {
+    // never destroyed, objects may still be released while the process exits
+    static BufferPool* pool = new BufferPool{{}, {}, 0, BUFFER_POOL_DEFAULT_LIMIT};
+    return pool;
+}
+
+// eight classes per power of two above a page, buffers a little apart in size share one
+static i64 GetBufferSizeClass(i64 bytes) {
+    if (bytes <= 4096) return 4096;
+
+    i64 step = 1L << (62 - __builtin_clzl(bytes - 1) - 2);
+    return (bytes + step - 1) / step * step;
+}
+
+inline PooledBufferHeader* GetPooledBufferHeader(void* buffer) {
+    return (PooledBufferHeader*)((iu8*)buffer - BUFFER_HEADER_SIZE);
+}
+
+static void FreeBufferBlock(iu8* block) {
+    GetPooledBufferHeader(block + BUFFER_HEADER_SIZE)->~PooledBufferHeader();
+    ::operator delete(block, std::align_val_t(BUFFER_HEADER_SIZE));
+}
+
+void* AcquireBuffer(i64 bytes, i32 kind) {
+    BufferPool* pool = GetBufferPool();
+    i64 sizeClass = GetBufferSizeClass(bytes);
+    iu8* block = nullptr;
+
+    {
+        std::lock_guard<std::mutex> lock(pool->mutex);
+        auto it = pool->freeBlocks.find(sizeClass);
+        if (it != pool->freeBlocks.end() && !it->second.empty()) {
+            block = it->second.back();
+            it->second.pop_back();
+            pool->pooledBytes -= sizeClass;
+        }
+    }
+
+    if (!block) {
+        block = (iu8*)::operator new(BUFFER_HEADER_SIZE + sizeClass, std::align_val_t(BUFFER_HEADER_SIZE));
+        new (block) PooledBufferHeader{sizeClass, {0}, kind};
+    }
+
+    PooledBufferHeader* header = GetPooledBufferHeader(block + BUFFER_HEADER_SIZE);
+    header->refs.store(1, std::memory_order_relaxed);
+    header->kind = kind;
+    AddMemoryUsage(kind, sizeClass);
+    return block + BUFFER_HEADER_SIZE;
+}
+
+void RetainBuffer(void* buffer) {
+    GetPooledBufferHeader(buffer)->refs.fetch_add(1, std::memory_order_relaxed);
+}
+
+void ReleaseBuffer(void* buffer) {
+    if (!buffer) return;
+
+    PooledBufferHeader* header = GetPooledBufferHeader(buffer);
+    if (header->refs.fetch_sub(1, std::memory_order_acq_rel) != 1) return;
+
+    AddMemoryUsage(header->kind, -header->sizeClass);
+
+    BufferPool* pool = GetBufferPool();
+    iu8* block = (iu8*)header;
+
+    {
+        std::lock_guard<std::mutex> lock(pool->mutex);
+        if (pool->pooledBytes + header->sizeClass <= pool->limit) {
+            pool->freeBlocks[header->sizeClass].push_back(block);
+            pool->pooledBytes += header->sizeClass;
+            return;
+        }
+    }
+
+    FreeBufferBlock(block);
+}
+
+// Frees pooled buffers until at most keep bytes are left, the limit stays as it is.
+static void TrimBufferPool(i64 keep) {
+    BufferPool* pool = GetBufferPool();
+    std::vector<iu8*> freed;
+
+    {
+        std::lock_guard<std::mutex> lock(pool->mutex);
+
+        for (auto& entry : pool->freeBlocks) {
+            while (pool->pooledBytes > keep && !entry.second.empty()) {
+                freed.push_back(entry.second.back());
+                entry.second.pop_back();
+                pool->pooledBytes -= entry.first;
+            }
+        }
+    }
+
+    for (iu8* block : freed) FreeBufferBlock(block);
+}
+
+// Caps the bytes kept in the free lists, buffers over it are freed right away. 0 turns pooling off.
+void SetBufferPoolLimit(i64 bytes) {
+    BufferPool* pool = GetBufferPool();
+
+    {
+        std::lock_guard<std::mutex> lock(pool->mutex);
+        pool->limit = std::max(0L, bytes);
+    }
+
+    TrimBufferPool(std::max(0L, bytes));
+}
+
+i64 GetBufferPoolSize() {
+    BufferPool* pool = GetBufferPool();
+    std::lock_guard<std::mutex> lock(pool->mutex);
+    return pool->pooledBytes;
+}
+
+// MEMORY_STATS_FIELDS values (live bytes, peak bytes, objects) for each MEMORY_KIND_* and then the totals.
+void GetMemoryStats(i64* out) {
+    for (i64 i = 0; i <= MEMORY_KIND_COUNT; i++) {
+        out[i * MEMORY_STATS_FIELDS] = memoryCounters[i].liveBytes.load(std::memory_order_relaxed);
+        out[i * MEMORY_STATS_FIELDS + 1] = memoryCounters[i].peakBytes.load(std::memory_order_relaxed);
+        out[i * MEMORY_STATS_FIELDS + 2] = memoryCounters[i].objects.load(std::memory_order_relaxed);
+    }
+}
+
+// Budget for the live bytes of all kinds, 0 means none. Nothing is refused natively, callers ask CheckMemoryLimit
+// before they allocate.
+void SetMemorySoftLimit(i64 bytes) {
+    memorySoftLimit.store(std::max(0L, bytes), std::memory_order_relaxed);
+}
+
+i64 GetMemorySoftLimit() {
+    return memorySoftLimit.load(std::memory_order_relaxed);
+}
+
+// Whether bytes more stay within the soft limit. Pooled buffers are freed first when they would push the process
+// over it, they are reused rather than refused.
+bool CheckMemoryLimit(i64 bytes) {
+    i64 limit = memorySoftLimit.load(std::memory_order_relaxed);
+    if (limit <= 0) return true;
+
+    i64 live = memoryCounters[MEMORY_KIND_COUNT].liveBytes.load(std::memory_order_relaxed);
+    if (live + bytes > limit) return false;
+
+    if (live + bytes + GetBufferPoolSize() > limit) TrimBufferPool(limit - live - bytes);
+    return true;
+}
+
+void* CreatePixelBuffer(i32 pixelFormat, i64 size, i32 kind) {
+    return AcquireBuffer(size * GetPixelFormatSize(pixelFormat), kind);
+}
+
+void DestroyPixelBuffer(void* buffer) {
+    ReleaseBuffer(buffer);
+}
+
 i64 GetBufferSize(RenderContext* ctx) {
     return ctx->width * ctx->height * (ctx->enableAlpha ? 4 : 3);
 }
 
 RenderContext* CreateRenderContext(
     i64 width, i64 height,
-    bool enableAlpha
+    bool enableAlpha,
+    i32 pixelFormat
 ) {
     RenderContext* ctx = new RenderContext();
+    CountMemoryObject(MEMORY_KIND_RENDER_CONTEXT, 1);
     ctx->width = width;
     ctx->height = height;
     ctx->enableAlpha = enableAlpha;
-    ctx->buffer = new f64[GetBufferSize(ctx)];
+    ctx->pixelFormat = pixelFormat;
+    ctx->buffer = CreatePixelBuffer(pixelFormat, GetBufferSize(ctx), MEMORY_KIND_RENDER_CONTEXT);
+    // pooled buffers keep whatever their last owner drew, a new context starts transparent black
+    memset(ctx->buffer, 0, GetBufferSize(ctx) * GetPixelFormatSize(pixelFormat));
 
     ctx->transformMatrix[0] = 1;
     ctx->transformMatrix[1] = 0;
@@ -24,6 +289,7 @@ RenderContext* CreateRenderContext(
     ctx->colorTransform[1] = 1;
     ctx->colorTransform[2] = 1;
     ctx->colorTransform[3] = 1;
+    ctx->antiAlias = false;
 
     ctx->stateStack = std::stack<RenderContextState>();
 
@@ -31,29 +297,79 @@ RenderContext* CreateRenderContext(
 }
 
 void DestroyRenderContext(RenderContext* ctx) {
-    return;
-    delete[] ctx->buffer;
+    DestroyPixelBuffer(ctx->buffer);
+    CountMemoryObject(MEMORY_KIND_RENDER_CONTEXT, -1);
     delete ctx;
 }
 
 void ResizeRenderContext(RenderContext* ctx, i64 width, i64 height) {
-    f64* newBuffer = new f64[width * height * (ctx->enableAlpha ? 4 : 3)];
-    delete[] ctx->buffer;
+    i64 size = width * height * (ctx->enableAlpha ? 4 : 3);
+    void* newBuffer = CreatePixelBuffer(ctx->pixelFormat, size, MEMORY_KIND_RENDER_CONTEXT);
+    memset(newBuffer, 0, size * GetPixelFormatSize(ctx->pixelFormat));
+    DestroyPixelBuffer(ctx->buffer);
     ctx->buffer = newBuffer;
     ctx->width = width;
     ctx->height = height;
 }
 
+i32 GetRenderContextPixelFormat(RenderContext* ctx) {
+    return ctx->pixelFormat;
+}
+
+void* GetRenderContextBuffer(RenderContext* ctx) {
+    return ctx->buffer;
+}
+
+// Frees the capture in whatever state it is, initialized or not, released or not. Queued frames are still encoded.
 void DestroyVideoCap(VideoCap* cap) {
-    return;
+    SetVideoCapAsyncFrames(cap, 0);
+
+    AVFormatContext* fmt = cap->formatCtx;
+    if (fmt && fmt->pb) {
+        if (cap->writeCallback) {
+            av_freep(&fmt->pb->buffer);
+            avio_context_free(&fmt->pb);
+        }
+        else if (!(fmt->oformat->flags & AVFMT_NOFILE)) avio_closep(&fmt->pb);
+    }
+
+    avcodec_free_context(&cap->codecCtx);
+    avcodec_free_context(&cap->aCodecCtx);
+    av_dict_free(&cap->options);
+    av_dict_free(&cap->muxerOptions);
+    av_frame_free(&cap->frame);
+    av_packet_free(&cap->packet);
+    sws_freeContext(cap->swsCtx);
+    avformat_free_context(fmt);
+    ReleaseBuffer(cap->rgbBuffer);
+    CountMemoryObject(MEMORY_KIND_VIDEO_CAP, -1);
     delete cap;
 }
 
+// Converts the context to straight 8-bit color, the layout PIL and swscale expect.
 void GetBufferAsUInt8(RenderContext* ctx, iu8 *buffer) {
-    i64 size = GetBufferSize(ctx);
-    for (i64 i = 0; i < size; ++i) {
-        buffer[i] = (iu8)(ctx->buffer[i] * 255);
-    }
+    WithPixelFormat(ctx->pixelFormat, [&](auto s) {
+        typedef decltype(s) S;
+        const typename S::T* src = (const typename S::T*)ctx->buffer;
+        i64 size = GetBufferSize(ctx);
+
+        if constexpr (!S::premultiplied) {
+            for (i64 i = 0; i < size; ++i) {
+                buffer[i] = (iu8)(S::Load(src[i]) * 255);
+            }
+        }
+        else if (!ctx->enableAlpha) {
+            memcpy(buffer, src, size);
+        }
+        else {
+            for (i64 i = 0; i < size; i += 4) {
+                f64 r, g, b, a;
+                LoadPixel<S>(src + i, true, &r, &g, &b, &a);
+                StorePixel<S>(buffer + i, false, r, g, b, a);
+                buffer[i + 3] = src[i + 3];
+            }
+        }
+    });
 }
 
 static const char* av_err2str_cpp(int err) {
@@ -64,6 +380,7 @@ static const char* av_err2str_cpp(int err) {
 
 VideoCap* CreateVideoCap(i64 width, i64 height, f64 frameRate){
     VideoCap* cap = new VideoCap();
+    CountMemoryObject(MEMORY_KIND_VIDEO_CAP, 1);
     cap->width = width;
     cap->height = height;
     cap->frameRate = frameRate;
@@ -76,13 +393,65 @@ VideoCap* CreateVideoCap(i64 width, i64 height, f64 frameRate){
     return cap;
 }
 
+// Options are kept until InitializeVideoCap. "encoder" and "container" pick the encoder and muxer by name, gop,
+// bframes, bitrate and thread_count are aliases of g, bf, b and threads, everything else (preset, tune, crf,
+// thread_type, ...) goes to avcodec_open2 unchanged.
+void SetVideoCapOption(VideoCap* cap, const char* key, const char* value) {
+    static const char* aliases[][2] = {{"gop", "g"}, {"bframes", "bf"}, {"bitrate", "b"}, {"thread_count", "threads"}};
+
+    for (auto& alias : aliases) {
+        if (strcmp(key, alias[0]) == 0) key = alias[1];
+    }
+    av_dict_set(&cap->options, key, value, 0);
+}
+
+// Options for avformat_write_header, e.g. movflags=frag_keyframe+empty_moov for an mp4 that plays while written.
+void SetVideoCapMuxerOption(VideoCap* cap, const char* key, const char* value) {
+    av_dict_set(&cap->muxerOptions, key, value, 0);
+}
+
+// The muxer writes through callback instead of opening the path given to InitializeVideoCap. The output can't
+// seek, so mp4 needs fragmented movflags. callback returns the bytes taken or a negative value on error.
+void SetVideoCapWriteCallback(VideoCap* cap, VideoCapWriteCallback callback) {
+    cap->writeCallback = callback;
+}
+
+// the write_packet signature gained const in libavformat 6.1
+#ifdef FF_API_AVIO_WRITE_NONCONST
+static int WriteVideoCapPacket(void* opaque, const uint8_t* data, int size) {
+#else
+static int WriteVideoCapPacket(void* opaque, uint8_t* data, int size) {
+#endif
+    VideoCap* cap = (VideoCap*)opaque;
+    return cap->writeCallback(data, size) < 0 ? AVERROR(EIO) : size;
+}
+
+// removes key from the options, returning its value or an empty string
+static std::string TakeVideoCapOption(VideoCap* cap, const char* key) {
+    AVDictionaryEntry* entry = av_dict_get(cap->options, key, nullptr, 0);
+    if (!entry) return "";
+
+    std::string value = entry->value;
+    av_dict_set(&cap->options, key, nullptr, 0);
+    return value;
+}
+
 bool InitializeVideoCap(
     VideoCap* cap, const char* path,
     bool hasAudio, AudioClip* aClip, i64 aBitRate
 ) {
-    const AVCodec* vCodec = avcodec_find_encoder(AV_CODEC_ID_H264);
+    std::string encoder = TakeVideoCapOption(cap, "encoder");
+    std::string container = TakeVideoCapOption(cap, "container");
+
+    if (!container.empty()) {
+        const AVOutputFormat* fmt = av_guess_format(container.c_str(), nullptr, nullptr);
+        if (!fmt) { fprintf(stderr, "[InitializeVideoCap] unknown container %s\n", container.c_str()); return false; }
+        cap->formatCtx->oformat = fmt;
+    }
+
+    const AVCodec* vCodec = encoder.empty() ? avcodec_find_encoder(AV_CODEC_ID_H264) : avcodec_find_encoder_by_name(encoder.c_str());
     if (!vCodec) {
-        delete cap;
+        fprintf(stderr, "[InitializeVideoCap] encoder %s not found\n", encoder.empty() ? "h264" : encoder.c_str());
         return false;
     }
     cap->stream = avformat_new_stream(cap->formatCtx, vCodec);
@@ -92,15 +461,26 @@ bool InitializeVideoCap(
     cap->codecCtx->time_base = {1, (int)cap->frameRate};
     cap->codecCtx->framerate = {(int)cap->frameRate, 1};
     cap->codecCtx->pix_fmt = AV_PIX_FMT_YUV420P;
-    cap->codecCtx->gop_size = 10;
-    cap->codecCtx->max_b_frames = 1;
+    // GOP and B-frames are left to the encoder's defaults, threads to one per core, unless an option says otherwise
+    cap->codecCtx->thread_count = 0;
+    if (cap->formatCtx->oformat->flags & AVFMT_GLOBALHEADER) cap->codecCtx->flags |= AV_CODEC_FLAG_GLOBAL_HEADER;
 
-    avcodec_parameters_from_context(cap->stream->codecpar, cap->codecCtx);
-    if (avcodec_open2(cap->codecCtx, vCodec, nullptr) < 0) {
-        delete cap;
+    int openRet = avcodec_open2(cap->codecCtx, vCodec, &cap->options);
+    if (openRet < 0) {
+        fprintf(stderr, "[InitializeVideoCap] avcodec_open2 failed: %s\n", av_err2str_cpp(openRet));
         return false;
     }
 
+    // avcodec_open2 leaves the options it did not recognize
+    AVDictionaryEntry* unused = nullptr;
+    while ((unused = av_dict_get(cap->options, "", unused, AV_DICT_IGNORE_SUFFIX))) {
+        fprintf(stderr, "[InitializeVideoCap] unused encoder option %s=%s\n", unused->key, unused->value);
+    }
+    av_dict_free(&cap->options);
+
+    avcodec_parameters_from_context(cap->stream->codecpar, cap->codecCtx);
+    cap->stream->time_base = cap->codecCtx->time_base;
+
     cap->frame = av_frame_alloc();
     cap->frame->format = cap->codecCtx->pix_fmt;
     cap->frame->width  = cap->codecCtx->width;
@@ -132,18 +512,23 @@ bool InitializeVideoCap(
     }
 
     int ret = 0;
-    if (!(cap->formatCtx->oformat->flags & AVFMT_NOFILE)) {
+    if (cap->writeCallback) {
+        cap->formatCtx->pb = avio_alloc_context(
+            (unsigned char*)av_malloc(VIDEO_CAP_IO_BUFFER_SIZE), VIDEO_CAP_IO_BUFFER_SIZE,
+            1, cap, nullptr, WriteVideoCapPacket, nullptr
+        );
+        cap->formatCtx->flags |= AVFMT_FLAG_CUSTOM_IO;
+    }
+    else if (!(cap->formatCtx->oformat->flags & AVFMT_NOFILE)) {
         ret = avio_open(&cap->formatCtx->pb, path, AVIO_FLAG_WRITE);
         if (ret < 0) {
             fprintf(stderr, "[CreateVideoCap] avio_open failed: %s\n", av_err2str_cpp(ret));
-            DestroyVideoCap(cap);
             return false;
         }
     }
-    ret = avformat_write_header(cap->formatCtx, nullptr);
+    ret = avformat_write_header(cap->formatCtx, &cap->muxerOptions);
     if (ret < 0) {
         fprintf(stderr, "[CreateVideoCap] avformat_write_header failed: %s\n", av_err2str_cpp(ret));
-        DestroyVideoCap(cap);
         return false;
     }
 
@@ -197,6 +582,7 @@ bool InitializeVideoCap(
 
 void ReleaseVideoCap(VideoCap* cap){
     AVFormatContext* fmt = cap->formatCtx;
+    SetVideoCapAsyncFrames(cap, 0);
 
     int ret = avcodec_send_frame(cap->codecCtx, nullptr);
     if (ret < 0) {
@@ -214,51 +600,145 @@ void ReleaseVideoCap(VideoCap* cap){
 
     av_write_trailer(fmt);
 
-    if (!(fmt->oformat->flags & AVFMT_NOFILE)) avio_closep(&fmt->pb);
+    if (cap->writeCallback) {
+        avio_flush(fmt->pb);
+        av_freep(&fmt->pb->buffer);
+        avio_context_free(&fmt->pb);
+    }
+    else if (!(fmt->oformat->flags & AVFMT_NOFILE)) avio_closep(&fmt->pb);
+    av_dict_free(&cap->muxerOptions);
 
     avcodec_free_context(&cap->codecCtx);
+    avcodec_free_context(&cap->aCodecCtx);
+    av_dict_free(&cap->options);
     av_frame_free(&cap->frame);
     av_packet_free(&cap->packet);
     sws_freeContext(cap->swsCtx);
     avformat_free_context(fmt);
+    ReleaseBuffer(cap->rgbBuffer);
 
     cap->formatCtx = nullptr;
     cap->codecCtx = nullptr;
     cap->frame = nullptr;
     cap->packet = nullptr;
     cap->swsCtx = nullptr;
+    cap->rgbBuffer = nullptr;
+    cap->rgbBufferSize = 0;
 }
 
-void PutRendererContextFrame(VideoCap* cap, RenderContext* ctx) {
-    i64 pxCount = ctx->width * ctx->height;
+void ParallelForRows(i64 top, i64 bottom, i64 pixelsPerRow, const std::function<void(i64, i64)>& fn);
+
+// Writes the context straight into YUV420P planes in one pass, BT.601 limited range like swscale's default.
+// Every pixel format encodes its straight color with alpha dropped, premultiplied u8 is divided back first, so
+// a scene looks the same whatever format it was drawn in. Chroma is the average of each 2x2 block.
+template <typename S> static void ConvertToYUV420P(RenderContext* ctx, AVFrame* frame) {
+    const typename S::T* src = (const typename S::T*)ctx->buffer;
     i64 ipp = ctx->enableAlpha ? 4 : 3;
+    i64 width = ctx->width;
+    i64 height = ctx->height;
+
+    // one pixel into its Y sample, its clamped color is summed for the block's chroma
+    bool enableAlpha = ctx->enableAlpha;
+    auto luma = [enableAlpha](const typename S::T* p, iu8* out, f32* sum) {
+        f32 r, g, b;
+        if constexpr (S::premultiplied) {
+            // u8 storage is always in range, color never exceeds its alpha
+            f32 scale = !enableAlpha ? 1.0f / 255.0f : (p[3] > 0 ? 1.0f / p[3] : 0.0f);
+            r = std::min(p[0] * scale, 1.0f);
+            g = std::min(p[1] * scale, 1.0f);
+            b = std::min(p[2] * scale, 1.0f);
+        }
+        else {
+            r = (f32)S::Load(p[0]);
+            g = (f32)S::Load(p[1]);
+            b = (f32)S::Load(p[2]);
+
+            r = std::min(std::max(r, 0.0f), 1.0f);
+            g = std::min(std::max(g, 0.0f), 1.0f);
+            b = std::min(std::max(b, 0.0f), 1.0f);
+        }
+
+        *out = (iu8)(16.5f + 65.481f * r + 128.553f * g + 24.966f * b);
+        sum[0] += r;
+        sum[1] += g;
+        sum[2] += b;
+    };
+
+    ParallelForRows(0, (height + 1) / 2, width * 2, [&](i64 top, i64 bottom) {
+        for (i64 cj = top; cj < bottom; ++cj) {
+            i64 rows = std::min(2L, height - cj * 2);
+            const typename S::T* srcRows[2] = {src + cj * 2 * width * ipp, src + (cj * 2 + rows - 1) * width * ipp};
+            iu8* yRows[2] = {frame->data[0] + cj * 2 * frame->linesize[0], frame->data[0] + (cj * 2 + rows - 1) * frame->linesize[0]};
+            iu8* uRow = frame->data[1] + cj * frame->linesize[1];
+            iu8* vRow = frame->data[2] + cj * frame->linesize[2];
+
+            for (i64 x = 0, ci = 0; x < width; x += 2, ++ci) {
+                i64 cols = std::min(2L, width - x);
+                f32 sum[3] = {0, 0, 0};
+
+                if (rows == 2 && cols == 2) {
+                    luma(srcRows[0] + x * ipp, yRows[0] + x, sum);
+                    luma(srcRows[0] + (x + 1) * ipp, yRows[0] + x + 1, sum);
+                    luma(srcRows[1] + x * ipp, yRows[1] + x, sum);
+                    luma(srcRows[1] + (x + 1) * ipp, yRows[1] + x + 1, sum);
+                }
+                else {
+                    for (i64 dy = 0; dy < rows; ++dy) {
+                        for (i64 dx = 0; dx < cols; ++dx) luma(srcRows[dy] + (x + dx) * ipp, yRows[dy] + x + dx, sum);
+                    }
+                }
+
+                f32 n = 1.0f / (rows * cols);
+                f32 r = sum[0] * n;
+                f32 g = sum[1] * n;
+                f32 b = sum[2] * n;
+                uRow[ci] = (iu8)(128.5f - 37.797f * r - 74.203f * g + 112.0f * b);
+                vRow[ci] = (iu8)(128.5f + 112.0f * r - 93.786f * g - 18.214f * b);
+            }
+        }
+    });
+}
+
+static void EncodeVideoCapFrame(VideoCap* cap, RenderContext* ctx) {
+    // the encoder may still reference the previous frame's planes
+    av_frame_make_writable(cap->frame);
 
-    iu8* tbuffer = new iu8[pxCount * ipp];
-    for (i64 i = 0; i < pxCount * ipp; ++i) {
-        tbuffer[i] = (iu8)(ctx->buffer[i] * 255.0);
+    if (ctx->width == cap->width && ctx->height == cap->height) {
+        WithPixelFormat(ctx->pixelFormat, [&](auto s) { ConvertToYUV420P<decltype(s)>(ctx, cap->frame); });
     }
+    else {
+        // only scaling needs swscale, its RGB input lives in a buffer kept across frames
+        i64 ipp = ctx->enableAlpha ? 4 : 3;
+        const uint8_t* srcData[4] = {(const uint8_t*)ctx->buffer, nullptr, nullptr, nullptr};
+        int srcLinesize[4] = {(int)(ctx->width * ipp), 0, 0, 0};
 
-    if (!cap->swsCtx) {
-        cap->swsCtx = sws_getContext(
+        cap->swsCtx = sws_getCachedContext(
+            cap->swsCtx,
             ctx->width, ctx->height, ipp == 4 ? AV_PIX_FMT_RGBA : AV_PIX_FMT_RGB24,
             cap->width, cap->height, AV_PIX_FMT_YUV420P,
             SWS_BILINEAR, nullptr, nullptr, nullptr
         );
-    }
 
-    AVFrame* rgbFrame = av_frame_alloc();
-    av_image_alloc(rgbFrame->data, rgbFrame->linesize, ctx->width, ctx->height, ipp == 4 ? AV_PIX_FMT_RGBA : AV_PIX_FMT_RGB24, 1);
+        // swscale takes straight 8-bit color, which only premultiplied u8 without alpha already is
+        if (ctx->pixelFormat != PIXEL_FORMAT_U8_PREMULTIPLIED || ctx->enableAlpha) {
+            i64 size = GetBufferSize(ctx);
+            if (cap->rgbBufferSize < size) {
+                ReleaseBuffer(cap->rgbBuffer);
+                cap->rgbBuffer = (iu8*)AcquireBuffer(size, MEMORY_KIND_VIDEO_CAP);
+                cap->rgbBufferSize = size;
+            }
 
-    for (int y = 0; y < ctx->height; ++y) {
-        memcpy(rgbFrame->data[0] + y * rgbFrame->linesize[0], tbuffer + y * ctx->width * ipp, ctx->width * ipp);
-    }
+            GetBufferAsUInt8(ctx, cap->rgbBuffer);
+            srcData[0] = cap->rgbBuffer;
+        }
 
-    sws_scale(cap->swsCtx, (const uint8_t* const*)rgbFrame->data, rgbFrame->linesize, 0, ctx->height, cap->frame->data, cap->frame->linesize);
+        sws_scale(cap->swsCtx, srcData, srcLinesize, 0, ctx->height, cap->frame->data, cap->frame->linesize);
+    }
 
     cap->frame->pts = cap->frameIndex++;
 
     int ret = avcodec_send_frame(cap->codecCtx, cap->frame);
-    if (ret < 0) goto END;
+    if (ret < 0) return;
 
     while (ret >= 0) {
         ret = avcodec_receive_packet(cap->codecCtx, cap->packet);
@@ -267,11 +747,98 @@ void PutRendererContextFrame(VideoCap* cap, RenderContext* ctx) {
         av_interleaved_write_frame(cap->formatCtx, cap->packet);
         av_packet_unref(cap->packet);
     }
+}
+
+// Encodes queued frames in order. A frame stays at the front of pendingFrames until it is written, so an empty
+// queue means everything handed over so far is in the muxer.
+static void VideoCapEncoderWorker(VideoCap* cap) {
+    std::unique_lock<std::mutex> lock(cap->encoderMutex);
+
+    while (true) {
+        cap->encoderCv.wait(lock, [&] { return !cap->pendingFrames.empty() || cap->encoderStopping; });
+        if (cap->pendingFrames.empty()) return;
+
+        RenderContext* frame = cap->pendingFrames.front();
+        lock.unlock();
+        EncodeVideoCapFrame(cap, frame);
+        lock.lock();
+
+        cap->pendingFrames.pop_front();
+        cap->freeFrames.push_back(frame);
+        cap->stagingCv.notify_all();
+    }
+}
+
+// Waits for the queue to drain and joins the encoder thread.
+static void StopVideoCapEncoder(VideoCap* cap) {
+    if (!cap->encoderThread.joinable()) return;
+
+    {
+        std::lock_guard<std::mutex> lock(cap->encoderMutex);
+        cap->encoderStopping = true;
+    }
+    cap->encoderCv.notify_all();
+
+    cap->encoderThread.join();
+    cap->encoderStopping = false;
+}
+
+// frames <= 0 encodes synchronously inside PutRendererContextFrame, otherwise up to frames snapshots are queued
+// before the caller blocks. Changing it drains the queue first.
+void SetVideoCapAsyncFrames(VideoCap* cap, i64 frames) {
+    StopVideoCapEncoder(cap);
+
+    for (RenderContext* frame : cap->stagingFrames) DestroyRenderContext(frame);
+    cap->stagingFrames.clear();
+    cap->freeFrames.clear();
+    cap->asyncFrames = std::max(0L, frames);
+}
+
+static void QueueVideoCapFrame(VideoCap* cap, RenderContext* ctx) {
+    RenderContext* frame;
+
+    {
+        std::unique_lock<std::mutex> lock(cap->encoderMutex);
+        if (!cap->encoderThread.joinable()) cap->encoderThread = std::thread(VideoCapEncoderWorker, cap);
+
+        cap->stagingCv.wait(lock, [&] {
+            return !cap->freeFrames.empty() || (i64)cap->stagingFrames.size() < cap->asyncFrames;
+        });
+
+        if (cap->freeFrames.empty()) {
+            frame = CreateRenderContext(ctx->width, ctx->height, ctx->enableAlpha, ctx->pixelFormat);
+            cap->stagingFrames.push_back(frame);
+        }
+        else {
+            frame = cap->freeFrames.back();
+            cap->freeFrames.pop_back();
+        }
+    }
+
+    if (
+        frame->width != ctx->width || frame->height != ctx->height
+        || frame->enableAlpha != ctx->enableAlpha || frame->pixelFormat != ctx->pixelFormat
+    ) {
+        frame->enableAlpha = ctx->enableAlpha;
+        frame->pixelFormat = ctx->pixelFormat;
+        ResizeRenderContext(frame, ctx->width, ctx->height);
+    }
+
+    i64 rowBytes = ctx->width * (ctx->enableAlpha ? 4 : 3) * GetPixelFormatSize(ctx->pixelFormat);
+    ParallelForRows(0, ctx->height, ctx->width, [&](i64 top, i64 bottom) {
+        memcpy((iu8*)frame->buffer + top * rowBytes, (const iu8*)ctx->buffer + top * rowBytes, (bottom - top) * rowBytes);
+    });
 
-END:
-    delete[] tbuffer;
-    av_freep(&rgbFrame->data[0]);
-    av_frame_free(&rgbFrame);
+    {
+        std::lock_guard<std::mutex> lock(cap->encoderMutex);
+        cap->pendingFrames.push_back(frame);
+    }
+    cap->encoderCv.notify_all();
+}
+
+void PutRendererContextFrame(VideoCap* cap, RenderContext* ctx) {
+    if (cap->asyncFrames > 0) QueueVideoCapFrame(cap, ctx);
+    else EncodeVideoCapFrame(cap, ctx);
 }
 
 void SaveContextState(RenderContext* ctx) {
@@ -286,6 +853,7 @@ void SaveContextState(RenderContext* ctx) {
     state.colorTransform[1] = ctx->colorTransform[1];
     state.colorTransform[2] = ctx->colorTransform[2];
     state.colorTransform[3] = ctx->colorTransform[3];
+    state.antiAlias = ctx->antiAlias;
     ctx->stateStack.push(state);
 }
 
@@ -303,83 +871,211 @@ bool RestoreContextState(RenderContext* ctx) {
     ctx->colorTransform[1] = state.colorTransform[1];
     ctx->colorTransform[2] = state.colorTransform[2];
     ctx->colorTransform[3] = state.colorTransform[3];
+    ctx->antiAlias = state.antiAlias;
     ctx->stateStack.pop();
 
     return true;
 }
 
+// Converts the context to straight f64 color whatever its storage format.
 void GetBuffer(RenderContext* ctx, f64 *buffer) {
-    i64 size = GetBufferSize(ctx);
-    for (i64 i = 0; i < size; ++i) {
-        buffer[i] = ctx->buffer[i];
-    }
+    WithPixelFormat(ctx->pixelFormat, [&](auto s) {
+        typedef decltype(s) S;
+        const typename S::T* src = (const typename S::T*)ctx->buffer;
+        i64 ipp = ctx->enableAlpha ? 4 : 3;
+        i64 size = GetBufferSize(ctx);
+
+        for (i64 i = 0; i < size; i += ipp) {
+            LoadPixel<S>(src + i, ctx->enableAlpha, &buffer[i], &buffer[i + 1], &buffer[i + 2], &buffer[i + 3]);
+        }
+    });
+}
+
+// Whether every texel of tex has alpha 1, scanned once so draws of RGBA images without transparency can store
+// instead of blend.
+static bool IsTextureOpaque(Texture* tex) {
+    if (!tex->enableAlpha) return true;
+
+    bool opaque = true;
+    WithPixelFormat(tex->pixelFormat, [&](auto s) {
+        typedef decltype(s) S;
+        const typename S::T* src = (const typename S::T*)tex->buffer;
+        const typename S::T one = S::Store(1);
+        i64 size = tex->width * tex->height * 4;
+
+        for (i64 i = 3; i < size; i += 4) {
+            if (src[i] != one) {
+                opaque = false;
+                return;
+            }
+        }
+    });
+
+    return opaque;
 }
 
 Texture* CreateTexture(
     i64 width, i64 height,
     bool enableAlpha,
-    f64 *buffer
+    f64 *buffer,
+    i32 pixelFormat
 ) {
     Texture* tex = new Texture();
+    CountMemoryObject(MEMORY_KIND_TEXTURE, 1);
     tex->width = width;
     tex->height = height;
     tex->enableAlpha = enableAlpha;
-    i64 size = width * height * (enableAlpha ? 4 : 3);
-    tex->buffer = new f64[size];
+    tex->pixelFormat = pixelFormat;
+    i64 ipp = enableAlpha ? 4 : 3;
+    i64 size = width * height * ipp;
+    tex->buffer = CreatePixelBuffer(pixelFormat, size, MEMORY_KIND_TEXTURE);
 
-    for (i64 i = 0; i < size; ++i) {
-        tex->buffer[i] = buffer[i];
-    }
+    WithPixelFormat(pixelFormat, [&](auto s) {
+        typedef decltype(s) S;
+        typename S::T* dst = (typename S::T*)tex->buffer;
+
+        for (i64 i = 0; i < size; i += ipp) {
+            StorePixel<S>(dst + i, enableAlpha, buffer[i], buffer[i + 1], buffer[i + 2], enableAlpha ? buffer[i + 3] : 1);
+        }
+    });
     
+    tex->opaque = IsTextureOpaque(tex);
     return tex;
 }
 
 Texture* CreateTextureUInt8(
     i64 width, i64 height,
     bool enableAlpha,
-    iu8 *buffer
+    iu8 *buffer,
+    i32 pixelFormat
 ) {
     Texture* tex = new Texture();
+    CountMemoryObject(MEMORY_KIND_TEXTURE, 1);
     tex->width = width;
     tex->height = height;
     tex->enableAlpha = enableAlpha;
-    i64 size = width * height * (enableAlpha ? 4 : 3);
-    tex->buffer = new f64[size];
-
-    for (i64 i = 0; i < size; ++i) {
-        tex->buffer[i] = buffer[i] / 255.0;
-    }
+    tex->pixelFormat = pixelFormat;
+    i64 ipp = enableAlpha ? 4 : 3;
+    i64 size = width * height * ipp;
+    tex->buffer = CreatePixelBuffer(pixelFormat, size, MEMORY_KIND_TEXTURE);
+
+    WithPixelFormat(pixelFormat, [&](auto s) {
+        typedef decltype(s) S;
+        typename S::T* dst = (typename S::T*)tex->buffer;
+
+        for (i64 i = 0; i < size; i += ipp) {
+            StorePixel<S>(
+                dst + i, enableAlpha,
+                buffer[i] / 255.0, buffer[i + 1] / 255.0, buffer[i + 2] / 255.0,
+                enableAlpha ? buffer[i + 3] / 255.0 : 1
+            );
+        }
+    });
 
+    tex->opaque = IsTextureOpaque(tex);
     return tex;
 }
 
 void DestroyTexture(Texture* tex) {
-    return;
-    delete[] tex->buffer;
+    for (Texture* level : tex->mipmaps) DestroyTexture(level);
+    if (tex->mapping) {
+        munmap(tex->mapping, tex->mappingSize);
+        AddMemoryUsage(MEMORY_KIND_TEXTURE, -tex->mappingSize);
+    }
+    else if (!tex->sharedBuffer || tex->retainedBuffer) DestroyPixelBuffer(tex->buffer);
+    CountMemoryObject(MEMORY_KIND_TEXTURE, -1);
     delete tex;
 }
 
+// Texture over width * height pixels stored in pixelFormat at offset in the file at path, which has to be aligned
+// to the element size. The file is mapped rather than read, so nothing is copied and pages load on first use.
+// The mapping is private, writes through GetTextureBuffer stay in this process and the file never changes
+// under the texture, so it mipmaps like an owned one. Returns nullptr when the file cannot hold the pixels.
+Texture* CreateTextureFromMappedFile(
+    const char* path,
+    i64 offset,
+    i64 width, i64 height,
+    bool enableAlpha,
+    i32 pixelFormat
+) {
+    i64 bytes = width * height * (enableAlpha ? 4 : 3) * GetPixelFormatSize(pixelFormat);
+    if (offset < 0 || width <= 0 || height <= 0 || offset % GetPixelFormatSize(pixelFormat) != 0) return nullptr;
+
+    int fd = open(path, O_RDONLY);
+    if (fd < 0) return nullptr;
+
+    struct stat st;
+    void* mapping = MAP_FAILED;
+    if (fstat(fd, &st) == 0 && st.st_size >= offset + bytes) {
+        mapping = mmap(nullptr, st.st_size, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+    }
+    close(fd);
+    if (mapping == MAP_FAILED) return nullptr;
+
+    Texture* tex = new Texture();
+
+    CountMemoryObject(MEMORY_KIND_TEXTURE, 1);
+    tex->width = width;
+    tex->height = height;
+    tex->enableAlpha = enableAlpha;
+    tex->pixelFormat = pixelFormat;
+    tex->buffer = (iu8*)mapping + offset;
+    tex->mapping = mapping;
+    tex->mappingSize = st.st_size;
+    AddMemoryUsage(MEMORY_KIND_TEXTURE, st.st_size);
+    tex->opaque = IsTextureOpaque(tex);
+    return tex;
+}
+
 Texture* CreateTextureFromRenderContext(RenderContext* ctx) {
     Texture* tex = new Texture();
+    CountMemoryObject(MEMORY_KIND_TEXTURE, 1);
     tex->width = ctx->width;
     tex->height = ctx->height;
     tex->enableAlpha = ctx->enableAlpha;
-    i64 size = GetBufferSize(ctx);
-    tex->buffer = new f64[size];
+    tex->pixelFormat = ctx->pixelFormat;
+    i64 bytes = GetBufferSize(ctx) * GetPixelFormatSize(ctx->pixelFormat);
+    tex->buffer = CreatePixelBuffer(ctx->pixelFormat, GetBufferSize(ctx), MEMORY_KIND_TEXTURE);
 
-    for (i64 i = 0; i < size; ++i) {
-        tex->buffer[i] = ctx->buffer[i];
-    }
+    memcpy(tex->buffer, ctx->buffer, bytes);
     
+    tex->opaque = IsTextureOpaque(tex);
     return tex;
 }
 
 Texture* CreateTextureFromRenderContextShared(RenderContext* ctx) {
     Texture* tex = new Texture();
+    CountMemoryObject(MEMORY_KIND_TEXTURE, 1);
     tex->width = ctx->width;
     tex->height = ctx->height;
     tex->enableAlpha = ctx->enableAlpha;
+    tex->pixelFormat = ctx->pixelFormat;
     tex->buffer = ctx->buffer;
+    tex->sharedBuffer = true;
+
+    // the pixels stay alive until both are destroyed, a resize moves the context to a new buffer
+    RetainBuffer(ctx->buffer);
+    tex->retainedBuffer = true;
+    tex->opaque = !tex->enableAlpha;
+    return tex;
+}
+
+// Wraps caller-owned memory already laid out in pixelFormat storage; the caller keeps it alive.
+Texture* CreateTextureFromBufferShared(
+    i64 width, i64 height,
+    bool enableAlpha,
+    void *buffer,
+    i32 pixelFormat
+) {
+    Texture* tex = new Texture();
+    CountMemoryObject(MEMORY_KIND_TEXTURE, 1);
+    tex->width = width;
+    tex->height = height;
+    tex->enableAlpha = enableAlpha;
+    tex->pixelFormat = pixelFormat;
+    tex->buffer = buffer;
+    tex->sharedBuffer = true;
+    tex->opaque = !tex->enableAlpha;
     return tex;
 }
 
@@ -452,7 +1148,7 @@ inline void TransformPointFromMatrix(
     *out_y = matrix[1] * x + matrix[3] * y + matrix[5];
 }
 
-inline void TransformPoint(
+void TransformPoint(
     RenderContext* ctx,
     f64 x, f64 y,
     f64 *out_x, f64 *out_y
@@ -491,34 +1187,170 @@ void GetInverseTransform(
     out_matrix[5] = (b * e - a * f) * inv_det;
 }
 
-bool SetPixel(
-    RenderContext* ctx,
-    i64 x, i64 y,
-    f64 r, f64 g, f64 b, f64 a
-) {
-    if (x < 0) return false;
-    if (x >= ctx->width) return false;
-    if (y < 0) return false;
-    if (y >= ctx->height) return false;
+// Built once on first use from whichever thread gets there, only dispatchMutex guards the workers after that.
+// Never destroyed, workers may still be parked while the process exits.
+static RenderThreadPool* GetRenderThreadPool() {
+    static RenderThreadPool* pool = [] {
+        RenderThreadPool* pool = new RenderThreadPool();
+        pool->stopping = false;
+        pool->generation = 0;
+        pool->busyWorkers = 0;
+        pool->job = nullptr;
+        return pool;
+    }();
+    return pool;
+}
+
+// rows handed to one worker at a time, small enough to balance uneven primitives
+#define RENDER_THREAD_BANDS_PER_WORKER 4
+// below this many pixels a primitive is not worth waking the workers for
+#define RENDER_THREAD_MIN_PIXELS 16384
+
+static void RunRowBands(RenderThreadPool* pool) {
+    while (true) {
+        i64 band = pool->nextBand.fetch_add(1);
+        i64 bandTop = pool->jobTop + band * pool->jobBandSize;
+        if (bandTop >= pool->jobBottom) break;
+
+        (*pool->job)(bandTop, std::min(bandTop + pool->jobBandSize, pool->jobBottom));
+    }
+}
 
-    i64 ipp = ctx->enableAlpha ? 4 : 3;
-    i64 index = y * ctx->width * ipp + x * ipp;
+// seenGeneration is the pool's generation when the worker was spawned, so a job finished before it started is
+// never taken for a new one
+static void RenderThreadPoolWorker(RenderThreadPool* pool, i64 seenGeneration) {
 
-    ctx->buffer[index + 0] = r;
-    ctx->buffer[index + 1] = g;
-    ctx->buffer[index + 2] = b;
-    ctx->buffer[index + 3] = a;
+    while (true) {
+        std::unique_lock<std::mutex> lock(pool->mutex);
+        pool->wakeCv.wait(lock, [&] { return pool->stopping || pool->generation != seenGeneration; });
+        if (pool->stopping) return;
+        seenGeneration = pool->generation;
+        lock.unlock();
 
-    return true;
+        RunRowBands(pool);
+
+        lock.lock();
+        if (--pool->busyWorkers == 0) pool->doneCv.notify_all();
+    }
 }
 
-inline bool ApplyPixel(
-    RenderContext* ctx,
-    i64 x, i64 y,
-    f64 r, f64 g, f64 b, f64 a
-) {
-    if (x < 0) return false;
-    if (x >= ctx->width) return false;
+static void StopRenderThreadPool(RenderThreadPool* pool) {
+    {
+        std::lock_guard<std::mutex> lock(pool->mutex);
+        pool->stopping = true;
+    }
+    pool->wakeCv.notify_all();
+
+    for (std::thread& worker : pool->workers) worker.join();
+    pool->workers.clear();
+    pool->stopping = false;
+}
+
+void SetRenderThreads(i64 n) {
+    if (n <= 0) n = std::max(1u, std::thread::hardware_concurrency());
+
+    RenderThreadPool* pool = GetRenderThreadPool();
+    std::lock_guard<std::mutex> dispatchLock(pool->dispatchMutex);
+    StopRenderThreadPool(pool);
+
+    // the calling thread always takes bands too, so n threads means n - 1 workers
+    for (i64 i = 0; i < n - 1; ++i) {
+        pool->workers.emplace_back(RenderThreadPoolWorker, pool, pool->generation);
+    }
+}
+
+i64 GetRenderThreads() {
+    RenderThreadPool* pool = GetRenderThreadPool();
+    std::lock_guard<std::mutex> dispatchLock(pool->dispatchMutex);
+    return pool->workers.size() + 1;
+}
+
+// Calls fn(bandTop, bandBottom) over disjoint row bands covering [top, bottom).
+// Every pixel is computed exactly as in the serial loop, bands only decide which thread writes it.
+void ParallelForRows(i64 top, i64 bottom, i64 pixelsPerRow, const std::function<void(i64, i64)>& fn) {
+    if (bottom <= top) return;
+
+    RenderThreadPool* pool = GetRenderThreadPool();
+    i64 rows = bottom - top;
+
+    if (
+        rows < 2 || rows * pixelsPerRow < RENDER_THREAD_MIN_PIXELS
+        || !pool->dispatchMutex.try_lock()
+    ) {
+        // serial path, also taken when another thread already owns the pool
+        fn(top, bottom);
+        return;
+    }
+
+    // workers only change under dispatchMutex, SetRenderThreads may run on another thread
+    if (pool->workers.empty()) {
+        pool->dispatchMutex.unlock();
+        fn(top, bottom);
+        return;
+    }
+
+    i64 threads = pool->workers.size() + 1;
+    i64 bandSize = std::max(1L, rows / (threads * RENDER_THREAD_BANDS_PER_WORKER));
+    bandSize = std::max(bandSize, RENDER_THREAD_MIN_PIXELS / 4 / std::max(1L, pixelsPerRow));
+
+    {
+        std::lock_guard<std::mutex> lock(pool->mutex);
+        pool->job = &fn;
+        pool->jobTop = top;
+        pool->jobBottom = bottom;
+        pool->jobBandSize = bandSize;
+        pool->nextBand = 0;
+        pool->busyWorkers = pool->workers.size();
+        ++pool->generation;
+    }
+    pool->wakeCv.notify_all();
+
+    RunRowBands(pool);
+
+    {
+        std::unique_lock<std::mutex> lock(pool->mutex);
+        pool->doneCv.wait(lock, [&] { return pool->busyWorkers == 0; });
+        pool->job = nullptr;
+    }
+
+    pool->dispatchMutex.unlock();
+}
+
+template <typename S> inline bool SetPixelT(
+    RenderContext* ctx,
+    i64 x, i64 y,
+    f64 r, f64 g, f64 b, f64 a
+) {
+    if (x < 0) return false;
+    if (x >= ctx->width) return false;
+    if (y < 0) return false;
+    if (y >= ctx->height) return false;
+
+    i64 ipp = ctx->enableAlpha ? 4 : 3;
+    i64 index = y * ctx->width * ipp + x * ipp;
+
+    StorePixel<S>((typename S::T*)ctx->buffer + index, ctx->enableAlpha, r, g, b, a);
+
+    return true;
+}
+
+bool SetPixel(
+    RenderContext* ctx,
+    i64 x, i64 y,
+    f64 r, f64 g, f64 b, f64 a
+) {
+    bool res = false;
+    WithPixelFormat(ctx->pixelFormat, [&](auto s) { res = SetPixelT<decltype(s)>(ctx, x, y, r, g, b, a); });
+    return res;
+}
+
+template <typename S> inline bool ApplyPixelT(
+    RenderContext* ctx,
+    i64 x, i64 y,
+    f64 r, f64 g, f64 b, f64 a
+) {
+    if (x < 0) return false;
+    if (x >= ctx->width) return false;
     if (y < 0) return false;
     if (y >= ctx->height) return false;
 
@@ -529,95 +1361,382 @@ inline bool ApplyPixel(
 
     i64 ipp = ctx->enableAlpha ? 4 : 3;
     i64 index = y * ctx->width * ipp + x * ipp;
+    typename S::T* p = (typename S::T*)ctx->buffer + index;
+
+    if constexpr (S::premultiplied) {
+        if (ctx->enableAlpha) {
+            // source-over onto premultiplied storage
+            f64 ia = 1 - a;
+            p[0] = S::Store(S::Load(p[0]) * ia + r * a);
+            p[1] = S::Store(S::Load(p[1]) * ia + g * a);
+            p[2] = S::Store(S::Load(p[2]) * ia + b * a);
+            p[3] = S::Store(S::Load(p[3]) * ia + a);
+            return true;
+        }
+    }
 
     if (a != 1) {
-        r = ctx->buffer[index + 0] * (1 - a) + r * a;
-        g = ctx->buffer[index + 1] * (1 - a) + g * a;
-        b = ctx->buffer[index + 2] * (1 - a) + b * a;
+        r = S::Load(p[0]) * (1 - a) + r * a;
+        g = S::Load(p[1]) * (1 - a) + g * a;
+        b = S::Load(p[2]) * (1 - a) + b * a;
     }
 
-    ctx->buffer[index + 0] = r;
-    ctx->buffer[index + 1] = g;
-    ctx->buffer[index + 2] = b;
+    p[0] = S::Store(r);
+    p[1] = S::Store(g);
+    p[2] = S::Store(b);
 
     if (ctx->enableAlpha) {
-        ctx->buffer[index + 3] = a;
-        a = ctx->buffer[index + 3] * (1 - a) + a * a;
+        p[3] = S::Store(a);
     }
 
     return true;
 }
 
+bool ApplyPixel(
+    RenderContext* ctx,
+    i64 x, i64 y,
+    f64 r, f64 g, f64 b, f64 a
+) {
+    bool res = false;
+    WithPixelFormat(ctx->pixelFormat, [&](auto s) { res = ApplyPixelT<decltype(s)>(ctx, x, y, r, g, b, a); });
+    return res;
+}
+
+// Calls fn with the number of channels per pixel as a compile time constant, so span loops have a fixed stride.
+template <typename Fn> inline void WithPixelChannels(bool enableAlpha, Fn fn) {
+    if (enableAlpha) fn(std::integral_constant<i64, 4>());
+    else fn(std::integral_constant<i64, 3>());
+}
+
+// Source-over of one color already multiplied by the color transform, same result as ApplyPixelT.
+// Blending at alpha 1 leaves exactly the source, so there is no branch on a.
+template <typename S, i64 IPP> inline void BlendPixel(typename S::T* p, f64 r, f64 g, f64 b, f64 a) {
+    f64 ia = 1 - a;
+    p[0] = S::Store(S::Load(p[0]) * ia + r * a);
+    p[1] = S::Store(S::Load(p[1]) * ia + g * a);
+    p[2] = S::Store(S::Load(p[2]) * ia + b * a);
+
+    if constexpr (IPP == 4) {
+        if constexpr (S::premultiplied) p[3] = S::Store(S::Load(p[3]) * ia + a);
+        else p[3] = S::Store(a);
+    }
+}
+
+// The span kernels below blend pixels [start, end) of row j, which the caller has already clipped to the
+// context. Addressing and the color transform are resolved once per span, the loops have no bounds checks.
+// coverage, when given, holds one factor per pixel of the span that scales its alpha (anti-aliased edges).
+
+// One color over the whole span.
+template <typename S> inline void BlendSpanSolid(
+    RenderContext* ctx,
+    i64 j, i64 start, i64 end,
+    f64 r, f64 g, f64 b, f64 a,
+    const f64* coverage = nullptr
+) {
+    if (end <= start) return;
+
+    r *= ctx->colorTransform[0];
+    g *= ctx->colorTransform[1];
+    b *= ctx->colorTransform[2];
+    a *= ctx->colorTransform[3];
+
+    WithPixelChannels(ctx->enableAlpha, [&](auto c) {
+        constexpr i64 IPP = decltype(c)::value;
+        typename S::T* __restrict p = (typename S::T*)ctx->buffer + (j * ctx->width + start) * IPP;
+        i64 count = end - start;
+
+        if (coverage) {
+            for (i64 k = 0; k < count; ++k) {
+                BlendPixel<S, IPP>(p + k * IPP, r, g, b, a * coverage[k]);
+            }
+            return;
+        }
+
+        if (a == 1) {
+            typename S::T v[4] = {S::Store(r), S::Store(g), S::Store(b), S::Store(1)};
+            for (i64 k = 0; k < count; ++k) {
+                for (i64 n = 0; n < IPP; ++n) p[k * IPP + n] = v[n];
+            }
+            return;
+        }
+
+        f64 ia = 1 - a;
+        f64 ra = r * a, ga = g * a, ba = b * a;
+        typename S::T sa = S::Store(a);
+
+        for (i64 k = 0; k < count; ++k) {
+            typename S::T* q = p + k * IPP;
+            q[0] = S::Store(S::Load(q[0]) * ia + ra);
+            q[1] = S::Store(S::Load(q[1]) * ia + ga);
+            q[2] = S::Store(S::Load(q[2]) * ia + ba);
+
+            if constexpr (IPP == 4) {
+                if constexpr (S::premultiplied) q[3] = S::Store(S::Load(q[3]) * ia + a);
+                else q[3] = sa;
+            }
+        }
+    });
+}
+
+// Per pixel straight colors, colors holds r, g, b, a for each pixel of the span.
+// An opaque span only stores, the caller promises every alpha times the color transform alpha is 1.
+template <typename S> inline void BlendSpanTextured(
+    RenderContext* ctx,
+    i64 j, i64 start, i64 end,
+    const f64* colors, bool opaque,
+    const f64* coverage = nullptr
+) {
+    if (end <= start) return;
+
+    f64 ct[4] = {ctx->colorTransform[0], ctx->colorTransform[1], ctx->colorTransform[2], ctx->colorTransform[3]};
+
+    WithPixelChannels(ctx->enableAlpha, [&](auto c) {
+        constexpr i64 IPP = decltype(c)::value;
+        typename S::T* __restrict p = (typename S::T*)ctx->buffer + (j * ctx->width + start) * IPP;
+        i64 count = end - start;
+
+        if (coverage) {
+            for (i64 k = 0; k < count; ++k) {
+                BlendPixel<S, IPP>(
+                    p + k * IPP,
+                    colors[k * 4] * ct[0], colors[k * 4 + 1] * ct[1], colors[k * 4 + 2] * ct[2], colors[k * 4 + 3] * ct[3] * coverage[k]
+                );
+            }
+            return;
+        }
+
+        if (opaque) {
+            for (i64 k = 0; k < count; ++k) {
+                typename S::T* q = p + k * IPP;
+                q[0] = S::Store(colors[k * 4] * ct[0]);
+                q[1] = S::Store(colors[k * 4 + 1] * ct[1]);
+                q[2] = S::Store(colors[k * 4 + 2] * ct[2]);
+                if constexpr (IPP == 4) q[3] = S::Store(1);
+            }
+            return;
+        }
+
+        for (i64 k = 0; k < count; ++k) {
+            BlendPixel<S, IPP>(
+                p + k * IPP,
+                colors[k * 4] * ct[0], colors[k * 4 + 1] * ct[1], colors[k * 4 + 2] * ct[2], colors[k * 4 + 3] * ct[3]
+            );
+        }
+    });
+}
+
+// Color interpolated from c0 to c1 by t, t is p at start and grows by dp per pixel.
+template <typename S> inline void BlendSpanGradient(
+    RenderContext* ctx,
+    i64 j, i64 start, i64 end,
+    const f64 c0[4], const f64 c1[4],
+    f64 p, f64 dp,
+    const f64* coverage = nullptr
+) {
+    if (end <= start) return;
+
+    f64 base[4], delta[4];
+    for (i64 n = 0; n < 4; ++n) {
+        base[n] = c0[n] * ctx->colorTransform[n];
+        delta[n] = (c1[n] - c0[n]) * ctx->colorTransform[n];
+    }
+
+    WithPixelChannels(ctx->enableAlpha, [&](auto c) {
+        constexpr i64 IPP = decltype(c)::value;
+        typename S::T* __restrict q = (typename S::T*)ctx->buffer + (j * ctx->width + start) * IPP;
+        i64 count = end - start;
+
+        for (i64 k = 0; k < count; ++k) {
+            f64 t = p + k * dp;
+            f64 a = base[3] + delta[3] * t;
+            if (coverage) a *= coverage[k];
+            BlendPixel<S, IPP>(q + k * IPP, base[0] + delta[0] * t, base[1] + delta[1] * t, base[2] + delta[2] * t, a);
+        }
+    });
+}
+
+// Splits the coverage of pixels [start, end) (indexed by x) into runs of untouched, partly and fully covered
+// pixels and calls fn(runStart, runEnd, runCoverage) for the covered ones. Fully covered runs get nullptr, so
+// they take the same kernel paths as aliased drawing.
+template <typename Fn> inline void ForEachCoverageRun(const f64* coverage, i64 start, i64 end, Fn fn) {
+    auto kind = [](f64 c) { return c < 1e-9 ? 0 : (c > 1 - 1e-9 ? 2 : 1); };
+
+    for (i64 i = start; i < end;) {
+        i32 runKind = kind(coverage[i]);
+        i64 runEnd = i + 1;
+        while (runEnd < end && kind(coverage[runEnd]) == runKind) ++runEnd;
+
+        if (runKind == 1) fn(i, runEnd, coverage + i);
+        else if (runKind == 2) fn(i, runEnd, (const f64*)nullptr);
+        i = runEnd;
+    }
+}
+
 bool IsNoTransform(f64 matrix[6]) {
-    return matrix[0] - 1 + matrix[1] + matrix[2] + matrix[3] - 1 + matrix[4] + matrix[5] < 1e-5;
+    return (
+        fabs(matrix[0] - 1) < 1e-9 && fabs(matrix[1]) < 1e-9
+        && fabs(matrix[2]) < 1e-9 && fabs(matrix[3] - 1) < 1e-9
+        && fabs(matrix[4]) < 1e-9 && fabs(matrix[5]) < 1e-9
+    );
 }
 
-inline void InterpolateColorFromBuffer(
-    f64 *buffer, i64 width, i64 height, bool enableAlpha,
+template <typename S> inline void InterpolateColorFromBuffer(
+    const void *buffer, i64 width, i64 height, bool enableAlpha,
     f64 x, f64 y,
     f64 *out_r, f64 *out_g, f64 *out_b, f64 *out_a
 ) {
     if (x < 0) x = 0;
-    if (x >= width - 1) x = width - 2;
+    if (x > width - 1) x = width - 1;
     if (y < 0) y = 0;
-    if (y >= height - 1) y = height - 2;
+    if (y > height - 1) y = height - 1;
 
     i64 ipp = enableAlpha ? 4 : 3;
     i64 index = (i64)y * width * ipp + (i64)x * ipp;
-    *out_r = buffer[index + 0];
-    *out_g = buffer[index + 1];
-    *out_b = buffer[index + 2];
+    LoadPixel<S>((const typename S::T*)buffer + index, enableAlpha, out_r, out_g, out_b, out_a);
+}
+
+template <typename S> inline void InterpolateColorFromBufferBilinear(
+    const void *buffer, i64 width, i64 height, bool enableAlpha,
+    f64 x, f64 y,
+    f64 *out_r, f64 *out_g, f64 *out_b, f64 *out_a
+) {
+    // texel k covers [k, k + 1) as in nearest sampling, so its center is at k + 0.5
+    x -= 0.5;
+    y -= 0.5;
+
+    f64 fx = floor(x);
+    f64 fy = floor(y);
+    f64 u = x - fx;
+    f64 v = y - fy;
+
+    // both taps clamp to the edge, outside the texture the border texel repeats
+    i64 ix = std::max(0L, std::min((i64)fx, width - 1));
+    i64 iy = std::max(0L, std::min((i64)fy, height - 1));
+    i64 nx = std::max(0L, std::min((i64)fx + 1, width - 1));
+    i64 ny = std::max(0L, std::min((i64)fy + 1, height - 1));
+
+    i64 ipp = enableAlpha ? 4 : 3;
+    const typename S::T* p = (const typename S::T*)buffer;
+    i64 indices[4] = {
+        iy * width * ipp + ix * ipp,
+        iy * width * ipp + nx * ipp,
+        ny * width * ipp + ix * ipp,
+        ny * width * ipp + nx * ipp,
+    };
+    f64 weights[4] = {(1 - u) * (1 - v), u * (1 - v), (1 - u) * v, u * v};
+
+    // blend premultiplied so transparent texels do not bleed their color
+    f64 r = 0, g = 0, b = 0, a = 0;
+    for (i64 k = 0; k < 4; ++k) {
+        f64 tr, tg, tb, ta = 1;
+        LoadPixel<S>(p + indices[k], enableAlpha, &tr, &tg, &tb, &ta);
+        f64 w = weights[k] * ta;
+        r += tr * w;
+        g += tg * w;
+        b += tb * w;
+        a += w;
+    }
+
+    if (a > 0) {
+        *out_r = r / a;
+        *out_g = g / a;
+        *out_b = b / a;
+    }
+    else {
+        *out_r = *out_g = *out_b = 0;
+    }
 
     if (enableAlpha) {
-        *out_a = buffer[index + 3];
+        *out_a = a;
     }
+}
 
-    // i64 ix = (i64)x;
-    // i64 iy = (i64)y;
-    // i64 nx = ix + 1;
-    // i64 ny = iy + 1;
+template <typename S> inline void SampleTexture(
+    const Texture* tex, bool bilinear,
+    f64 x, f64 y,
+    f64 *out_r, f64 *out_g, f64 *out_b, f64 *out_a
+) {
+    if (bilinear) InterpolateColorFromBufferBilinear<S>(tex->buffer, tex->width, tex->height, tex->enableAlpha, x, y, out_r, out_g, out_b, out_a);
+    else InterpolateColorFromBuffer<S>(tex->buffer, tex->width, tex->height, tex->enableAlpha, x, y, out_r, out_g, out_b, out_a);
+}
 
-    // i64 ipp = enableAlpha ? 4 : 3;
+// 2x2 box filter of src, averaged premultiplied, odd trailing rows and columns fold into the last texel
+static Texture* CreateTextureMipLevel(Texture* src) {
+    Texture* tex = new Texture();
+    CountMemoryObject(MEMORY_KIND_TEXTURE, 1);
+    tex->width = src->width / 2;
+    tex->height = src->height / 2;
+    tex->enableAlpha = src->enableAlpha;
+    tex->pixelFormat = src->pixelFormat;
+    tex->sharedBuffer = false;
+    i64 ipp = tex->enableAlpha ? 4 : 3;
+    tex->buffer = CreatePixelBuffer(tex->pixelFormat, tex->width * tex->height * ipp, MEMORY_KIND_TEXTURE);
 
-    // i64 index0 = iy * width * ipp + ix * ipp;
-    // f64 r0 = buffer[index0 + 0];
-    // f64 g0 = buffer[index0 + 1];
-    // f64 b0 = buffer[index0 + 2];
-    // f64 a0 = enableAlpha ? buffer[index0 + 3] : 1;
+    WithPixelFormat(tex->pixelFormat, [&](auto s) {
+        typedef decltype(s) S;
+        const typename S::T* srcBuffer = (const typename S::T*)src->buffer;
+        typename S::T* dst = (typename S::T*)tex->buffer;
 
-    // i64 index1 = iy * width * ipp + nx * ipp;
-    // f64 r1 = buffer[index1 + 0];
-    // f64 g1 = buffer[index1 + 1];
-    // f64 b1 = buffer[index1 + 2];
-    // f64 a1 = enableAlpha ? buffer[index1 + 3] : 1;
+        ParallelForRows(0, tex->height, tex->width * 4, [&](i64 top, i64 bottom) {
+            for (i64 j = top; j < bottom; ++j) {
+                i64 y0 = j * 2;
+                i64 y1 = j == tex->height - 1 ? src->height : y0 + 2;
+
+                for (i64 i = 0; i < tex->width; ++i) {
+                    i64 x0 = i * 2;
+                    i64 x1 = i == tex->width - 1 ? src->width : x0 + 2;
+
+                    f64 r = 0, g = 0, b = 0, a = 0;
+                    for (i64 sy = y0; sy < y1; ++sy) {
+                        for (i64 sx = x0; sx < x1; ++sx) {
+                            f64 tr, tg, tb, ta = 1;
+                            LoadPixel<S>(srcBuffer + sy * src->width * ipp + sx * ipp, src->enableAlpha, &tr, &tg, &tb, &ta);
+                            r += tr * ta;
+                            g += tg * ta;
+                            b += tb * ta;
+                            a += ta;
+                        }
+                    }
+
+                    f64 n = (y1 - y0) * (x1 - x0);
+                    if (a > 0) StorePixel<S>(dst + j * tex->width * ipp + i * ipp, tex->enableAlpha, r / a, g / a, b / a, a / n);
+                    else StorePixel<S>(dst + j * tex->width * ipp + i * ipp, tex->enableAlpha, 0, 0, 0, 0);
+                }
+            }
+        });
+    });
 
-    // i64 index2 = ny * width * ipp + ix * ipp;
-    // f64 r2 = buffer[index2 + 0];
-    // f64 g2 = buffer[index2 + 1];
-    // f64 b2 = buffer[index2 + 2];
-    // f64 a2 = enableAlpha ? buffer[index2 + 3] : 1;
+    // averages of alpha 1 texels stay 1
+    tex->opaque = src->opaque;
+    return tex;
+}
 
-    // i64 index3 = ny * width * ipp + nx * ipp;
-    // f64 r3 = buffer[index3 + 0];
-    // f64 g3 = buffer[index3 + 1];
-    // f64 b3 = buffer[index3 + 2];
-    // f64 a3 = enableAlpha ? buffer[index3 + 3] : 1;
+// Picks the mip level for texelsPerPixel texels covered by one destination pixel, building the chain up to
+// it on first use. Levels stop before a side drops under 2 texels.
+static Texture* GetTextureMipLevel(Texture* tex, f64 texelsPerPixel) {
+    if (tex->sharedBuffer || !(texelsPerPixel >= 2)) return tex;
 
-    // f64 u = x - ix;
-    // f64 v = y - iy;
+    i64 level = (i64)floor(log2(texelsPerPixel));
 
-    // f64 r = r0 * (1 - u) * (1 - v) + r1 * u * (1 - v) + r2 * (1 - u) * v + r3 * u * v;
-    // f64 g = g0 * (1 - u) * (1 - v) + g1 * u * (1 - v) + g2 * (1 - u) * v + g3 * u * v;
-    // f64 b = b0 * (1 - u) * (1 - v) + b1 * u * (1 - v) + b2 * (1 - u) * v + b3 * u * v;
+    std::lock_guard<std::mutex> lock(tex->mipmapMutex);
+    while ((i64)tex->mipmaps.size() < level) {
+        Texture* last = tex->mipmaps.empty() ? tex : tex->mipmaps.back();
+        if (last->width < 4 || last->height < 4) break;
+        tex->mipmaps.push_back(CreateTextureMipLevel(last));
+    }
 
-    // *out_r = r;
-    // *out_g = g;
-    // *out_b = b;
+    if (tex->mipmaps.empty()) return tex;
+    return tex->mipmaps[std::min(level, (i64)tex->mipmaps.size()) - 1];
+}
 
-    // if (enableAlpha) {
-    //     f64 a = a0 * (1 - u) * (1 - v) + a1 * u * (1 - v) + a2 * (1 - u) * v + a3 * u * v;
-    //     *out_a = a;
-    // }
+// texels of the source walked per destination pixel step, the larger of the two screen axes
+inline f64 GetTextureFootprint(RenderContext* ctx, f64 scaleX, f64 scaleY) {
+    f64 inv[6];
+    GetInverseTransform(ctx, inv);
+
+    f64 stepX = sqrt(inv[0] * scaleX * inv[0] * scaleX + inv[1] * scaleY * inv[1] * scaleY);
+    f64 stepY = sqrt(inv[2] * scaleX * inv[2] * scaleX + inv[3] * scaleY * inv[3] * scaleY);
+    return std::max(stepX, stepY);
 }
 
 void SetColorTransform(
@@ -640,20 +1759,82 @@ void ApplyColorTransform(
     ctx->colorTransform[3] *= a;
 }
 
+// Switches primitives between the binary sample point test and analytic edge coverage folded into alpha.
+void SetAntiAlias(RenderContext* ctx, bool enabled) {
+    ctx->antiAlias = enabled;
+}
+
 void SetColor(
     RenderContext* ctx,
     f64 r, f64 g, f64 b, f64 a
 ) {
-    if (r == g && g == b && b == a) {
-        std::fill(ctx->buffer, ctx->buffer + ctx->width * ctx->height * (ctx->enableAlpha ? 4 : 3), r);
+    WithPixelFormat(ctx->pixelFormat, [&](auto cs) {
+        typedef decltype(cs) CS;
+        typename CS::T* buffer = (typename CS::T*)ctx->buffer;
+
+        // premultiplying only keeps every channel equal when alpha is 0 or 1
+        bool uniform = r == g && g == b && b == a && (!CS::premultiplied || !ctx->enableAlpha || a == 0 || a == 1);
+
+        if (uniform) {
+            i64 rowSize = ctx->width * (ctx->enableAlpha ? 4 : 3);
+            ParallelForRows(0, ctx->height, ctx->width, [&](i64 top, i64 bottom) {
+                std::fill(buffer + top * rowSize, buffer + bottom * rowSize, CS::Store(r));
+            });
+            return;
+        }
+
+        // every pixel gets the same stored value, so it is encoded once and repeated along each row
+        typename CS::T pixel[4];
+        StorePixel<CS>(pixel, ctx->enableAlpha, r, g, b, a);
+
+        WithPixelChannels(ctx->enableAlpha, [&](auto c) {
+            constexpr i64 IPP = decltype(c)::value;
+            ParallelForRows(0, ctx->height, ctx->width, [&](i64 top, i64 bottom) {
+                typename CS::T* p = buffer + top * ctx->width * IPP;
+                for (i64 k = 0; k < (bottom - top) * ctx->width; ++k) {
+                    for (i64 n = 0; n < IPP; ++n) p[k * IPP + n] = pixel[n];
+                }
+            });
+        });
+    });
+}
+
+// Copies layer over ctx, ignoring transforms and blending, across the area both share from the top left.
+// A layer in the same pixel format is copied row by row with memcpy.
+void BlitLayer(RenderContext* ctx, RenderContext* layer) {
+    i64 width = std::min(ctx->width, layer->width);
+    i64 height = std::min(ctx->height, layer->height);
+    if (width <= 0 || height <= 0) return;
+
+    if (ctx->pixelFormat == layer->pixelFormat && ctx->enableAlpha == layer->enableAlpha) {
+        i64 pixelBytes = (ctx->enableAlpha ? 4 : 3) * GetPixelFormatSize(ctx->pixelFormat);
+        ParallelForRows(0, height, width, [&](i64 top, i64 bottom) {
+            for (i64 j = top; j < bottom; ++j) {
+                memcpy((iu8*)ctx->buffer + j * ctx->width * pixelBytes, (const iu8*)layer->buffer + j * layer->width * pixelBytes, width * pixelBytes);
+            }
+        });
         return;
     }
 
-    for (i64 i = 0; i < ctx->width; ++i) {
-        for (i64 j = 0; j < ctx->height; ++j) {
-            SetPixel(ctx, i, j, r, g, b, a);
-        }
-    }
+    WithPixelFormats(ctx->pixelFormat, layer->pixelFormat, [&](auto cs, auto ls) {
+        typedef decltype(cs) CS;
+        typedef decltype(ls) LS;
+        i64 ctxIpp = ctx->enableAlpha ? 4 : 3;
+        i64 layerIpp = layer->enableAlpha ? 4 : 3;
+
+        ParallelForRows(0, height, width, [&](i64 top, i64 bottom) {
+            for (i64 j = top; j < bottom; ++j) {
+                typename CS::T* dst = (typename CS::T*)ctx->buffer + j * ctx->width * ctxIpp;
+                const typename LS::T* src = (const typename LS::T*)layer->buffer + j * layer->width * layerIpp;
+
+                for (i64 i = 0; i < width; ++i, dst += ctxIpp, src += layerIpp) {
+                    f64 r, g, b, a = 1;
+                    LoadPixel<LS>(src, layer->enableAlpha, &r, &g, &b, &a);
+                    StorePixel<CS>(dst, ctx->enableAlpha, r, g, b, a);
+                }
+            }
+        });
+    });
 }
 
 void GetColor(
@@ -672,22 +1853,25 @@ void GetColor(
     i64 ipp = ctx->enableAlpha ? 4 : 3;
     i64 index = iy * ctx->width * ipp + ix * ipp;
     
-    *out_r = ctx->buffer[index + 0];
-    *out_g = ctx->buffer[index + 1];
-    *out_b = ctx->buffer[index + 2];
-
-    if (ctx->enableAlpha) *out_a = ctx->buffer[index + 3];
+    WithPixelFormat(ctx->pixelFormat, [&](auto cs) {
+        typedef decltype(cs) CS;
+        LoadPixel<CS>((const typename CS::T*)ctx->buffer + index, ctx->enableAlpha, out_r, out_g, out_b, out_a);
+    });
 }
 
 void FillColor(
     RenderContext* ctx,
     f64 r, f64 g, f64 b, f64 a
 ) {
-    for (i64 i = 0; i < ctx->width; ++i) {
-        for (i64 j = 0; j < ctx->height; ++j) {
-            ApplyPixel(ctx, i, j, r, g, b, a);
-        }
-    }
+    WithPixelFormat(ctx->pixelFormat, [&](auto cs) {
+        typedef decltype(cs) CS;
+
+        ParallelForRows(0, ctx->height, ctx->width, [&](i64 top, i64 bottom) {
+            for (i64 j = top; j < bottom; ++j) {
+                BlendSpanSolid<CS>(ctx, j, 0, ctx->width, r, g, b, a);
+            }
+        });
+    });
 }
 
 inline void GetBoarder(
@@ -717,131 +1901,816 @@ inline void GetBoarder(
     *out_bottom = std::max(0L, std::min((i64)max_height, *out_bottom));
 }
 
+// Rows of a transformed rect, each row is reduced to the span whose inverse-mapped points land inside
+// [x, x + width] x [y, y + height] so draws only visit covered pixels.
+struct QuadSpans {
+    f64 inv[6];
+    f64 x, y, width, height;
+    i64 left, right, top, bottom;
+};
+
+inline void SetupQuadSpans(
+    RenderContext* ctx,
+    f64 x, f64 y, f64 width, f64 height,
+    QuadSpans* spans
+) {
+    GetInverseTransform(ctx, spans->inv);
+    GetBoarder(ctx->transformMatrix, x, y, width, height, &spans->left, &spans->right, &spans->top, &spans->bottom, ctx->width, ctx->height);
+
+    spans->x = x;
+    spans->y = y;
+    spans->width = width;
+    spans->height = height;
+}
+
+inline bool InsideQuadSpans(const QuadSpans* spans, f64 invX, f64 invY) {
+    return invX >= spans->x && invX <= spans->x + spans->width && invY >= spans->y && invY <= spans->y + spans->height;
+}
+
+// narrows [start, end) to the i where lo <= a * i + b <= hi
+inline void ClipLinearSpan(f64 a, f64 b, f64 lo, f64 hi, f64* start, f64* end) {
+    if (a == 0) {
+        if (b < lo || b > hi) *end = *start;
+        return;
+    }
+
+    f64 i0 = (lo - b) / a;
+    f64 i1 = (hi - b) / a;
+    if (a < 0) std::swap(i0, i1);
+
+    *start = std::max(*start, ceil(i0));
+    *end = std::min(*end, floor(i1) + 1);
+}
+
+// Gets the covered span [out_start, out_end) of row j and the inverse-mapped point of its first pixel,
+// moving one pixel right advances that point by (inv[0], inv[1]).
+inline bool GetQuadSpan(
+    const QuadSpans* spans, i64 j,
+    i64* out_start, i64* out_end,
+    f64* out_invX, f64* out_invY
+) {
+    const f64* inv = spans->inv;
+    f64 rowX = inv[2] * j + inv[4];
+    f64 rowY = inv[3] * j + inv[5];
+
+    f64 start = spans->left, end = spans->right;
+    ClipLinearSpan(inv[0], rowX, spans->x, spans->x + spans->width, &start, &end);
+    ClipLinearSpan(inv[1], rowY, spans->y, spans->y + spans->height, &start, &end);
+    if (start >= end) return false;
+
+    // settle the rounding at both ends with the exact per-pixel test
+    i64 s = (i64)start, e = (i64)end;
+    auto inside = [&](i64 i) { return InsideQuadSpans(spans, inv[0] * i + rowX, inv[1] * i + rowY); };
+    while (s < e && !inside(s)) ++s;
+    while (s > spans->left && inside(s - 1)) --s;
+    while (e > s && !inside(e - 1)) --e;
+    while (e < spans->right && inside(e)) ++e;
+    if (s >= e) return false;
+
+    *out_start = s;
+    *out_end = e;
+    *out_invX = inv[0] * s + rowX;
+    *out_invY = inv[1] * s + rowY;
+    return true;
+}
+
+struct PolygonEdge {
+    i64 top;
+    i64 bottom;
+    f64 x;
+    f64 y;
+    f64 yEnd;
+    f64 slope;
+    i32 winding;
+};
+
+// Builds the edge table of one closed contour in device space, points are interleaved x, y in user space.
+// Only rows inside the context are kept, an edge covers row j when min(y0, y1) <= j < max(y0, y1), or with
+// anti-aliasing when it crosses the pixel row [j, j + 1) at all.
+static void AddPolygonEdges(
+    RenderContext* ctx,
+    const f64* points, i64 numPoints,
+    bool positiveWinding,
+    std::vector<PolygonEdge>& edges
+) {
+    if (numPoints < 3) return;
+
+    f64 area = 0;
+    for (i64 i = 0; i < numPoints; ++i) {
+        i64 n = (i + 1) % numPoints;
+        area += points[i * 2] * points[n * 2 + 1] - points[n * 2] * points[i * 2 + 1];
+    }
+    i32 flip = positiveWinding && area < 0 ? -1 : 1;
+
+    for (i64 i = 0; i < numPoints; ++i) {
+        i64 n = (i + 1) % numPoints;
+
+        f64 x0, y0, x1, y1;
+        TransformPointFromMatrix(ctx->transformMatrix, points[i * 2], points[i * 2 + 1], &x0, &y0);
+        TransformPointFromMatrix(ctx->transformMatrix, points[n * 2], points[n * 2 + 1], &x1, &y1);
+
+        if (y0 == y1) continue;
+
+        PolygonEdge edge;
+        edge.winding = (y1 > y0 ? 1 : -1) * flip;
+        if (y0 > y1) {
+            std::swap(x0, x1);
+            std::swap(y0, y1);
+        }
+
+        edge.top = std::max(0L, (i64)(ctx->antiAlias ? floor(y0) : ceil(y0)));
+        edge.bottom = std::min(ctx->height, (i64)ceil(y1));
+        if (edge.top >= edge.bottom) continue;
+
+        edge.x = x0;
+        edge.y = y0;
+        edge.yEnd = y1;
+        edge.slope = (x1 - x0) / (y1 - y0);
+        edges.push_back(edge);
+    }
+}
+
+// Adds a segment lying inside one pixel row to the row's accumulation cells: every cell gets the signed area
+// the segment leaves right of it inside that cell, so the running sum along the row is the winding weighted
+// coverage of each pixel. d is the signed height of the segment, only its x range matters.
+// The part left of the context folds into cell 0 and the part right of it touches no visible pixel.
+static inline void AccumulateCoverageSegment(
+    f64* cells, i64 width,
+    f64 x0, f64 x1, f64 d,
+    i64* minCell, i64* maxCell
+) {
+    f64 l = std::min(x0, x1), r = std::max(x0, x1);
+    if (l >= width) return;
+
+    if (r <= 0) {
+        cells[0] += d;
+        *minCell = 0;
+        *maxCell = std::max(*maxCell, 1L);
+        return;
+    }
+
+    if (r > l) {
+        f64 dPerX = d / (r - l);
+        if (l < 0) {
+            cells[0] += dPerX * -l;
+            l = 0;
+        }
+        r = std::min(r, (f64)width);
+        d = dPerX * (r - l);
+    }
+
+    i64 l0 = (i64)l;
+    i64 r1 = (i64)ceil(r);
+    *minCell = std::min(*minCell, l0);
+    *maxCell = std::max(*maxCell, std::max(l0, r1) + 2);
+
+    if (r1 <= l0 + 1) {
+        // within one cell the area right of the segment splits by its mid x
+        f64 mid = 0.5 * (l + r) - l0;
+        cells[l0] += d - d * mid;
+        cells[l0 + 1] += d * mid;
+        return;
+    }
+
+    // triangles in the first and last cell, a constant share per cell in between
+    f64 s = 1 / (r - l);
+    f64 lf = l - l0;
+    f64 first = 0.5 * s * (1 - lf) * (1 - lf);
+    f64 rf = r - r1 + 1;
+    f64 last = 0.5 * s * rf * rf;
+
+    cells[l0] += d * first;
+    if (r1 == l0 + 2) {
+        cells[l0 + 1] += d * (1 - first - last);
+    }
+    else {
+        f64 second = s * (1.5 - lf);
+        cells[l0 + 1] += d * (second - first);
+        for (i64 i = l0 + 2; i < r1 - 1; ++i) cells[i] += d * s;
+        f64 beforeLast = second + (r1 - l0 - 3) * s;
+        cells[r1 - 1] += d * (1 - beforeLast - last);
+    }
+    cells[r1] += d * last;
+}
+
+// Anti-aliased scanline state of one row band, pixel (i, j) is the square [i, i + 1) x [j, j + 1) and its
+// coverage is the exact area of it inside the contours (non-zero clamps the winding, even-odd folds it).
+struct CoverageRows {
+    const std::vector<PolygonEdge>* edges;
+    bool nonZero;
+    i64 width;
+
+    std::vector<const PolygonEdge*> active;
+    size_t next;
+    std::vector<f64> cells;
+    std::vector<f64> coverage;
+};
+
+inline void SetupCoverageRows(
+    RenderContext* ctx,
+    const std::vector<PolygonEdge>& edges,
+    bool nonZero,
+    CoverageRows* rows
+) {
+    rows->edges = &edges;
+    rows->nonZero = nonZero;
+    rows->width = ctx->width;
+    rows->next = 0;
+    rows->cells.assign(ctx->width + 2, 0);
+    rows->coverage.assign(ctx->width, 0);
+}
+
+// Fills rows->coverage (indexed by x) over [start, end) for row j, rows must be asked in increasing order
+// and the edges sorted by top. Pixels in the range may still have zero coverage.
+inline bool GetCoverageRow(CoverageRows* rows, i64 j, i64* out_start, i64* out_end) {
+    const std::vector<PolygonEdge>& edges = *rows->edges;
+    while (rows->next < edges.size() && edges[rows->next].top <= j) {
+        if (edges[rows->next].bottom > j) rows->active.push_back(&edges[rows->next]);
+        ++rows->next;
+    }
+    rows->active.erase(
+        std::remove_if(rows->active.begin(), rows->active.end(), [&](const PolygonEdge* edge) { return edge->bottom <= j; }),
+        rows->active.end()
+    );
+    if (rows->active.empty()) return false;
+
+    f64* cells = rows->cells.data();
+    i64 minCell = rows->width, maxCell = 0;
+    for (const PolygonEdge* edge : rows->active) {
+        f64 y0 = std::max(edge->y, (f64)j);
+        f64 y1 = std::min(edge->yEnd, (f64)(j + 1));
+        if (y0 >= y1) continue;
+
+        f64 x0 = edge->x + (y0 - edge->y) * edge->slope;
+        f64 x1 = edge->x + (y1 - edge->y) * edge->slope;
+        AccumulateCoverageSegment(cells, rows->width, x0, x1, (y1 - y0) * edge->winding, &minCell, &maxCell);
+    }
+    if (minCell >= rows->width) {
+        std::fill(cells, cells + std::min(maxCell, rows->width + 2), 0);
+        return false;
+    }
+    maxCell = std::min(maxCell, rows->width + 2);
+
+    // past the last touched cell the sum stays constant, either nothing or a run clipped by the right side
+    f64 sum = 0;
+    i64 end = minCell;
+    for (i64 i = minCell; i < rows->width; ++i) {
+        sum += cells[i];
+        if (i >= maxCell && fabs(sum) < 1e-9) break;
+
+        f64 winding = fabs(sum);
+        if (rows->nonZero) rows->coverage[i] = std::min(1.0, winding);
+        else {
+            f64 folded = fmod(winding, 2);
+            rows->coverage[i] = folded > 1 ? 2 - folded : folded;
+        }
+        end = i + 1;
+    }
+    std::fill(cells + minCell, cells + maxCell, 0);
+
+    *out_start = minCell;
+    *out_end = end;
+    return end > minCell;
+}
+
+// Row range and widest row of an edge table, for banding.
+static void GetPolygonEdgesBounds(
+    RenderContext* ctx,
+    const std::vector<PolygonEdge>& edges,
+    i64* out_top, i64* out_bottom, i64* out_pixelsPerRow
+) {
+    i64 top = ctx->height, bottom = 0;
+    f64 minX = ctx->width, maxX = 0;
+    for (const PolygonEdge& edge : edges) {
+        top = std::min(top, edge.top);
+        bottom = std::max(bottom, edge.bottom);
+
+        f64 xTop = edge.x + (std::max((f64)edge.top, edge.y) - edge.y) * edge.slope;
+        f64 xBottom = edge.x + (std::min((f64)edge.bottom, edge.yEnd) - edge.y) * edge.slope;
+        minX = std::min(minX, std::min(xTop, xBottom));
+        maxX = std::max(maxX, std::max(xTop, xBottom));
+    }
+
+    *out_top = top;
+    *out_bottom = bottom;
+    *out_pixelsPerRow = std::max(0L, std::min(ctx->width, (i64)ceil(maxX)) - std::max(0L, (i64)minX));
+}
+
+// Anti-aliased counterpart of the QuadSpans loop, calls fn(j, start, end, coverage, scratch) for every partly
+// or fully covered run of the transformed rect, coverage is nullptr on fully covered runs. scratch is a
+// buffer of the caller's that lives as long as the row band.
+template <typename Fn> inline void ForEachQuadCoverageRun(
+    RenderContext* ctx,
+    f64 x, f64 y, f64 width, f64 height,
+    Fn fn
+) {
+    f64 points[] = {x, y, x + width, y, x + width, y + height, x, y + height};
+    std::vector<PolygonEdge> edges;
+    AddPolygonEdges(ctx, points, 4, false, edges);
+    if (edges.empty()) return;
+
+    std::sort(edges.begin(), edges.end(), [](const PolygonEdge& e0, const PolygonEdge& e1) { return e0.top < e1.top; });
+
+    i64 top, bottom, pixelsPerRow;
+    GetPolygonEdgesBounds(ctx, edges, &top, &bottom, &pixelsPerRow);
+
+    ParallelForRows(top, bottom, pixelsPerRow, [&](i64 bandTop, i64 bandBottom) {
+        CoverageRows rows;
+        SetupCoverageRows(ctx, edges, true, &rows);
+        std::vector<f64> scratch;
+
+        for (i64 j = bandTop; j < bandBottom; ++j) {
+            i64 start, end;
+            if (!GetCoverageRow(&rows, j, &start, &end)) continue;
+
+            ForEachCoverageRun(rows.coverage.data(), start, end, [&](i64 runStart, i64 runEnd, const f64* coverage) {
+                fn(j, runStart, runEnd, coverage, scratch);
+            });
+        }
+    });
+}
+
 void DrawTexture(
     RenderContext* ctx,
     Texture* tex,
     f64 x, f64 y,
-    f64 width, f64 height
+    f64 width, f64 height,
+    i32 filter
 ) {
     if (width == 0 || height == 0) return;
 
-    f64 scaleX = tex->width / width;
-    f64 scaleY = tex->height / height;
+    Texture* src = tex;
+    if (filter & TEXTURE_FILTER_MIPMAP) src = GetTextureMipLevel(tex, GetTextureFootprint(ctx, tex->width / width, tex->height / height));
+    bool bilinear = filter & TEXTURE_FILTER_BILINEAR;
 
-    if (IsNoTransform(ctx->transformMatrix)) {
-        i64 ix = std::max(0L, std::min(ctx->width - 1, (i64)x));
-        i64 iy = std::max(0L, std::min(ctx->height - 1, (i64)y));
-        i64 iwidth = std::max(0L, std::min(ctx->width - (i64)x, (i64)x + (i64)width)) - x;
-        i64 iheight = std::max(0L, std::min(ctx->height - (i64)y, (i64)y + (i64)height)) - y;
+    f64 scaleX = src->width / width;
+    f64 scaleY = src->height / height;
+    bool opaque = src->opaque && ctx->colorTransform[3] == 1;
 
-        if (tex->enableAlpha == ctx->enableAlpha && iwidth == tex->width && iheight == tex->height && false) {
-            
+    // pixel aligned untransformed draws cover whole pixels, anti-aliasing changes nothing there
+    bool untransformed = IsNoTransform(ctx->transformMatrix);
+    bool aligned = x == floor(x) && y == floor(y) && x + width == floor(x + width) && y + height == floor(y + height);
+
+    WithPixelFormats(ctx->pixelFormat, src->pixelFormat, [&](auto cs, auto ts) {
+        typedef decltype(cs) CS;
+        typedef decltype(ts) TS;
+
+        if (ctx->antiAlias && !(untransformed && aligned)) {
+            f64 inv[6];
+            GetInverseTransform(ctx, inv);
+
+            ForEachQuadCoverageRun(ctx, x, y, width, height, [&](i64 j, i64 start, i64 end, const f64* coverage, std::vector<f64>& colors) {
+                colors.resize((end - start) * 4);
+                for (i64 i = start; i < end; ++i) {
+                    f64 invX, invY;
+                    TransformPointFromMatrix(inv, i, j, &invX, &invY);
+
+                    f64* c = &colors[(i - start) * 4];
+                    c[3] = 1;
+                    SampleTexture<TS>(src, bilinear, (invX - x) * scaleX, (invY - y) * scaleY, c, c + 1, c + 2, c + 3);
+                }
+                BlendSpanTextured<CS>(ctx, j, start, end, colors.data(), opaque, coverage);
+            });
         }
-        else {
-            for (i64 i = x; i < x + width; ++i) {
-                for (i64 j = y; j < y + height; ++j) {
-                    f64 u = (i - x) * scaleX;
-                    f64 v = (j - y) * scaleY;
-
-                    f64 r, g, b, a;
-                    InterpolateColorFromBuffer(tex->buffer, tex->width, tex->height, tex->enableAlpha, u, v, &r, &g, &b, &a);
-                    ApplyPixel(ctx, i, j, r, g, b, a);
+        else if (untransformed) {
+            // same pixels the unclipped (i64)x .. x + width loop would reach inside the context
+            i64 left = std::max(0L, (i64)x);
+            i64 right = std::min(ctx->width, (i64)ceil(x + width));
+            i64 top = std::max(0L, (i64)y);
+            i64 bottom = std::min(ctx->height, (i64)ceil(y + height));
+            if (right <= left || bottom <= top) return;
+
+            // at 1:1 on whole pixels every destination pixel lands on a texel, so the filter does not matter
+            bool unscaled = x == floor(x) && y == floor(y) && width == src->width && height == src->height;
+
+            if constexpr (std::is_same<CS, TS>::value) {
+                const f64* ct = ctx->colorTransform;
+                if (unscaled && opaque && src->enableAlpha == ctx->enableAlpha && ct[0] == 1 && ct[1] == 1 && ct[2] == 1) {
+                    i64 ipp = ctx->enableAlpha ? 4 : 3;
+                    ParallelForRows(top, bottom, right - left, [&](i64 bandTop, i64 bandBottom) {
+                        for (i64 j = bandTop; j < bandBottom; ++j) {
+                            memcpy(
+                                (typename CS::T*)ctx->buffer + (j * ctx->width + left) * ipp,
+                                (const typename TS::T*)src->buffer + ((j - (i64)y) * src->width + left - (i64)x) * ipp,
+                                (right - left) * ipp * sizeof(typename CS::T)
+                            );
+                        }
+                    });
+                    return;
                 }
             }
+
+            if (bilinear && !unscaled) {
+                ParallelForRows(top, bottom, right - left, [&](i64 bandTop, i64 bandBottom) {
+                    std::vector<f64> colors((right - left) * 4, 1);
+                    for (i64 j = bandTop; j < bandBottom; ++j) {
+                        f64 v = (j - y) * scaleY;
+                        for (i64 i = left; i < right; ++i) {
+                            f64* c = &colors[(i - left) * 4];
+                            SampleTexture<TS>(src, bilinear, (i - x) * scaleX, v, c, c + 1, c + 2, c + 3);
+                        }
+                        BlendSpanTextured<CS>(ctx, j, left, right, colors.data(), opaque);
+                    }
+                });
+                return;
+            }
+
+            // nearest sampling along an axis only depends on that axis, so texel offsets are computed once per column
+            i64 tipp = src->enableAlpha ? 4 : 3;
+            std::vector<i64> columns(right - left);
+            for (i64 i = left; i < right; ++i) {
+                f64 u = std::max(0.0, std::min((f64)(src->width - 1), (i - x) * scaleX));
+                columns[i - left] = (i64)u * tipp;
+            }
+
+            ParallelForRows(top, bottom, right - left, [&](i64 bandTop, i64 bandBottom) {
+                std::vector<f64> colors((right - left) * 4, 1);
+                for (i64 j = bandTop; j < bandBottom; ++j) {
+                    f64 v = std::max(0.0, std::min((f64)(src->height - 1), (j - y) * scaleY));
+                    const typename TS::T* srcRow = (const typename TS::T*)src->buffer + (i64)v * src->width * tipp;
+
+                    for (i64 i = left; i < right; ++i) {
+                        f64* c = &colors[(i - left) * 4];
+                        LoadPixel<TS>(srcRow + columns[i - left], src->enableAlpha, c, c + 1, c + 2, c + 3);
+                    }
+                    BlendSpanTextured<CS>(ctx, j, left, right, colors.data(), opaque);
+                }
+            });
         }
-    }
-    else {
-        f64 inv[6];
-        GetInverseTransform(ctx, inv);
+        else {
+            QuadSpans spans;
+            SetupQuadSpans(ctx, x, y, width, height, &spans);
+
+            f64 du = spans.inv[0] * scaleX;
+            f64 dv = spans.inv[1] * scaleY;
+
+            ParallelForRows(spans.top, spans.bottom, spans.right - spans.left, [&](i64 bandTop, i64 bandBottom) {
+                std::vector<f64> colors((spans.right - spans.left) * 4, 1);
+                for (i64 j = bandTop; j < bandBottom; ++j) {
+                    i64 start, end;
+                    f64 invX, invY;
+                    if (!GetQuadSpan(&spans, j, &start, &end, &invX, &invY)) continue;
+
+                    f64 u = (invX - x) * scaleX;
+                    f64 v = (invY - y) * scaleY;
+
+                    for (i64 i = start; i < end; ++i, u += du, v += dv) {
+                        f64* c = &colors[(i - start) * 4];
+                        SampleTexture<TS>(src, bilinear, u, v, c, c + 1, c + 2, c + 3);
+                    }
+                    BlendSpanTextured<CS>(ctx, j, start, end, colors.data(), opaque);
+                }
+            });
+        }
+    });
+}
 
-        i64 left, right, top, bottom;
-        GetBoarder(ctx->transformMatrix, x, y, width, height, &left, &right, &top, &bottom, ctx->width, ctx->height);
+void DrawSplittedTexture(
+    RenderContext* ctx,
+    Texture* tex,
+    f64 x, f64 y,
+    f64 width, f64 height,
+    f64 uStart, f64 uEnd,
+    f64 vStart, f64 vEnd,
+    i32 filter
+) {
+    if (width == 0 || height == 0) return;
 
-        for (i64 i = left; i < right; ++i) {
-            for (i64 j = top; j < bottom; ++j) {
+    Texture* src = tex;
+    if (filter & TEXTURE_FILTER_MIPMAP) src = GetTextureMipLevel(tex, GetTextureFootprint(ctx, tex->width / width * fabs(uEnd - uStart), tex->height / height * fabs(vEnd - vStart)));
+    bool bilinear = filter & TEXTURE_FILTER_BILINEAR;
+
+    f64 scaleX = src->width / width;
+    f64 scaleY = src->height / height;
+
+    QuadSpans spans;
+    SetupQuadSpans(ctx, x, y, width, height, &spans);
+
+    // the sub-rect mapping is affine too, so it folds into the per-pixel increments
+    f64 du = spans.inv[0] * scaleX * (uEnd - uStart);
+    f64 dv = spans.inv[1] * scaleY * (vEnd - vStart);
+    bool opaque = src->opaque && ctx->colorTransform[3] == 1;
+
+    WithPixelFormats(ctx->pixelFormat, src->pixelFormat, [&](auto cs, auto ts) {
+        typedef decltype(cs) CS;
+        typedef decltype(ts) TS;
+
+        if (ctx->antiAlias) {
+            ForEachQuadCoverageRun(ctx, x, y, width, height, [&](i64 j, i64 start, i64 end, const f64* coverage, std::vector<f64>& colors) {
                 f64 invX, invY;
-                TransformPointFromMatrix(inv, i, j, &invX, &invY);
+                TransformPointFromMatrix(spans.inv, start, j, &invX, &invY);
+
+                f64 u = (uStart + (uEnd - uStart) * (invX - x) * scaleX / src->width) * src->width;
+                f64 v = (vStart + (vEnd - vStart) * (invY - y) * scaleY / src->height) * src->height;
 
-                if (invX < x) continue;
-                if (invX > x + width) continue;
-                if (invY < y) continue;
-                if (invY > y + height) continue;
+                colors.resize((end - start) * 4);
+                for (i64 i = start; i < end; ++i, u += du, v += dv) {
+                    f64* c = &colors[(i - start) * 4];
+                    c[3] = 1;
+                    SampleTexture<TS>(src, bilinear, u, v, c, c + 1, c + 2, c + 3);
+                }
+                BlendSpanTextured<CS>(ctx, j, start, end, colors.data(), opaque, coverage);
+            });
+            return;
+        }
+
+        ParallelForRows(spans.top, spans.bottom, spans.right - spans.left, [&](i64 bandTop, i64 bandBottom) {
+            std::vector<f64> colors((spans.right - spans.left) * 4, 1);
+            for (i64 j = bandTop; j < bandBottom; ++j) {
+                i64 start, end;
+                f64 invX, invY;
+                if (!GetQuadSpan(&spans, j, &start, &end, &invX, &invY)) continue;
 
                 f64 u = (invX - x) * scaleX;
                 f64 v = (invY - y) * scaleY;
 
-                f64 r, g, b, a;
-                InterpolateColorFromBuffer(tex->buffer, tex->width, tex->height, tex->enableAlpha, u, v, &r, &g, &b, &a);
-                ApplyPixel(ctx, i, j, r, g, b, a);
+                u = (uStart + (uEnd - uStart) * u / src->width) * src->width;
+                v = (vStart + (vEnd - vStart) * v / src->height) * src->height;
+
+                for (i64 i = start; i < end; ++i, u += du, v += dv) {
+                    f64* c = &colors[(i - start) * 4];
+                    SampleTexture<TS>(src, bilinear, u, v, c, c + 1, c + 2, c + 3);
+                }
+                BlendSpanTextured<CS>(ctx, j, start, end, colors.data(), opaque);
             }
-        }
+        });
+    });
+}
+
+// Draws count sprites of one texture. Each sprite is SPRITE_BATCH_STRIDE packed f64: a transform a, b, c, d,
+// e, f applied on top of the context's, the rect x, y, width, height under it, the texture sub-rect uStart,
+// uEnd, vStart, vEnd as for DrawSplittedTexture and a tint r, g, b, a multiplied into the color transform.
+// The context's own transform and color transform are left as they were.
+void DrawSpriteBatch(
+    RenderContext* ctx,
+    Texture* tex,
+    f64* sprites, i64 count,
+    i32 filter
+) {
+    f64 matrix[6], colorTransform[4];
+    memcpy(matrix, ctx->transformMatrix, sizeof(matrix));
+    memcpy(colorTransform, ctx->colorTransform, sizeof(colorTransform));
+
+    for (i64 k = 0; k < count; ++k) {
+        const f64* s = sprites + k * SPRITE_BATCH_STRIDE;
+        if (s[17] * colorTransform[3] == 0) continue;
+
+        ApplyTransform(ctx, s[0], s[1], s[2], s[3], s[4], s[5]);
+        ApplyColorTransform(ctx, s[14], s[15], s[16], s[17]);
+        DrawSplittedTexture(ctx, tex, s[6], s[7], s[8], s[9], s[10], s[11], s[12], s[13], filter);
+
+        memcpy(ctx->transformMatrix, matrix, sizeof(matrix));
+        memcpy(ctx->colorTransform, colorTransform, sizeof(colorTransform));
     }
 }
 
-void DrawSplittedTexture(
+// Texel coordinate of the position p along a sliced axis of length size whose ends dst0 and dst1 long show
+// the first src0 and the last src1 of texSize texels unscaled in texture space, the middle stretches. Ends
+// that do not fit in size shrink together.
+inline f64 MapSliceCoordinate(f64 p, f64 size, f64 dst0, f64 dst1, f64 src0, f64 src1, f64 texSize) {
+    if (dst0 + dst1 > size) {
+        f64 shrink = size / (dst0 + dst1);
+        dst0 *= shrink;
+        dst1 *= shrink;
+    }
+
+    if (p < dst0) return p / dst0 * src0;
+    if (p > size - dst1) return texSize - (size - p) / dst1 * src1;
+
+    f64 middle = size - dst0 - dst1;
+    return middle > 0 ? src0 + (p - dst0) / middle * (texSize - src0 - src1) : src0;
+}
+
+// Draws tex stretched over the rect (x, y, width, height) as a nine-slice: the borders srcLeft, srcTop,
+// srcRight and srcBottom texels wide are drawn dstLeft, dstTop, dstRight and dstBottom wide in user space,
+// the edges stretch along one axis and the centre along both. Zero top and bottom make it a horizontal
+// three-slice. The whole rect is one quad, so slices cannot leave seams between them.
+void DrawNineSliceTexture(
     RenderContext* ctx,
     Texture* tex,
     f64 x, f64 y,
     f64 width, f64 height,
-    f64 uStart, f64 uEnd,
-    f64 vStart, f64 vEnd
+    f64 srcLeft, f64 srcTop, f64 srcRight, f64 srcBottom,
+    f64 dstLeft, f64 dstTop, f64 dstRight, f64 dstBottom,
+    i32 filter
 ) {
-    if (width == 0 || height == 0) return;
+    if (width <= 0 || height <= 0) return;
+
+    Texture* src = tex;
+    if (filter & TEXTURE_FILTER_MIPMAP) src = GetTextureMipLevel(tex, GetTextureFootprint(ctx, tex->width / width, tex->height / height));
+    bool bilinear = filter & TEXTURE_FILTER_BILINEAR;
+
+    // borders are given in texels of the full size texture
+    f64 levelX = (f64)src->width / tex->width;
+    f64 levelY = (f64)src->height / tex->height;
+    srcLeft *= levelX;
+    srcRight *= levelX;
+    srcTop *= levelY;
+    srcBottom *= levelY;
+
+    bool opaque = src->opaque && ctx->colorTransform[3] == 1;
 
     f64 inv[6];
     GetInverseTransform(ctx, inv);
-    f64 scaleX = tex->width / width;
-    f64 scaleY = tex->height / height;
 
-    i64 left, right, top, bottom;
-    GetBoarder(ctx->transformMatrix, x, y, width, height, &left, &right, &top, &bottom, ctx->width, ctx->height);
+    WithPixelFormats(ctx->pixelFormat, src->pixelFormat, [&](auto cs, auto ts) {
+        typedef decltype(cs) CS;
+        typedef decltype(ts) TS;
+
+        auto shade = [&](i64 j, i64 start, i64 end, f64* colors) {
+            f64 px, py;
+            TransformPointFromMatrix(inv, start, j, &px, &py);
+            px -= x;
+            py -= y;
+
+            for (i64 i = start; i < end; ++i, px += inv[0], py += inv[1]) {
+                f64 u = MapSliceCoordinate(px, width, dstLeft, dstRight, srcLeft, srcRight, src->width);
+                f64 v = MapSliceCoordinate(py, height, dstTop, dstBottom, srcTop, srcBottom, src->height);
+
+                f64* c = colors + (i - start) * 4;
+                c[3] = 1;
+                SampleTexture<TS>(src, bilinear, u, v, c, c + 1, c + 2, c + 3);
+            }
+        };
+
+        if (ctx->antiAlias) {
+            ForEachQuadCoverageRun(ctx, x, y, width, height, [&](i64 j, i64 start, i64 end, const f64* coverage, std::vector<f64>& colors) {
+                colors.resize((end - start) * 4);
+                shade(j, start, end, colors.data());
+                BlendSpanTextured<CS>(ctx, j, start, end, colors.data(), opaque, coverage);
+            });
+            return;
+        }
+
+        QuadSpans spans;
+        SetupQuadSpans(ctx, x, y, width, height, &spans);
+
+        ParallelForRows(spans.top, spans.bottom, spans.right - spans.left, [&](i64 bandTop, i64 bandBottom) {
+            std::vector<f64> colors((spans.right - spans.left) * 4);
+            for (i64 j = bandTop; j < bandBottom; ++j) {
+                i64 start, end;
+                f64 invX, invY;
+                if (!GetQuadSpan(&spans, j, &start, &end, &invX, &invY)) continue;
+
+                shade(j, start, end, colors.data());
+                BlendSpanTextured<CS>(ctx, j, start, end, colors.data(), opaque);
+            }
+        });
+    });
+}
+
+// Scanline fill over an edge table, pixel (i, j) is covered exactly when its sample point is inside the
+// contours (even-odd or non-zero), so only covered pixels are visited. With anti-aliasing the coverage
+// rows scale alpha instead.
+static void FillPolygonEdges(
+    RenderContext* ctx,
+    std::vector<PolygonEdge>& edges,
+    bool nonZero,
+    f64 r, f64 g, f64 b, f64 a
+) {
+    if (edges.empty()) return;
+
+    std::sort(edges.begin(), edges.end(), [](const PolygonEdge& e0, const PolygonEdge& e1) { return e0.top < e1.top; });
+
+    i64 top, bottom, pixelsPerRow;
+    GetPolygonEdgesBounds(ctx, edges, &top, &bottom, &pixelsPerRow);
+
+    WithPixelFormat(ctx->pixelFormat, [&](auto cs) {
+        typedef decltype(cs) CS;
+
+        if (ctx->antiAlias) {
+            ParallelForRows(top, bottom, pixelsPerRow, [&](i64 bandTop, i64 bandBottom) {
+                CoverageRows rows;
+                SetupCoverageRows(ctx, edges, nonZero, &rows);
+
+                for (i64 j = bandTop; j < bandBottom; ++j) {
+                    i64 start, end;
+                    if (!GetCoverageRow(&rows, j, &start, &end)) continue;
+
+                    ForEachCoverageRun(rows.coverage.data(), start, end, [&](i64 runStart, i64 runEnd, const f64* coverage) {
+                        BlendSpanSolid<CS>(ctx, j, runStart, runEnd, r, g, b, a, coverage);
+                    });
+                }
+            });
+            return;
+        }
+
+        ParallelForRows(top, bottom, pixelsPerRow, [&](i64 bandTop, i64 bandBottom) {
+            std::vector<const PolygonEdge*> active;
+            std::vector<std::pair<f64, i32>> crossings;
+            size_t next = 0;
+
+            for (i64 j = bandTop; j < bandBottom; ++j) {
+                while (next < edges.size() && edges[next].top <= j) {
+                    if (edges[next].bottom > j) active.push_back(&edges[next]);
+                    ++next;
+                }
+                active.erase(
+                    std::remove_if(active.begin(), active.end(), [&](const PolygonEdge* edge) { return edge->bottom <= j; }),
+                    active.end()
+                );
+                if (active.empty()) continue;
+
+                crossings.clear();
+                for (const PolygonEdge* edge : active) {
+                    crossings.emplace_back(edge->x + (j - edge->y) * edge->slope, edge->winding);
+                }
+                std::sort(crossings.begin(), crossings.end());
+
+                // a pixel is inside from ceil(entering crossing) up to ceil(leaving crossing)
+                i32 winding = 0;
+                i64 spanStart = 0;
+                for (const std::pair<f64, i32>& crossing : crossings) {
+                    bool wasInside = nonZero ? winding != 0 : (winding & 1);
+                    winding += nonZero ? crossing.second : 1;
+                    bool inside = nonZero ? winding != 0 : (winding & 1);
+
+                    if (!wasInside && inside) {
+                        spanStart = std::max(0L, (i64)ceil(crossing.first));
+                    }
+                    else if (wasInside && !inside) {
+                        i64 spanEnd = std::min(ctx->width, (i64)ceil(crossing.first));
+                        BlendSpanSolid<CS>(ctx, j, spanStart, spanEnd, r, g, b, a);
+                    }
+                }
+            }
+        });
+    });
+}
+
+void FillPolygon(
+    RenderContext* ctx,
+    f64* points, i64 numPoints,
+    f64 r, f64 g, f64 b, f64 a
+) {
+    std::vector<PolygonEdge> edges;
+    AddPolygonEdges(ctx, points, numPoints, false, edges);
+    FillPolygonEdges(ctx, edges, false, r, g, b, a);
+}
+
+void DrawPolyline(
+    RenderContext* ctx,
+    f64* points, i64 numPoints,
+    f64 width, bool closed,
+    f64 r, f64 g, f64 b, f64 a
+) {
+    if (width <= 0 || numPoints < 2) return;
 
-    for (i64 i = left; i < right; ++i) {
-        for (i64 j = top; j < bottom; ++j) {
-            f64 invX, invY;
-            TransformPointFromMatrix(inv, i, j, &invX, &invY);
+    f64 halfWidth = width / 2;
+    i64 numSegments = closed ? numPoints : numPoints - 1;
+
+    // every segment body and bevel join becomes its own contour, filled together with the non-zero
+    // rule so overlapping parts are only blended once
+    std::vector<PolygonEdge> edges;
+    bool hasPrev = false;
+    f64 prevVx = 0, prevVy = 0;
+    f64 firstVx = 0, firstVy = 0;
+
+    auto addJoin = [&](f64 px, f64 py, f64 v0x, f64 v0y, f64 v1x, f64 v1y) {
+        // the outer side of the turn is opposite to the direction it turns to
+        f64 side = v0x * v1y - v0y * v1x > 0 ? -halfWidth : halfWidth;
+        f64 join[] = {
+            px, py,
+            px + v0x * side, py + v0y * side,
+            px + v1x * side, py + v1y * side,
+        };
+        AddPolygonEdges(ctx, join, 3, true, edges);
+    };
 
-            if (invX < x) continue;
-            if (invX > x + width) continue;
-            if (invY < y) continue;
-            if (invY > y + height) continue;
+    for (i64 s = 0; s < numSegments; ++s) {
+        f64 x1 = points[s * 2], y1 = points[s * 2 + 1];
+        f64 x2 = points[(s + 1) % numPoints * 2], y2 = points[(s + 1) % numPoints * 2 + 1];
 
-            f64 u = (invX - x) * scaleX;
-            f64 v = (invY - y) * scaleY;
+        f64 dx = x2 - x1;
+        f64 dy = y2 - y1;
+        f64 len = sqrt(dx * dx + dy * dy);
+        if (len == 0) continue;
 
-            u = (uStart + (uEnd - uStart) * u / tex->width) * tex->width;
-            v = (vStart + (vEnd - vStart) * v / tex->height) * tex->height;
+        f64 vx = -dy / len;
+        f64 vy = dx / len;
 
-            f64 r, g, b, a;
-            InterpolateColorFromBuffer(tex->buffer, tex->width, tex->height, tex->enableAlpha, u, v, &r, &g, &b, &a);
-            ApplyPixel(ctx, i, j, r, g, b, a);
+        if (hasPrev) addJoin(x1, y1, prevVx, prevVy, vx, vy);
+        else {
+            firstVx = vx;
+            firstVy = vy;
         }
-    }
-}
 
-inline bool pointInPolygon(
-    f64 x, f64 y,
-    f64 points[][2], i64 num_points
-) {
-    i64 n = num_points;
-    i64 j = n - 1;
-    bool res = false;
-    for (i64 i = 0; i < n; ++i) {
-        if (
-            (points[i][1] > y) != (points[j][1] > y)
-            && (
-                x < (
-                    (points[j][0] - points[i][0])
-                    * (y - points[i][1])
-                    / (points[j][1] - points[i][1])
-                    + points[i][0]
-                )
-            )
-        ) res = !res;
-        j = i;
+        f64 quad[] = {
+            x1 - vx * halfWidth, y1 - vy * halfWidth,
+            x1 + vx * halfWidth, y1 + vy * halfWidth,
+            x2 + vx * halfWidth, y2 + vy * halfWidth,
+            x2 - vx * halfWidth, y2 - vy * halfWidth,
+        };
+        AddPolygonEdges(ctx, quad, 4, true, edges);
+
+        hasPrev = true;
+        prevVx = vx;
+        prevVy = vy;
     }
 
-    return res;
+    if (closed && hasPrev) addJoin(points[0], points[1], prevVx, prevVy, firstVx, firstVy);
+
+    FillPolygonEdges(ctx, edges, true, r, g, b, a);
 }
 
 void DrawRect(
@@ -852,25 +2721,29 @@ void DrawRect(
 ) {
     if (width <= 0 || height <= 0) return;
 
-    f64 inv[6];
-    GetInverseTransform(ctx, inv);
+    WithPixelFormat(ctx->pixelFormat, [&](auto cs) {
+        typedef decltype(cs) CS;
 
-    i64 left, right, top, bottom;
-    GetBoarder(ctx->transformMatrix, x, y, width, height, &left, &right, &top, &bottom, ctx->width, ctx->height);
+        if (ctx->antiAlias) {
+            ForEachQuadCoverageRun(ctx, x, y, width, height, [&](i64 j, i64 start, i64 end, const f64* coverage, std::vector<f64>&) {
+                BlendSpanSolid<CS>(ctx, j, start, end, r, g, b, a, coverage);
+            });
+            return;
+        }
 
-    for (i64 i = left; i < right; ++i) {
-        for (i64 j = top; j < bottom; ++j) {
-            f64 invX, invY;
-            TransformPointFromMatrix(inv, i, j, &invX, &invY);
+        QuadSpans spans;
+        SetupQuadSpans(ctx, x, y, width, height, &spans);
 
-            if (invX < x) continue;
-            if (invX > x + width) continue;
-            if (invY < y) continue;
-            if (invY > y + height) continue;
-            
-            ApplyPixel(ctx, i, j, r, g, b, a);
-        }
-    }
+        ParallelForRows(spans.top, spans.bottom, spans.right - spans.left, [&](i64 bandTop, i64 bandBottom) {
+            for (i64 j = bandTop; j < bandBottom; ++j) {
+                i64 start, end;
+                f64 invX, invY;
+                if (!GetQuadSpan(&spans, j, &start, &end, &invX, &invY)) continue;
+
+                BlendSpanSolid<CS>(ctx, j, start, end, r, g, b, a);
+            }
+        });
+    });
 }
 
 void DrawLine(
@@ -882,9 +2755,6 @@ void DrawLine(
 ) {
     if (width <= 0) return;
 
-    f64 inv[6];
-    GetInverseTransform(ctx, inv);
-
     f64 dx = x2 - x1;
     f64 dy = y2 - y1;
     f64 len = sqrt(dx * dx + dy * dy);
@@ -898,23 +2768,301 @@ void DrawLine(
 
     f64 halfWidth = width / 2;
 
-    f64 points[][2] = {
-        {x1 - vx * halfWidth, y1 - vy * halfWidth},
-        {x1 + vx * halfWidth, y1 + vy * halfWidth},
-        {x2 + vx * halfWidth, y2 + vy * halfWidth},
-        {x2 - vx * halfWidth, y2 - vy * halfWidth},
+    f64 points[] = {
+        x1 - vx * halfWidth, y1 - vy * halfWidth,
+        x1 + vx * halfWidth, y1 + vy * halfWidth,
+        x2 + vx * halfWidth, y2 + vy * halfWidth,
+        x2 - vx * halfWidth, y2 - vy * halfWidth,
     };
 
-    for (i64 i = 0; i < ctx->width; ++i) {
-        for (i64 j = 0; j < ctx->height; ++j) {
-            f64 invX, invY;
-            TransformPointFromMatrix(inv, i, j, &invX, &invY);
+    FillPolygon(ctx, points, 4, r, g, b, a);
+}
+
+// Up to four disjoint pixel spans [start, end) of one row, in increasing order.
+struct RowSpans {
+    i64 start[4];
+    i64 end[4];
+    i32 count;
+};
+
+inline void IntersectRowSpans(RowSpans* spans, i64 start, i64 end) {
+    i32 n = 0;
+    for (i32 k = 0; k < spans->count; ++k) {
+        i64 s = std::max(spans->start[k], start);
+        i64 e = std::min(spans->end[k], end);
+        if (s >= e) continue;
+
+        spans->start[n] = s;
+        spans->end[n] = e;
+        ++n;
+    }
+    spans->count = n;
+}
+
+inline void SubtractRowSpan(RowSpans* spans, i64 start, i64 end) {
+    if (start >= end) return;
+
+    RowSpans res;
+    res.count = 0;
+    auto push = [&](i64 s, i64 e) {
+        res.start[res.count] = s;
+        res.end[res.count] = e;
+        ++res.count;
+    };
+
+    for (i32 k = 0; k < spans->count; ++k) {
+        if (spans->end[k] <= start || spans->start[k] >= end) {
+            push(spans->start[k], spans->end[k]);
+            continue;
+        }
+        if (spans->start[k] < start) push(spans->start[k], start);
+        if (spans->end[k] > end) push(end, spans->end[k]);
+    }
+    *spans = res;
+}
+
+// Pixels i with a <= i <= b (closed) or a < i < b (open), clipped to [left, right).
+inline void GetPixelRange(f64 a, f64 b, bool closed, i64 left, i64 right, i64* out_start, i64* out_end) {
+    f64 s = closed ? ceil(a) : floor(a) + 1;
+    f64 e = closed ? floor(b) + 1 : ceil(b);
+    *out_start = (i64)std::max((f64)left, std::min((f64)right, s));
+    *out_end = (i64)std::max((f64)left, std::min((f64)right, e));
+}
+
+// Ellipses, rings and sectors in normalised coordinates: q maps the device sample point (i, j) to
+// ((p - c) / radiusX, (p - c) / radiusY) with p the inverse mapped point, so the shape is |q| <= 1 with
+// |q| < inner cut out, and when sector is set only directions from startDir turning towards endDir.
+// q is affine in (i, j), each row is a line through the unit circle and its spans are roots of a quadratic.
+struct EllipseShape {
+    f64 q[6];
+    f64 inner;
+    bool sector;
+    f64 sweep;
+    f64 startDir[2];
+    f64 endDir[2];
+    f64 gradient;
+    i64 left, right, top, bottom;
+};
+
+// sampleOffset moves the sample point inside the pixel, 0 for the corner and 0.5 for the centre.
+static void SetupEllipseShape(
+    RenderContext* ctx,
+    f64 x, f64 y,
+    f64 radiusX, f64 radiusY,
+    f64 inner,
+    f64 startAngle, f64 sweep,
+    f64 sampleOffset,
+    EllipseShape* shape
+) {
+    f64 inv[6];
+    GetInverseTransform(ctx, inv);
+
+    f64* q = shape->q;
+    q[0] = inv[0] / radiusX;
+    q[1] = inv[1] / radiusY;
+    q[2] = inv[2] / radiusX;
+    q[3] = inv[3] / radiusY;
+    q[4] = (inv[4] - x) / radiusX + (q[0] + q[2]) * sampleOffset;
+    q[5] = (inv[5] - y) / radiusY + (q[1] + q[3]) * sampleOffset;
+
+    // largest singular value of the pixel to q jacobian, the fastest |q| can change per device pixel
+    f64 t = q[0] * q[0] + q[1] * q[1] + q[2] * q[2] + q[3] * q[3];
+    f64 det = q[0] * q[3] - q[2] * q[1];
+    shape->gradient = sqrt((t + sqrt(std::max(0.0, t * t - 4 * det * det))) / 2);
+
+    shape->inner = inner;
+    shape->sector = sweep < 2 * M_PI;
+    shape->sweep = sweep;
+    shape->startDir[0] = cos(startAngle);
+    shape->startDir[1] = sin(startAngle);
+    shape->endDir[0] = cos(startAngle + sweep);
+    shape->endDir[1] = sin(startAngle + sweep);
+
+    // GetBoarder truncates the far sides, the last column and row can still hold sample points
+    GetBoarder(ctx->transformMatrix, x - radiusX, y - radiusY, 2 * radiusX, 2 * radiusY, &shape->left, &shape->right, &shape->top, &shape->bottom, ctx->width, ctx->height);
+    shape->right = std::min(ctx->width, shape->right + 1);
+    shape->bottom = std::min(ctx->height, shape->bottom + 1);
+}
+
+// Signed distance like value of the sector bounds, c >= 0 on the inner side, c = c0 + c1 * i along row j.
+// dj is its change per row, so the gradient length over device pixels is hypot(c1, dj).
+inline void GetSectorBound(const EllipseShape* shape, bool end, f64 j, f64* c0, f64* c1, f64* dj) {
+    const f64* q = shape->q;
+    f64 ax = q[2] * j + q[4], ay = q[3] * j + q[5];
+    const f64* d = end ? shape->endDir : shape->startDir;
+    f64 sign = end ? -1 : 1;
+
+    *c0 = sign * (d[0] * ay - d[1] * ax);
+    *c1 = sign * (d[0] * q[1] - d[1] * q[0]);
+    *dj = sign * (d[0] * q[3] - d[1] * q[2]);
+}
+
+// Spans of row j where the shape grown by margin device pixels (shrunk when negative) holds, a margin of 0
+// gives exactly the pixels whose sample point is inside.
+static void GetEllipseRowSpans(const EllipseShape* shape, i64 j, f64 margin, RowSpans* spans) {
+    spans->count = 0;
+    const f64* q = shape->q;
+    f64 ax = q[2] * j + q[4], ay = q[3] * j + q[5];
+    f64 bx = q[0], by = q[1];
+
+    // |a + i b|^2 <= k^2
+    f64 qa = bx * bx + by * by;
+    f64 qb = 2 * (ax * bx + ay * by);
+    f64 aa = ax * ax + ay * ay;
+    auto solve = [&](f64 k, f64* i0, f64* i1) {
+        if (k <= 0 || qa == 0) return false;
+        f64 disc = qb * qb - 4 * qa * (aa - k * k);
+        if (disc < 0) return false;
+        f64 root = sqrt(disc);
+        *i0 = (-qb - root) / (2 * qa);
+        *i1 = (-qb + root) / (2 * qa);
+        return true;
+    };
+
+    f64 i0, i1;
+    if (!solve(1 + margin * shape->gradient, &i0, &i1)) return;
+
+    i64 s, e;
+    GetPixelRange(i0, i1, true, shape->left, shape->right, &s, &e);
+    if (s >= e) return;
+    spans->start[0] = s;
+    spans->end[0] = e;
+    spans->count = 1;
+
+    if (shape->inner > 0 && solve(shape->inner - margin * shape->gradient, &i0, &i1)) {
+        GetPixelRange(i0, i1, false, shape->left, shape->right, &s, &e);
+        SubtractRowSpan(spans, s, e);
+    }
+
+    if (!shape->sector) return;
+
+    // where c0 + c1 * i >= threshold, or for the cut out side where it is below
+    auto halfLine = [&](bool end, bool inside, f64* lo, f64* hi) {
+        f64 c0, c1, dj;
+        GetSectorBound(shape, end, j, &c0, &c1, &dj);
+        f64 threshold = -margin * sqrt(c1 * c1 + dj * dj);
+        *lo = -INFINITY;
+        *hi = INFINITY;
+
+        if (c1 == 0) {
+            if ((c0 >= threshold) != inside) *lo = INFINITY;
+            return;
+        }
+        f64 root = (threshold - c0) / c1;
+        if ((c1 > 0) == inside) *lo = root;
+        else *hi = root;
+    };
 
-            if (!pointInPolygon(invX, invY, points, 4)) continue;
+    f64 lo0, hi0, lo1, hi1;
+    if (shape->sweep <= M_PI) {
+        // a convex sector is the intersection of both half-planes
+        halfLine(false, true, &lo0, &hi0);
+        halfLine(true, true, &lo1, &hi1);
+        GetPixelRange(std::max(lo0, lo1), std::min(hi0, hi1), true, shape->left, shape->right, &s, &e);
+        IntersectRowSpans(spans, s, e);
+    }
+    else {
+        // otherwise the cut out wedge is convex
+        halfLine(false, false, &lo0, &hi0);
+        halfLine(true, false, &lo1, &hi1);
+        GetPixelRange(std::max(lo0, lo1), std::min(hi0, hi1), false, shape->left, shape->right, &s, &e);
+        SubtractRowSpan(spans, s, e);
+    }
+}
 
-            ApplyPixel(ctx, i, j, r, g, b, a);
+// Area coverage estimate of pixel (i, j) from the distance to each boundary in device pixels, boundaries
+// closer than a pixel are combined like parallel edges.
+static f64 GetEllipseCoverage(const EllipseShape* shape, i64 i, i64 j) {
+    const f64* q = shape->q;
+    f64 qx = q[0] * i + q[2] * j + q[4];
+    f64 qy = q[1] * i + q[3] * j + q[5];
+    f64 len = sqrt(qx * qx + qy * qy);
+
+    // |q| changes by the jacobian applied to its direction
+    f64 nx = len > 0 ? qx / len : 1;
+    f64 ny = len > 0 ? qy / len : 0;
+    f64 gi = q[0] * nx + q[1] * ny;
+    f64 gj = q[2] * nx + q[3] * ny;
+    f64 g = sqrt(gi * gi + gj * gj);
+    if (g == 0) return len <= 1 ? 1 : 0;
+
+    auto clamp = [](f64 v) { return std::max(0.0, std::min(1.0, v)); };
+    f64 coverage = clamp(0.5 - (len - 1) / g);
+    if (shape->inner > 0) coverage = clamp(coverage - clamp(0.5 - (len - shape->inner) / g));
+
+    if (shape->sector) {
+        f64 c0, c1, dj, h[2];
+        for (i32 k = 0; k < 2; ++k) {
+            GetSectorBound(shape, k == 1, j, &c0, &c1, &dj);
+            f64 cg = sqrt(c1 * c1 + dj * dj);
+            h[k] = cg > 0 ? clamp(0.5 + (c0 + c1 * i) / cg) : (c0 >= 0 ? 1 : 0);
         }
+        f64 wedge = shape->sweep <= M_PI ? clamp(h[0] + h[1] - 1) : clamp(h[0] + h[1]);
+        coverage = clamp(coverage + wedge - 1);
+    }
+
+    return coverage;
+}
+
+// Shared body of the ellipse primitives, see EllipseShape.
+static void FillEllipseShape(
+    RenderContext* ctx,
+    f64 x, f64 y,
+    f64 radiusX, f64 radiusY,
+    f64 inner,
+    f64 startAngle, f64 sweep,
+    f64 r, f64 g, f64 b, f64 a
+) {
+    if (radiusX <= 0 || radiusY <= 0 || sweep <= 0) return;
+
+    EllipseShape shape;
+    SetupEllipseShape(ctx, x, y, radiusX, radiusY, inner, startAngle, sweep, ctx->antiAlias ? 0.5 : 0, &shape);
+
+    if (ctx->antiAlias) {
+        // partly covered pixels reach up to half a pixel past the bounds
+        shape.left = std::max(0L, shape.left - 1);
+        shape.top = std::max(0L, shape.top - 1);
+        shape.right = std::min(ctx->width, shape.right + 1);
+        shape.bottom = std::min(ctx->height, shape.bottom + 1);
     }
+
+    WithPixelFormat(ctx->pixelFormat, [&](auto cs) {
+        typedef decltype(cs) CS;
+
+        ParallelForRows(shape.top, shape.bottom, shape.right - shape.left, [&](i64 bandTop, i64 bandBottom) {
+            std::vector<f64> coverage;
+            if (ctx->antiAlias) coverage.resize(ctx->width);
+
+            for (i64 j = bandTop; j < bandBottom; ++j) {
+                RowSpans spans;
+
+                if (!ctx->antiAlias) {
+                    GetEllipseRowSpans(&shape, j, 0, &spans);
+                    for (i32 k = 0; k < spans.count; ++k) {
+                        BlendSpanSolid<CS>(ctx, j, spans.start[k], spans.end[k], r, g, b, a);
+                    }
+                    continue;
+                }
+
+                // only pixels between the grown and the shrunk shape need a coverage estimate
+                RowSpans full;
+                GetEllipseRowSpans(&shape, j, 0.5, &spans);
+                GetEllipseRowSpans(&shape, j, -0.5, &full);
+
+                for (i32 k = 0; k < spans.count; ++k) {
+                    i32 f = 0;
+                    for (i64 i = spans.start[k]; i < spans.end[k]; ++i) {
+                        while (f < full.count && full.end[f] <= i) ++f;
+                        coverage[i] = f < full.count && full.start[f] <= i ? 1 : GetEllipseCoverage(&shape, i, j);
+                    }
+
+                    ForEachCoverageRun(coverage.data(), spans.start[k], spans.end[k], [&](i64 runStart, i64 runEnd, const f64* runCoverage) {
+                        BlendSpanSolid<CS>(ctx, j, runStart, runEnd, r, g, b, a, runCoverage);
+                    });
+                }
+            }
+        });
+    });
 }
 
 void DrawCircle(
@@ -923,28 +3071,50 @@ void DrawCircle(
     f64 radius,
     f64 r, f64 g, f64 b, f64 a
 ) {
-    if (radius <= 0) return;
-    
-    f64 inv[6];
-    GetInverseTransform(ctx, inv);
+    FillEllipseShape(ctx, x, y, radius, radius, 0, 0, 2 * M_PI, r, g, b, a);
+}
 
-    i64 left, right, top, bottom;
-    GetBoarder(ctx->transformMatrix, x - radius, y - radius, 2 * radius, 2 * radius, &left, &right, &top, &bottom, ctx->width, ctx->height);
-    
-    for (i64 i = left; i < right; ++i) {
-        for (i64 j = top; j < bottom; ++j) {
-            f64 invX, invY;
-            TransformPointFromMatrix(inv, i, j, &invX, &invY);
-            
-            f64 dx = invX - x;
-            f64 dy = invY - y;
-            f64 dist = sqrt(dx * dx + dy * dy);
+void DrawEllipse(
+    RenderContext* ctx,
+    f64 x, f64 y,
+    f64 radiusX, f64 radiusY,
+    f64 r, f64 g, f64 b, f64 a
+) {
+    FillEllipseShape(ctx, x, y, radiusX, radiusY, 0, 0, 2 * M_PI, r, g, b, a);
+}
 
-            if (dist > radius) continue;
-            
-            ApplyPixel(ctx, i, j, r, g, b, a);
-        }
+// The area between two concentric circles.
+void DrawRing(
+    RenderContext* ctx,
+    f64 x, f64 y,
+    f64 innerRadius, f64 outerRadius,
+    f64 r, f64 g, f64 b, f64 a
+) {
+    if (outerRadius <= 0 || innerRadius >= outerRadius) return;
+    FillEllipseShape(ctx, x, y, outerRadius, outerRadius, std::max(0.0, innerRadius) / outerRadius, 0, 2 * M_PI, r, g, b, a);
+}
+
+// The part of a ring from startAngle to endAngle (radians, growing the same way as Rotate), an inner
+// radius of 0 draws a pie slice. A span of 2 pi or more draws the whole ring.
+void DrawArc(
+    RenderContext* ctx,
+    f64 x, f64 y,
+    f64 innerRadius, f64 outerRadius,
+    f64 startAngle, f64 endAngle,
+    f64 r, f64 g, f64 b, f64 a
+) {
+    if (outerRadius <= 0 || innerRadius >= outerRadius || endAngle == startAngle) return;
+
+    f64 sweep = endAngle - startAngle;
+    if (fabs(sweep) < 2 * M_PI) {
+        sweep = fmod(sweep, 2 * M_PI);
+        if (sweep < 0) sweep += 2 * M_PI;
+    }
+    else {
+        sweep = 2 * M_PI;
     }
+
+    FillEllipseShape(ctx, x, y, outerRadius, outerRadius, std::max(0.0, innerRadius) / outerRadius, startAngle, sweep, r, g, b, a);
 }
 
 Texture* ResampleTexture(
@@ -952,26 +3122,33 @@ Texture* ResampleTexture(
     i64 width, i64 height
 ) {
     Texture* res = new Texture();
+    CountMemoryObject(MEMORY_KIND_TEXTURE, 1);
     res->width = width;
     res->height = height;
     i64 ipp = tex->enableAlpha ? 4 : 3;
-    res->buffer = new f64[width * height * ipp];
+    res->pixelFormat = tex->pixelFormat;
+    res->buffer = CreatePixelBuffer(res->pixelFormat, width * height * ipp, MEMORY_KIND_TEXTURE);
     res->enableAlpha = tex->enableAlpha;
 
-    for (i64 i = 0; i < width; ++i) {
-        for (i64 j = 0; j < height; ++j) {
-            InterpolateColorFromBuffer(
-                tex->buffer, tex->width, tex->height, tex->enableAlpha,
-                (f64)i / width * tex->width,
-                (f64)j / height * tex->height,
-                &res->buffer[j * res->width * ipp + i * ipp],
-                &res->buffer[j * res->width * ipp + i * ipp + 1],
-                &res->buffer[j * res->width * ipp + i * ipp + 2],
-                tex->enableAlpha ? &res->buffer[j * res->width * ipp + i * ipp + 3] : nullptr
-            );
+    WithPixelFormat(tex->pixelFormat, [&](auto ts) {
+        typedef decltype(ts) TS;
+        typename TS::T* dst = (typename TS::T*)res->buffer;
+
+        for (i64 i = 0; i < width; ++i) {
+            for (i64 j = 0; j < height; ++j) {
+                f64 r, g, b, a = 1;
+                InterpolateColorFromBuffer<TS>(
+                    tex->buffer, tex->width, tex->height, tex->enableAlpha,
+                    (f64)i / width * tex->width,
+                    (f64)j / height * tex->height,
+                    &r, &g, &b, &a
+                );
+                StorePixel<TS>(dst + j * res->width * ipp + i * ipp, res->enableAlpha, r, g, b, a);
+            }
         }
-    }
+    });
 
+    res->opaque = IsTextureOpaque(res);
     return res;
 }
 
@@ -987,6 +3164,27 @@ bool GetTextureEnableAlpha(Texture* tex) {
     return tex->enableAlpha;
 }
 
+i32 GetTexturePixelFormat(Texture* tex) {
+    return tex->pixelFormat;
+}
+
+void* GetTextureBuffer(Texture* tex) {
+    return tex->buffer;
+}
+
+// Drops the mip chain after the base level was written in place; it is rebuilt on the next minified draw.
+void InvalidateTextureMipmaps(Texture* tex) {
+    std::lock_guard<std::mutex> lock(tex->mipmapMutex);
+    for (Texture* level : tex->mipmaps) DestroyTexture(level);
+    tex->mipmaps.clear();
+    if (!tex->sharedBuffer) tex->opaque = IsTextureOpaque(tex);
+}
+
+i64 GetTextureMipLevels(Texture* tex) {
+    std::lock_guard<std::mutex> lock(tex->mipmapMutex);
+    return tex->mipmaps.size() + 1;
+}
+
 i64 GetAudioClipBufferSizeFromData(i64 numFrames, i64 channels) {
     return numFrames * channels;
 }
@@ -1000,11 +3198,12 @@ AudioClip* CreateAudioClipFromBuffer(
     i64 numFrames, f64 *buffer
 ) {
     AudioClip* clip = new AudioClip();
+    CountMemoryObject(MEMORY_KIND_AUDIO_CLIP, 1);
     clip->sampleRate = sampleRate;
     clip->channels = channels;
     clip->numFrames = numFrames;
     i64 size = GetAudioClipBufferSize(clip);
-    clip->buffer = new f64[size];
+    clip->buffer = (f64*)AcquireBuffer(size * sizeof(f64), MEMORY_KIND_AUDIO_CLIP);
 
     for (i64 i = 0; i < size; ++i) {
         clip->buffer[i] = buffer[i];
@@ -1018,11 +3217,12 @@ AudioClip* CreateAudioClipFromInt16Buffer(
     i64 numFrames, i16 *buffer
 ) {
     AudioClip* clip = new AudioClip();
+    CountMemoryObject(MEMORY_KIND_AUDIO_CLIP, 1);
     clip->sampleRate = sampleRate;
     clip->channels = channels;
     clip->numFrames = numFrames;
     i64 size = GetAudioClipBufferSize(clip);
-    clip->buffer = new f64[size];
+    clip->buffer = (f64*)AcquireBuffer(size * sizeof(f64), MEMORY_KIND_AUDIO_CLIP);
 
     for (i64 i = 0; i < clip->numFrames; ++i) {
         for (i64 j = 0; j < clip->channels; ++j) {
@@ -1035,22 +3235,48 @@ AudioClip* CreateAudioClipFromInt16Buffer(
 
 AudioClip* CreateSilentAudioClip(i64 sampleRate, i64 channels, i64 numFrames) {
     AudioClip* clip = new AudioClip();
+    CountMemoryObject(MEMORY_KIND_AUDIO_CLIP, 1);
     clip->sampleRate = sampleRate;
     clip->channels = channels;
     clip->numFrames = numFrames;
     i64 size = GetAudioClipBufferSize(clip);
-    clip->buffer = new f64[size];
+    clip->buffer = (f64*)AcquireBuffer(size * sizeof(f64), MEMORY_KIND_AUDIO_CLIP);
 
     std::fill(clip->buffer, clip->buffer + size, 0.0);
     return clip;
 }
 
+// Wraps caller-owned interleaved samples; the caller keeps them alive until an edit replaces the buffer.
+AudioClip* CreateAudioClipFromBufferShared(
+    i64 sampleRate, i64 channels,
+    i64 numFrames, f64 *buffer
+) {
+    AudioClip* clip = new AudioClip();
+    CountMemoryObject(MEMORY_KIND_AUDIO_CLIP, 1);
+    clip->sampleRate = sampleRate;
+    clip->channels = channels;
+    clip->numFrames = numFrames;
+    clip->buffer = buffer;
+    clip->sharedBuffer = true;
+    return clip;
+}
+
 void DestroyAudioClip(AudioClip* clip) {
-    return;
-    delete[] clip->buffer;
+    if (!clip->sharedBuffer) ReleaseBuffer(clip->buffer);
+    CountMemoryObject(MEMORY_KIND_AUDIO_CLIP, -1);
     delete clip;
 }
 
+static void ReplaceAudioClipBuffer(AudioClip* clip, f64* buffer) {
+    if (!clip->sharedBuffer) ReleaseBuffer(clip->buffer);
+    clip->buffer = buffer;
+    clip->sharedBuffer = false;
+}
+
+f64* GetAudioClipBuffer(AudioClip* clip) {
+    return clip->buffer;
+}
+
 AudioClip* CloneAudioClip(AudioClip* clip) {
     return CreateAudioClipFromBuffer(
         clip->sampleRate,
@@ -1070,7 +3296,7 @@ void ApplyResampleAudioClip(
     i64 newNumSamples = dur * sampleRate;
     i64 newSize = GetAudioClipBufferSizeFromData(newNumSamples, channels);
 
-    f64 *newBuffer = new f64[newSize];
+    f64 *newBuffer = (f64*)AcquireBuffer(newSize * sizeof(f64), MEMORY_KIND_AUDIO_CLIP);
 
     for (i64 i = 0; i < newNumSamples; ++i) {
         f64 secT = (f64)i / sampleRate;
@@ -1111,9 +3337,7 @@ void ApplyResampleAudioClip(
         }
     }
 
-    delete[] clip->buffer;
-
-    clip->buffer = newBuffer;
+    ReplaceAudioClipBuffer(clip, newBuffer);
     clip->sampleRate = sampleRate;
     clip->channels = channels;
     clip->numFrames = newNumSamples;
@@ -1132,25 +3356,30 @@ i64 OverlayAudioClip(
     i64 startFrame,
     bool autoResample
 ) {
+    // the resampled copy only lives for this call
+    AudioClip* resampled = nullptr;
     if (autoResample) {
         if (target->sampleRate != source->sampleRate || target->channels != source->channels) {
-            source = CloneAudioClip(source);
+            source = resampled = CloneAudioClip(source);
             ResampleAudioClipLike(source, target);
         }
     }
 
-    if (target->sampleRate != source->sampleRate) return -1;
-    if (target->channels != source->channels) return -2;
-
-    for (i64 i = 0; i < source->numFrames; ++i) {
-        if (startFrame + i >= target->numFrames) break;
-        i64 targetIndex = startFrame + i;
-        for (i64 c = 0; c < source->channels; ++c) {
-            target->buffer[targetIndex * source->channels + c] += source->buffer[i * source->channels + c];
+    i64 res = 0;
+    if (target->sampleRate != source->sampleRate) res = -1;
+    else if (target->channels != source->channels) res = -2;
+    else {
+        for (i64 i = 0; i < source->numFrames; ++i) {
+            if (startFrame + i >= target->numFrames) break;
+            i64 targetIndex = startFrame + i;
+            for (i64 c = 0; c < source->channels; ++c) {
+                target->buffer[targetIndex * source->channels + c] += source->buffer[i * source->channels + c];
+            }
         }
     }
 
-    return 0;
+    if (resampled) DestroyAudioClip(resampled);
+    return res;
 }
 
 i64 OverlayAudioClipSecond(
@@ -1182,7 +3411,7 @@ WapperedBytes* SaveAudioClipAsWav(AudioClip* clip) {
     dataSize += 4; // Data size
     dataSize += GetAudioClipBufferSize(clip) * 2;
 
-    iu8* data = new iu8[dataSize];
+    iu8* data = (iu8*)AcquireBuffer(dataSize, MEMORY_KIND_BYTES);
     *(iu8*)&data[0] = 'R';
     *(iu8*)&data[1] = 'I';
     *(iu8*)&data[2] = 'F';
@@ -1222,6 +3451,8 @@ WapperedBytes* SaveAudioClipAsWav(AudioClip* clip) {
     }
 
     WapperedBytes* result = new WapperedBytes();
+
+    CountMemoryObject(MEMORY_KIND_BYTES, 1);
     result->data = data;
     result->size = dataSize;
     return result;
@@ -1251,6 +3482,12 @@ i64 GetWapperedBytesDataSize(WapperedBytes* bytes) {
     return bytes->size;
 }
 
+void DestroyWapperedBytes(WapperedBytes* bytes) {
+    ReleaseBuffer(bytes->data);
+    CountMemoryObject(MEMORY_KIND_BYTES, -1);
+    delete bytes;
+}
+
 void ApplyVolumeGain(AudioClip* clip, f64 gain) {
     i64 size = GetAudioClipBufferSize(clip);
     for (i64 i = 0; i < size; ++i) {
@@ -1263,7 +3500,10 @@ i64 GetVersion() {
 }
 
 void ApplyCutAudioClip(AudioClip* clip, i64 startFrame, i64 endFrame) {
-    f64* newBuffer = new f64[GetAudioClipBufferSizeFromData(endFrame - startFrame, clip->channels)];
+    i64 newSize = GetAudioClipBufferSizeFromData(endFrame - startFrame, clip->channels);
+    f64* newBuffer = (f64*)AcquireBuffer(newSize * sizeof(f64), MEMORY_KIND_AUDIO_CLIP);
+    // frames past the end of the clip stay silent
+    std::fill(newBuffer, newBuffer + newSize, 0.0);
 
     for (i64 i = 0; i < endFrame - startFrame; ++i) {
         if (startFrame + i >= clip->numFrames) break;
@@ -1272,9 +3512,7 @@ void ApplyCutAudioClip(AudioClip* clip, i64 startFrame, i64 endFrame) {
         }
     }
 
-    delete[] clip->buffer;
-    
-    clip->buffer = newBuffer;
+    ReplaceAudioClipBuffer(clip, newBuffer);
     clip->numFrames = endFrame - startFrame;
 }
 
@@ -1290,29 +3528,306 @@ void DrawVerticalGrd(
 ) {
     if (width <= 0 || height <= 0) return;
 
+    QuadSpans spans;
+    SetupQuadSpans(ctx, x, y, width, height, &spans);
+
+    f64 dp = spans.inv[1] / height;
+    f64 topColor[4] = {top_r, top_g, top_b, top_a};
+    f64 bottomColor[4] = {bottom_r, bottom_g, bottom_b, bottom_a};
+
+    WithPixelFormat(ctx->pixelFormat, [&](auto cs) {
+        typedef decltype(cs) CS;
+
+        if (ctx->antiAlias) {
+            ForEachQuadCoverageRun(ctx, x, y, width, height, [&](i64 j, i64 start, i64 end, const f64* coverage, std::vector<f64>&) {
+                f64 invX, invY;
+                TransformPointFromMatrix(spans.inv, start, j, &invX, &invY);
+                BlendSpanGradient<CS>(ctx, j, start, end, topColor, bottomColor, (invY - y) / height, dp, coverage);
+            });
+            return;
+        }
+
+        ParallelForRows(spans.top, spans.bottom, spans.right - spans.left, [&](i64 bandTop, i64 bandBottom) {
+            for (i64 j = bandTop; j < bandBottom; ++j) {
+                i64 start, end;
+                f64 invX, invY;
+                if (!GetQuadSpan(&spans, j, &start, &end, &invX, &invY)) continue;
+
+                BlendSpanGradient<CS>(ctx, j, start, end, topColor, bottomColor, (invY - y) / height, dp);
+            }
+        });
+    });
+}
+
+// Straight colors of a stop array at GRADIENT_LUT_SIZE evenly spaced positions over [0, 1], stops are packed
+// as position, r, g, b, a. Before the first and after the last stop the end colors hold.
+static void BuildGradientLut(const f64* stops, i64 numStops, f64* lut) {
+    std::vector<i64> order(numStops);
+    for (i64 k = 0; k < numStops; ++k) order[k] = k;
+    std::stable_sort(order.begin(), order.end(), [&](i64 k0, i64 k1) { return stops[k0 * 5] < stops[k1 * 5]; });
+
+    i64 next = 0;
+    for (i64 n = 0; n < GRADIENT_LUT_SIZE; ++n) {
+        f64 t = (f64)n / (GRADIENT_LUT_SIZE - 1);
+        while (next < numStops && stops[order[next] * 5] <= t) ++next;
+
+        const f64* s0 = stops + order[std::max(0L, next - 1)] * 5;
+        const f64* s1 = stops + order[std::min(numStops - 1, next)] * 5;
+        f64 p = s1[0] > s0[0] ? std::max(0.0, std::min(1.0, (t - s0[0]) / (s1[0] - s0[0]))) : 0;
+
+        for (i64 c = 0; c < 4; ++c) lut[n * 4 + c] = s0[c + 1] + (s1[c + 1] - s0[c + 1]) * p;
+    }
+}
+
+inline const f64* LookupGradient(const f64* lut, f64 t) {
+    t = std::max(0.0, std::min(1.0, t));
+    return lut + (i64)(t * (GRADIENT_LUT_SIZE - 1) + 0.5) * 4;
+}
+
+// Fills the transformed rect (x, y, width, height) with gradient colors. shade(j, start, end, colors) writes
+// the straight colors of a span and returns true when only colors[0 .. 3] was written because the whole
+// span has one color, which then blends as a solid span.
+template <typename Shade> static void FillGradientRect(
+    RenderContext* ctx,
+    f64 x, f64 y, f64 width, f64 height,
+    bool opaque,
+    Shade shade
+) {
+    if (width <= 0 || height <= 0) return;
+    opaque = opaque && ctx->colorTransform[3] == 1;
+
+    WithPixelFormat(ctx->pixelFormat, [&](auto cs) {
+        typedef decltype(cs) CS;
+
+        auto blend = [&](i64 j, i64 start, i64 end, const f64* coverage, std::vector<f64>& colors) {
+            colors.resize(std::max(1L, end - start) * 4);
+            f64* c = colors.data();
+            if (shade(j, start, end, c)) BlendSpanSolid<CS>(ctx, j, start, end, c[0], c[1], c[2], c[3], coverage);
+            else BlendSpanTextured<CS>(ctx, j, start, end, c, opaque, coverage);
+        };
+
+        if (ctx->antiAlias) {
+            ForEachQuadCoverageRun(ctx, x, y, width, height, blend);
+            return;
+        }
+
+        QuadSpans spans;
+        SetupQuadSpans(ctx, x, y, width, height, &spans);
+
+        ParallelForRows(spans.top, spans.bottom, spans.right - spans.left, [&](i64 bandTop, i64 bandBottom) {
+            std::vector<f64> colors;
+            for (i64 j = bandTop; j < bandBottom; ++j) {
+                i64 start, end;
+                f64 invX, invY;
+                if (!GetQuadSpan(&spans, j, &start, &end, &invX, &invY)) continue;
+
+                blend(j, start, end, nullptr, colors);
+            }
+        });
+    });
+}
+
+inline bool IsGradientOpaque(const f64* stops, i64 numStops) {
+    for (i64 k = 0; k < numStops; ++k) {
+        if (stops[k * 5 + 4] != 1) return false;
+    }
+    return true;
+}
+
+// Fills the rect (x, y, width, height) with a gradient along (x0, y0) -> (x1, y1), all in user space. Stops are
+// numStops packed position, r, g, b, a with positions along the axis in [0, 1], colors pad past both ends.
+// When the axis stays vertical on screen every row has one color.
+void DrawLinearGradient(
+    RenderContext* ctx,
+    f64 x, f64 y, f64 width, f64 height,
+    f64 x0, f64 y0, f64 x1, f64 y1,
+    f64* stops, i64 numStops
+) {
+    f64 dx = x1 - x0, dy = y1 - y0;
+    f64 len2 = dx * dx + dy * dy;
+    if (numStops < 1 || len2 == 0) return;
+
+    std::vector<f64> lut(GRADIENT_LUT_SIZE * 4);
+    BuildGradientLut(stops, numStops, lut.data());
+
+    // t of the projection onto the axis is affine in the device pixel
     f64 inv[6];
     GetInverseTransform(ctx, inv);
+    f64 ti = (inv[0] * dx + inv[1] * dy) / len2;
+    f64 tj = (inv[2] * dx + inv[3] * dy) / len2;
+    f64 t0 = ((inv[4] - x0) * dx + (inv[5] - y0) * dy) / len2;
+    bool rowConstant = fabs(ti) < 1e-12;
+
+    FillGradientRect(ctx, x, y, width, height, IsGradientOpaque(stops, numStops), [&](i64 j, i64 start, i64 end, f64* colors) {
+        f64 t = t0 + tj * j + ti * start;
+        if (rowConstant) {
+            memcpy(colors, LookupGradient(lut.data(), t), 4 * sizeof(f64));
+            return true;
+        }
 
-    i64 left, right, top, bottom;
-    GetBoarder(ctx->transformMatrix, x, y, width, height, &left, &right, &top, &bottom, ctx->width, ctx->height);
-    
-    for (i64 i = left; i < right; ++i) {
-        for (i64 j = top; j < bottom; ++j) {
-            f64 invX, invY;
-            TransformPointFromMatrix(inv, i, j, &invX, &invY);
-            if (invX < x) continue;
-            if (invX > x + width) continue;
-            if (invY < y) continue;
-            if (invY > y + height) continue;
-            
-            f64 p = (invY - y) / height;
-            f64 r = top_r + (bottom_r - top_r) * p;
-            f64 g = top_g + (bottom_g - top_g) * p;
-            f64 b = top_b + (bottom_b - top_b) * p;
-            f64 a = top_a + (bottom_a - top_a) * p;
-            ApplyPixel(ctx, i, j, r, g, b, a);
+        for (i64 k = 0; k < end - start; ++k) {
+            memcpy(colors + k * 4, LookupGradient(lut.data(), t + ti * k), 4 * sizeof(f64));
+        }
+        return false;
+    });
+}
+
+// Fills the rect (x, y, width, height) with a gradient by distance from (cx, cy), position 1 at radius, all in
+// user space. Stops as for DrawLinearGradient.
+void DrawRadialGradient(
+    RenderContext* ctx,
+    f64 x, f64 y, f64 width, f64 height,
+    f64 cx, f64 cy, f64 radius,
+    f64* stops, i64 numStops
+) {
+    if (numStops < 1 || radius <= 0) return;
+
+    std::vector<f64> lut(GRADIENT_LUT_SIZE * 4);
+    BuildGradientLut(stops, numStops, lut.data());
+
+    // offset from the centre in radii is affine in the device pixel
+    f64 inv[6];
+    GetInverseTransform(ctx, inv);
+    f64 q[6] = {
+        inv[0] / radius, inv[1] / radius,
+        inv[2] / radius, inv[3] / radius,
+        (inv[4] - cx) / radius, (inv[5] - cy) / radius,
+    };
+
+    FillGradientRect(ctx, x, y, width, height, IsGradientOpaque(stops, numStops), [&](i64 j, i64 start, i64 end, f64* colors) {
+        f64 qx = q[0] * start + q[2] * j + q[4];
+        f64 qy = q[1] * start + q[3] * j + q[5];
+
+        for (i64 k = 0; k < end - start; ++k, qx += q[0], qy += q[1]) {
+            memcpy(colors + k * 4, LookupGradient(lut.data(), sqrt(qx * qx + qy * qy)), 4 * sizeof(f64));
+        }
+        return false;
+    });
+}
+
+// number of f64 arguments following the opcode at args, -1 when the opcode is unknown or its
+// arguments run past the end of the buffer
+static i64 GetCommandArgumentCount(i64 op, const f64* args, i64 available) {
+    i64 count;
+    switch (op) {
+        case COMMAND_SAVE_STATE: count = 0; break;
+        case COMMAND_RESTORE_STATE: count = 0; break;
+        case COMMAND_SET_TRANSFORM: count = 6; break;
+        case COMMAND_APPLY_TRANSFORM: count = 6; break;
+        case COMMAND_SCALE: count = 2; break;
+        case COMMAND_TRANSLATE: count = 2; break;
+        case COMMAND_ROTATE: count = 1; break;
+        case COMMAND_SET_COLOR_TRANSFORM: count = 4; break;
+        case COMMAND_APPLY_COLOR_TRANSFORM: count = 4; break;
+        case COMMAND_SET_COLOR: count = 4; break;
+        case COMMAND_FILL_COLOR: count = 4; break;
+        case COMMAND_SET_PIXEL: count = 6; break;
+        case COMMAND_APPLY_PIXEL: count = 6; break;
+        case COMMAND_DRAW_TEXTURE: count = 6; break;
+        case COMMAND_DRAW_SPLITTED_TEXTURE: count = 10; break;
+        case COMMAND_DRAW_RECT: count = 8; break;
+        case COMMAND_DRAW_LINE: count = 9; break;
+        case COMMAND_DRAW_CIRCLE: count = 7; break;
+        case COMMAND_DRAW_VERTICAL_GRD: count = 12; break;
+        case COMMAND_SET_ANTI_ALIAS: count = 1; break;
+        case COMMAND_DRAW_ELLIPSE: count = 8; break;
+        case COMMAND_DRAW_RING: count = 8; break;
+        case COMMAND_DRAW_ARC: count = 10; break;
+        case COMMAND_DRAW_NINE_SLICE_TEXTURE: count = 14; break;
+        case COMMAND_DRAW_PROCEDURAL_TEXTURE: count = 12; break;
+        case COMMAND_FILL_POLYGON:
+        case COMMAND_DRAW_POLYLINE:
+            // the point count comes first, the points themselves sit before the color
+            if (available < 1 || !(args[0] >= 0 && args[0] <= available)) return -1;
+            count = (op == COMMAND_FILL_POLYGON ? 1 : 3) + (i64)args[0] * 2 + 4;
+            break;
+        case COMMAND_DRAW_LINEAR_GRADIENT:
+        case COMMAND_DRAW_RADIAL_GRADIENT:
+            // the stop count comes first, the stops follow the geometry
+            if (available < 1 || !(args[0] >= 0 && args[0] <= available)) return -1;
+            count = (op == COMMAND_DRAW_LINEAR_GRADIENT ? 9 : 8) + (i64)args[0] * 5;
+            break;
+        case COMMAND_DRAW_SPRITE_BATCH:
+            // texture index, filter and sprite count, then the sprites
+            if (available < 3 || !(args[2] >= 0 && args[2] <= available)) return -1;
+            count = 3 + (i64)args[2] * SPRITE_BATCH_STRIDE;
+            break;
+        default: return -1;
+    }
+
+    return count <= available ? count : -1;
+}
+
+// Replays a frame recorded on the Python side in one call. Every command is its opcode followed by its
+// arguments, all packed as f64, and textures are referenced by their index in the textures table.
+// Execution stops at the first malformed command and false is returned.
+bool ExecuteCommandBuffer(
+    RenderContext* ctx,
+    f64* commands, i64 size,
+    Texture** textures, i64 numTextures
+) {
+    i64 pos = 0;
+
+    while (pos < size) {
+        i64 op = (i64)commands[pos];
+        f64* a = commands + pos + 1;
+        i64 count = GetCommandArgumentCount(op, a, size - pos - 1);
+        if (count < 0) return false;
+
+        Texture* tex = nullptr;
+        if (op == COMMAND_DRAW_TEXTURE || op == COMMAND_DRAW_SPLITTED_TEXTURE || op == COMMAND_DRAW_SPRITE_BATCH || op == COMMAND_DRAW_NINE_SLICE_TEXTURE || op == COMMAND_DRAW_PROCEDURAL_TEXTURE) {
+            i64 index = (i64)a[0];
+            if (index < 0 || index >= numTextures) return false;
+            tex = textures[index];
+        }
+
+        switch (op) {
+            case COMMAND_SAVE_STATE: SaveContextState(ctx); break;
+            case COMMAND_RESTORE_STATE: RestoreContextState(ctx); break;
+            case COMMAND_SET_TRANSFORM: SetTransform(ctx, a[0], a[1], a[2], a[3], a[4], a[5]); break;
+            case COMMAND_APPLY_TRANSFORM: ApplyTransform(ctx, a[0], a[1], a[2], a[3], a[4], a[5]); break;
+            case COMMAND_SCALE: Scale(ctx, a[0], a[1]); break;
+            case COMMAND_TRANSLATE: Translate(ctx, a[0], a[1]); break;
+            case COMMAND_ROTATE: Rotate(ctx, a[0]); break;
+            case COMMAND_SET_COLOR_TRANSFORM: SetColorTransform(ctx, a[0], a[1], a[2], a[3]); break;
+            case COMMAND_APPLY_COLOR_TRANSFORM: ApplyColorTransform(ctx, a[0], a[1], a[2], a[3]); break;
+            case COMMAND_SET_COLOR: SetColor(ctx, a[0], a[1], a[2], a[3]); break;
+            case COMMAND_FILL_COLOR: FillColor(ctx, a[0], a[1], a[2], a[3]); break;
+            case COMMAND_SET_PIXEL: SetPixel(ctx, (i64)a[0], (i64)a[1], a[2], a[3], a[4], a[5]); break;
+            case COMMAND_APPLY_PIXEL: ApplyPixel(ctx, (i64)a[0], (i64)a[1], a[2], a[3], a[4], a[5]); break;
+            case COMMAND_DRAW_TEXTURE: DrawTexture(ctx, tex, a[1], a[2], a[3], a[4], (i32)a[5]); break;
+            case COMMAND_DRAW_SPLITTED_TEXTURE: DrawSplittedTexture(ctx, tex, a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8], (i32)a[9]); break;
+            case COMMAND_DRAW_RECT: DrawRect(ctx, a[0], a[1], a[2], a[3], a[4], a[5], a[6], a[7]); break;
+            case COMMAND_DRAW_LINE: DrawLine(ctx, a[0], a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8]); break;
+            case COMMAND_DRAW_CIRCLE: DrawCircle(ctx, a[0], a[1], a[2], a[3], a[4], a[5], a[6]); break;
+            case COMMAND_DRAW_VERTICAL_GRD: DrawVerticalGrd(ctx, a[0], a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8], a[9], a[10], a[11]); break;
+            case COMMAND_SET_ANTI_ALIAS: SetAntiAlias(ctx, a[0] != 0); break;
+            case COMMAND_DRAW_ELLIPSE: DrawEllipse(ctx, a[0], a[1], a[2], a[3], a[4], a[5], a[6], a[7]); break;
+            case COMMAND_DRAW_RING: DrawRing(ctx, a[0], a[1], a[2], a[3], a[4], a[5], a[6], a[7]); break;
+            case COMMAND_DRAW_ARC: DrawArc(ctx, a[0], a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8], a[9]); break;
+            case COMMAND_FILL_POLYGON: {
+                i64 n = (i64)a[0];
+                f64* c = a + 1 + n * 2;
+                FillPolygon(ctx, a + 1, n, c[0], c[1], c[2], c[3]);
+                break;
+            }
+            case COMMAND_DRAW_POLYLINE: {
+                i64 n = (i64)a[0];
+                f64* c = a + 3 + n * 2;
+                DrawPolyline(ctx, a + 3, n, a[1], a[2] != 0, c[0], c[1], c[2], c[3]);
+                break;
+            }
+            case COMMAND_DRAW_LINEAR_GRADIENT: DrawLinearGradient(ctx, a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8], a + 9, (i64)a[0]); break;
+            case COMMAND_DRAW_RADIAL_GRADIENT: DrawRadialGradient(ctx, a[1], a[2], a[3], a[4], a[5], a[6], a[7], a + 8, (i64)a[0]); break;
+            case COMMAND_DRAW_SPRITE_BATCH: DrawSpriteBatch(ctx, tex, a + 3, (i64)a[2], (i32)a[1]); break;
+            case COMMAND_DRAW_NINE_SLICE_TEXTURE: DrawNineSliceTexture(ctx, tex, a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8], a[9], a[10], a[11], a[12], (i32)a[13]); break;
+            case COMMAND_DRAW_PROCEDURAL_TEXTURE: DrawProceduralTexture(ctx, (i32)a[1], tex, a[2], a[3], a[4], a[5], a[6], a[7], a[8], a[9], a[10], (i32)a[11]); break;
         }
+
+        pos += 1 + count;
     }
+
+    return true;
 }
 
 namespace ShaderUtils {
@@ -1403,7 +3918,7 @@ namespace ShaderUtils {
     }
 }
 
-inline void GetMilthmHitEffectPixel(f64 seed, f64 t, f64 x, f64 y, f64* a) {
+void GetMilthmHitEffectPixel(f64 seed, f64 t, f64 x, f64 y, f64* a) {
     using namespace ShaderUtils;
 
     f64 n = circularNoise({x, y}, 50.0, seed);
@@ -1411,30 +3926,139 @@ inline void GetMilthmHitEffectPixel(f64 seed, f64 t, f64 x, f64 y, f64* a) {
 }
 
 void GetPixelChannel(Texture* tex, i64 x, i64 y, i64 channel, f64* res) {
-    *res = tex->buffer[x * tex->height * 4 + y * 4 + channel];
+    WithPixelFormat(tex->pixelFormat, [&](auto ts) {
+        typedef decltype(ts) TS;
+        f64 color[4] = {0, 0, 0, 1};
+        LoadPixel<TS>((const typename TS::T*)tex->buffer + x * tex->height * 4 + y * 4, tex->enableAlpha, &color[0], &color[1], &color[2], &color[3]);
+        *res = color[channel];
+    });
+}
+
+// The hit effect at time t only keeps the pixels whose noise is at least t, so one noise field serves every
+// frame of a seed. out gets width * height values laid out like the textures, column after column.
+void GetMilthmHitEffectNoise(f64 seed, i64 width, i64 height, f64* out) {
+    ParallelForRows(0, width, height, [&](i64 left, i64 right) {
+        for (i64 i = left; i < right; ++i) {
+            for (i64 j = 0; j < height; ++j) {
+                out[i * height + j] = ShaderUtils::circularNoise({(f64)i / width, (f64)j / height}, 50.0, seed);
+            }
+        }
+    });
 }
 
-Texture* CreateMilthmHitEffectTexture(Texture* mask, f64 seed, f64 t, f64 r, f64 g, f64 b) {
+Texture* CreateMilthmHitEffectTextureFromNoise(Texture* mask, f64* noise, f64 t, f64 r, f64 g, f64 b, i32 pixelFormat) {
     if (!mask->enableAlpha) return nullptr;
 
     Texture* tex = new Texture();
+
+    CountMemoryObject(MEMORY_KIND_TEXTURE, 1);
     tex->width = mask->width;
     tex->height = mask->height;
     tex->enableAlpha = true;
-    tex->buffer = new f64[mask->width * mask->height * 4];
-
-    for (i64 i = 0; i < mask->width; ++i) {
-        for (i64 j = 0; j < mask->height; ++j) {
-            f64 a;
-            GetMilthmHitEffectPixel(seed, t, (f64)i / mask->width, (f64)j / mask->height, &a);
-            f64 mask_a;
-            GetPixelChannel(mask, i, j, TEXTURE_CHANNEL_A, &mask_a);
-            tex->buffer[i * mask->height * 4 + j * 4 + 0] = r;
-            tex->buffer[i * mask->height * 4 + j * 4 + 1] = g;
-            tex->buffer[i * mask->height * 4 + j * 4 + 2] = b;
-            tex->buffer[i * mask->height * 4 + j * 4 + 3] = a * mask_a;
-        }
-    }
+    tex->pixelFormat = pixelFormat;
+    tex->buffer = CreatePixelBuffer(pixelFormat, mask->width * mask->height * 4, MEMORY_KIND_TEXTURE);
+
+    WithPixelFormat(pixelFormat, [&](auto ts) {
+        typedef decltype(ts) TS;
+        typename TS::T* dst = (typename TS::T*)tex->buffer;
+
+        ParallelForRows(0, mask->width, mask->height, [&](i64 left, i64 right) {
+            for (i64 i = left; i < right; ++i) {
+                for (i64 j = 0; j < mask->height; ++j) {
+                    f64 a = noise[i * mask->height + j] < t ? 0.0 : 1.0;
+                    f64 mask_a;
+                    GetPixelChannel(mask, i, j, TEXTURE_CHANNEL_A, &mask_a);
+                    StorePixel<TS>(dst + i * mask->height * 4 + j * 4, true, r, g, b, a * mask_a);
+                }
+            }
+        });
+    });
 
+    tex->opaque = IsTextureOpaque(tex);
     return tex;
 }
+
+Texture* CreateMilthmHitEffectTexture(Texture* mask, f64 seed, f64 t, f64 r, f64 g, f64 b, i32 pixelFormat) {
+    if (!mask->enableAlpha) return nullptr;
+
+    std::vector<f64> noise(mask->width * mask->height);
+    GetMilthmHitEffectNoise(seed, mask->width, mask->height, noise.data());
+    return CreateMilthmHitEffectTextureFromNoise(mask, noise.data(), t, r, g, b, pixelFormat);
+}
+
+// Draws the procedural texture shader over the rect (x, y, width, height), evaluated once per covered pixel
+// at the resolution it lands on instead of sampled from a pre-baked texture. mask is stretched over the rect
+// as by DrawTexture and its alpha scales the result. For PROCEDURAL_SHADER_MILTHM_HIT_EFFECT the color is
+// (r, g, b) wherever GetMilthmHitEffectPixel(seed, t) keeps the pixel, matching CreateMilthmHitEffectTexture.
+void DrawProceduralTexture(
+    RenderContext* ctx,
+    i32 shader,
+    Texture* mask,
+    f64 x, f64 y,
+    f64 width, f64 height,
+    f64 seed, f64 t,
+    f64 r, f64 g, f64 b,
+    i32 filter
+) {
+    if (width == 0 || height == 0 || shader != PROCEDURAL_SHADER_MILTHM_HIT_EFFECT) return;
+
+    Texture* src = mask;
+    if (filter & TEXTURE_FILTER_MIPMAP) src = GetTextureMipLevel(mask, GetTextureFootprint(ctx, mask->width / width, mask->height / height));
+    bool bilinear = filter & TEXTURE_FILTER_BILINEAR;
+
+    f64 inv[6];
+    GetInverseTransform(ctx, inv);
+
+    WithPixelFormats(ctx->pixelFormat, src->pixelFormat, [&](auto cs, auto ts) {
+        typedef decltype(cs) CS;
+        typedef decltype(ts) TS;
+
+        auto shade = [&](i64 j, i64 start, i64 end, f64* colors) {
+            f64 invX, invY;
+            TransformPointFromMatrix(inv, start, j, &invX, &invY);
+            f64 u = (invX - x) / width;
+            f64 v = (invY - y) / height;
+
+            for (i64 i = start; i < end; ++i, u += inv[0] / width, v += inv[1] / height) {
+                f64* c = colors + (i - start) * 4;
+                c[0] = r;
+                c[1] = g;
+                c[2] = b;
+                c[3] = 1;
+
+                f64 maskR, maskG, maskB;
+                SampleTexture<TS>(src, bilinear, u * src->width, v * src->height, &maskR, &maskG, &maskB, &c[3]);
+                if (c[3] == 0) continue;
+
+                // the baked textures store the noise transposed
+                f64 a;
+                GetMilthmHitEffectPixel(seed, t, v, u, &a);
+                c[3] *= a;
+            }
+        };
+
+        if (ctx->antiAlias) {
+            ForEachQuadCoverageRun(ctx, x, y, width, height, [&](i64 j, i64 start, i64 end, const f64* coverage, std::vector<f64>& colors) {
+                colors.resize((end - start) * 4);
+                shade(j, start, end, colors.data());
+                BlendSpanTextured<CS>(ctx, j, start, end, colors.data(), false, coverage);
+            });
+            return;
+        }
+
+        QuadSpans spans;
+        SetupQuadSpans(ctx, x, y, width, height, &spans);
+
+        ParallelForRows(spans.top, spans.bottom, spans.right - spans.left, [&](i64 bandTop, i64 bandBottom) {
+            std::vector<f64> colors((spans.right - spans.left) * 4);
+            for (i64 j = bandTop; j < bandBottom; ++j) {
+                i64 start, end;
+                f64 invX, invY;
+                if (!GetQuadSpan(&spans, j, &start, &end, &invX, &invY)) continue;
+
+                shade(j, start, end, colors.data());
+                BlendSpanTextured<CS>(ctx, j, start, end, colors.data(), false);
+            }
+        });
+    });
+}
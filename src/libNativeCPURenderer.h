@@ -6,16 +6,80 @@
 #define f64 double
 #define f32 float
 #define iu8 unsigned char
-#define LIB_NATIVE_CPU_RENDERER_VERSION 1
+#define LIB_NATIVE_CPU_RENDERER_VERSION 2
 #define TEXTURE_CHANNEL_R 0
 #define TEXTURE_CHANNEL_G 1
 #define TEXTURE_CHANNEL_B 2
 #define TEXTURE_CHANNEL_A 3
+#define PIXEL_FORMAT_F64 0
+#define PIXEL_FORMAT_F32 1
+#define PIXEL_FORMAT_U8_PREMULTIPLIED 2
+#define TEXTURE_FILTER_NEAREST 0
+#define TEXTURE_FILTER_BILINEAR 1
+#define TEXTURE_FILTER_MIPMAP 2
+#define COMMAND_SAVE_STATE 0
+#define COMMAND_RESTORE_STATE 1
+#define COMMAND_SET_TRANSFORM 2
+#define COMMAND_APPLY_TRANSFORM 3
+#define COMMAND_SCALE 4
+#define COMMAND_TRANSLATE 5
+#define COMMAND_ROTATE 6
+#define COMMAND_SET_COLOR_TRANSFORM 7
+#define COMMAND_APPLY_COLOR_TRANSFORM 8
+#define COMMAND_SET_COLOR 9
+#define COMMAND_FILL_COLOR 10
+#define COMMAND_SET_PIXEL 11
+#define COMMAND_APPLY_PIXEL 12
+#define COMMAND_DRAW_TEXTURE 13
+#define COMMAND_DRAW_SPLITTED_TEXTURE 14
+#define COMMAND_DRAW_RECT 15
+#define COMMAND_DRAW_LINE 16
+#define COMMAND_DRAW_CIRCLE 17
+#define COMMAND_DRAW_VERTICAL_GRD 18
+#define COMMAND_FILL_POLYGON 19
+#define COMMAND_DRAW_POLYLINE 20
+#define COMMAND_SET_ANTI_ALIAS 21
+#define COMMAND_DRAW_ELLIPSE 22
+#define COMMAND_DRAW_RING 23
+#define COMMAND_DRAW_ARC 24
+#define COMMAND_DRAW_LINEAR_GRADIENT 25
+#define COMMAND_DRAW_RADIAL_GRADIENT 26
+#define COMMAND_DRAW_SPRITE_BATCH 27
+#define COMMAND_DRAW_NINE_SLICE_TEXTURE 28
+#define COMMAND_DRAW_PROCEDURAL_TEXTURE 29
+#define VIDEO_CAP_IO_BUFFER_SIZE 65536
+#define GRADIENT_LUT_SIZE 1024
+#define SPRITE_BATCH_STRIDE 18
+#define PROCEDURAL_SHADER_MILTHM_HIT_EFFECT 0
+#define BUFFER_HEADER_SIZE 64
+#define BUFFER_POOL_DEFAULT_LIMIT (512L << 20)
+#define MEMORY_KIND_RENDER_CONTEXT 0
+#define MEMORY_KIND_TEXTURE 1
+#define MEMORY_KIND_AUDIO_CLIP 2
+#define MEMORY_KIND_VIDEO_CAP 3
+#define MEMORY_KIND_BYTES 4
+#define MEMORY_KIND_COUNT 5
+#define MEMORY_STATS_FIELDS 3
 
 #include <cmath>
+#include <algorithm>
 #include <stack>
+#include <deque>
 #include <cstring>
 #include <cstdio>
+#include <vector>
+#include <string>
+#include <thread>
+#include <mutex>
+#include <atomic>
+#include <functional>
+#include <condition_variable>
+#include <unordered_map>
+#include <new>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
 
 extern "C" {
     #include <libavcodec/avcodec.h>
@@ -27,16 +91,19 @@ extern "C" {
 struct RenderContextState {
     f64 transformMatrix[6];
     f64 colorTransform[4];
+    bool antiAlias;
 };
 
 struct RenderContext {
     i64 width;
     i64 height;
     bool enableAlpha;
-    f64 *buffer;
+    i32 pixelFormat;
+    void *buffer;
 
     f64 transformMatrix[6];
     f64 colorTransform[4];
+    bool antiAlias;
 
     std::stack<RenderContextState> stateStack;
 };
@@ -45,9 +112,21 @@ struct Texture {
     i64 width;
     i64 height;
     bool enableAlpha;
-    f64 *buffer;
+    i32 pixelFormat;
+    void *buffer;
+    bool sharedBuffer;
+    bool retainedBuffer;
+    void *mapping;
+    i64 mappingSize;
+    // every texel has alpha 1, shared buffers only count when they have no alpha since their pixels change
+    bool opaque;
+
+    std::vector<Texture*> mipmaps;
+    std::mutex mipmapMutex;
 };
 
+typedef i64 (*VideoCapWriteCallback)(const iu8* data, i64 size);
+
 struct VideoCap {
     i64 width;
     i64 height;
@@ -59,12 +138,28 @@ struct VideoCap {
     AVFrame* frame;
     AVPacket* packet;
     SwsContext* swsCtx;
+    AVDictionary* options;
+    AVDictionary* muxerOptions;
+    VideoCapWriteCallback writeCallback;
+    iu8* rgbBuffer;
+    i64 rgbBufferSize;
     i32 frameIndex;
 
     bool hasAudio;
     AVStream* aStream;
     AVCodecContext* aCodecCtx;
     i64 audioPts;
+
+    // async encoding: frames are copied into at most asyncFrames staging contexts and encoded by encoderThread
+    i64 asyncFrames;
+    std::vector<RenderContext*> stagingFrames;
+    std::vector<RenderContext*> freeFrames;
+    std::deque<RenderContext*> pendingFrames;
+    std::thread encoderThread;
+    std::mutex encoderMutex;
+    std::condition_variable encoderCv;
+    std::condition_variable stagingCv;
+    bool encoderStopping;
 };
 
 struct AudioClip {
@@ -73,6 +168,7 @@ struct AudioClip {
     i64 numFrames;
 
     f64 *buffer;
+    bool sharedBuffer;
 };
 
 struct WapperedBytes {
@@ -80,9 +176,47 @@ struct WapperedBytes {
     i64 size;
 };
 
+struct RenderThreadPool {
+    std::vector<std::thread> workers;
+    std::mutex dispatchMutex;
+    std::mutex mutex;
+    std::condition_variable wakeCv;
+    std::condition_variable doneCv;
+    bool stopping;
+    i64 generation;
+    i64 busyWorkers;
+
+    const std::function<void(i64, i64)>* job;
+    i64 jobTop;
+    i64 jobBottom;
+    i64 jobBandSize;
+    std::atomic<i64> nextBand;
+};
+
+// Header in front of every pooled buffer, BUFFER_HEADER_SIZE bytes so the data after it stays aligned.
+struct PooledBufferHeader {
+    i64 sizeClass;
+    std::atomic<i64> refs;
+    i32 kind;
+};
+
+struct MemoryCounters {
+    std::atomic<i64> liveBytes;
+    std::atomic<i64> peakBytes;
+    std::atomic<i64> objects;
+};
+
+struct BufferPool {
+    std::mutex mutex;
+    std::unordered_map<i64, std::vector<iu8*>> freeBlocks;
+    i64 pooledBytes;
+    i64 limit;
+};
+
 extern "C" {
     i64 GetBufferSize(RenderContext* ctx);
-    RenderContext* CreateRenderContext(i64 width, i64 height, bool enableAlpha);
+    i64 GetPixelFormatSize(i32 pixelFormat);
+    RenderContext* CreateRenderContext(i64 width, i64 height, bool enableAlpha, i32 pixelFormat);
     void DestroyRenderContext(RenderContext* ctx);
     VideoCap* CreateVideoCap(i64 width, i64 height, f64 frameRate);
     bool InitializeVideoCap(VideoCap* cap, const char* path, bool hasAudio, AudioClip* aClip, i64 aBitRate);
@@ -93,8 +227,8 @@ extern "C" {
     bool RestoreContextState(RenderContext* ctx);
     void GetBuffer(RenderContext* ctx, f64 *buffer);
     void GetBufferAsUInt8(RenderContext* ctx, iu8 *buffer);
-    Texture* CreateTexture(i64 width, i64 height, bool enableAlpha, f64 *buffer);
-    Texture* CreateTextureUInt8(i64 width, i64 height, bool enableAlpha, iu8 *buffer);
+    Texture* CreateTexture(i64 width, i64 height, bool enableAlpha, f64 *buffer, i32 pixelFormat);
+    Texture* CreateTextureUInt8(i64 width, i64 height, bool enableAlpha, iu8 *buffer, i32 pixelFormat);
     void DestroyTexture(Texture* tex);
     Texture* CreateTextureFromRenderContext(RenderContext* ctx);
     void SetTransform(RenderContext* ctx, f64 a, f64 b, f64 c, f64 d, f64 e, f64 f);
@@ -112,14 +246,19 @@ extern "C" {
     void SetColor(RenderContext* ctx, f64 r, f64 g, f64 b, f64 a);
     void GetColor(RenderContext* ctx, f64 x, f64 y, f64 *out_r, f64 *out_g, f64 *out_b, f64 *out_a);
     void FillColor(RenderContext* ctx, f64 r, f64 g, f64 b, f64 a);
-    void DrawTexture(RenderContext* ctx, Texture* tex, f64 x, f64 y, f64 width, f64 height);
+    void DrawTexture(RenderContext* ctx, Texture* tex, f64 x, f64 y, f64 width, f64 height, i32 filter);
     void DrawRect(RenderContext* ctx, f64 x, f64 y, f64 width, f64 height, f64 r, f64 g, f64 b, f64 a);
     void DrawLine(RenderContext* ctx, f64 x1, f64 y1, f64 x2, f64 y2, f64 width, f64 r, f64 g, f64 b, f64 a);
+    void FillPolygon(RenderContext* ctx, f64* points, i64 numPoints, f64 r, f64 g, f64 b, f64 a);
+    void DrawPolyline(RenderContext* ctx, f64* points, i64 numPoints, f64 width, bool closed, f64 r, f64 g, f64 b, f64 a);
     void DrawCircle(RenderContext* ctx, f64 x, f64 y, f64 radius, f64 r, f64 g, f64 b, f64 a);
     Texture* ResampleTexture(Texture* tex, i64 width, i64 height);
     i64 GetTextureWidth(Texture* tex);
     i64 GetTextureHeight(Texture* tex);
     bool GetTextureEnableAlpha(Texture* tex);
+    i32 GetTexturePixelFormat(Texture* tex);
+    i64 GetTextureMipLevels(Texture* tex);
+    i32 GetRenderContextPixelFormat(RenderContext* ctx);
     i64 GetAudioClipBufferSizeFromData(i64 numFrames, i64 channels);
     i64 GetAudioClipBufferSize(AudioClip* clip);
     AudioClip* CreateAudioClipFromBuffer(i64 sampleRate, i64 channels, i64 numFrames, f64 *buffer);
@@ -139,14 +278,46 @@ extern "C" {
     iu8* GetWapperedBytesDataPtr(WapperedBytes* bytes);
     i64 GetWapperedBytesDataSize(WapperedBytes* bytes);
     void ApplyVolumeGain(AudioClip* clip, f64 gain);
-    bool PutAudioIntoVideoCap(VideoCap* vCap, AudioClip* aClip, i64 bitRate);
     i64 GetVersion();
     void ApplyCutAudioClip(AudioClip* clip, i64 startFrame, i64 endFrame);
     void ApplySpeedAudioClip(AudioClip* clip, f64 speed);
     void DrawVerticalGrd(RenderContext* ctx, f64 x, f64 y, f64 width, f64 height, f64 top_r, f64 top_g, f64 top_b, f64 top_a, f64 bottom_r, f64 bottom_g, f64 bottom_b, f64 bottom_a);
-    void DrawSplittedTexture(RenderContext* ctx, Texture* tex, f64 x, f64 y, f64 width, f64 height, f64 uStart, f64 uEnd, f64 vStart, f64 vEnd);
+    void DrawSplittedTexture(RenderContext* ctx, Texture* tex, f64 x, f64 y, f64 width, f64 height, f64 uStart, f64 uEnd, f64 vStart, f64 vEnd, i32 filter);
     Texture* CreateTextureFromRenderContextShared(RenderContext* ctx);
     void ResizeRenderContext(RenderContext* ctx, i64 width, i64 height);
     void GetMilthmHitEffectPixel(f64 seed, f64 t, f64 x, f64 y, f64* a);
-    Texture* CreateMilthmHitEffectTexture(Texture* mask, f64 seed, f64 t, f64 r, f64 g, f64 b);
+    Texture* CreateMilthmHitEffectTexture(Texture* mask, f64 seed, f64 t, f64 r, f64 g, f64 b, i32 pixelFormat);
+    void SetRenderThreads(i64 n);
+    i64 GetRenderThreads();
+    bool ExecuteCommandBuffer(RenderContext* ctx, f64* commands, i64 size, Texture** textures, i64 numTextures);
+    void* GetRenderContextBuffer(RenderContext* ctx);
+    void* GetTextureBuffer(Texture* tex);
+    f64* GetAudioClipBuffer(AudioClip* clip);
+    Texture* CreateTextureFromBufferShared(i64 width, i64 height, bool enableAlpha, void *buffer, i32 pixelFormat);
+    AudioClip* CreateAudioClipFromBufferShared(i64 sampleRate, i64 channels, i64 numFrames, f64 *buffer);
+    void InvalidateTextureMipmaps(Texture* tex);
+    void SetVideoCapAsyncFrames(VideoCap* cap, i64 frames);
+    void SetVideoCapOption(VideoCap* cap, const char* key, const char* value);
+    void SetVideoCapMuxerOption(VideoCap* cap, const char* key, const char* value);
+    void SetVideoCapWriteCallback(VideoCap* cap, VideoCapWriteCallback callback);
+    void BlitLayer(RenderContext* ctx, RenderContext* layer);
+    void SetAntiAlias(RenderContext* ctx, bool enabled);
+    void DrawEllipse(RenderContext* ctx, f64 x, f64 y, f64 radiusX, f64 radiusY, f64 r, f64 g, f64 b, f64 a);
+    void DrawRing(RenderContext* ctx, f64 x, f64 y, f64 innerRadius, f64 outerRadius, f64 r, f64 g, f64 b, f64 a);
+    void DrawArc(RenderContext* ctx, f64 x, f64 y, f64 innerRadius, f64 outerRadius, f64 startAngle, f64 endAngle, f64 r, f64 g, f64 b, f64 a);
+    void DrawLinearGradient(RenderContext* ctx, f64 x, f64 y, f64 width, f64 height, f64 x0, f64 y0, f64 x1, f64 y1, f64* stops, i64 numStops);
+    void DrawRadialGradient(RenderContext* ctx, f64 x, f64 y, f64 width, f64 height, f64 cx, f64 cy, f64 radius, f64* stops, i64 numStops);
+    void DrawSpriteBatch(RenderContext* ctx, Texture* tex, f64* sprites, i64 count, i32 filter);
+    void DrawNineSliceTexture(RenderContext* ctx, Texture* tex, f64 x, f64 y, f64 width, f64 height, f64 srcLeft, f64 srcTop, f64 srcRight, f64 srcBottom, f64 dstLeft, f64 dstTop, f64 dstRight, f64 dstBottom, i32 filter);
+    void GetMilthmHitEffectNoise(f64 seed, i64 width, i64 height, f64* out);
+    Texture* CreateMilthmHitEffectTextureFromNoise(Texture* mask, f64* noise, f64 t, f64 r, f64 g, f64 b, i32 pixelFormat);
+    void DrawProceduralTexture(RenderContext* ctx, i32 shader, Texture* mask, f64 x, f64 y, f64 width, f64 height, f64 seed, f64 t, f64 r, f64 g, f64 b, i32 filter);
+    Texture* CreateTextureFromMappedFile(const char* path, i64 offset, i64 width, i64 height, bool enableAlpha, i32 pixelFormat);
+    void DestroyWapperedBytes(WapperedBytes* bytes);
+    void SetBufferPoolLimit(i64 bytes);
+    i64 GetBufferPoolSize();
+    void GetMemoryStats(i64* out);
+    void SetMemorySoftLimit(i64 bytes);
+    i64 GetMemorySoftLimit();
+    bool CheckMemoryLimit(i64 bytes);
 }
@@ -1,310 +1,800 @@
 from __future__ import annotations
 
+import array
+import concurrent.futures
 import ctypes
 import struct
 import math
+import os
+import re
 import typing
 import random
+import hashlib
+import mmap
+import io
+
+LIB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "libNativeCPURenderer.so")
+HEADER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "libNativeCPURenderer.h")
+
+# (restype, argtypes) of every function exported by libNativeCPURenderer.h, in header order
+SIGNATURES: dict[str, tuple[typing.Any, tuple[typing.Any, ...]]] = {
+    "GetBufferSize": (ctypes.c_long, (ctypes.c_void_p,)),
+    "GetPixelFormatSize": (ctypes.c_long, (ctypes.c_int,)),
+    "CreateRenderContext": (ctypes.c_void_p, (ctypes.c_long, ctypes.c_long, ctypes.c_bool, ctypes.c_int)),
+    "DestroyRenderContext": (None, (ctypes.c_void_p,)),
+    "CreateVideoCap": (ctypes.c_void_p, (ctypes.c_long, ctypes.c_long, ctypes.c_double)),
+    "InitializeVideoCap": (ctypes.c_bool, (ctypes.c_void_p, ctypes.c_char_p, ctypes.c_bool, ctypes.c_void_p, ctypes.c_long)),
+    "DestroyVideoCap": (None, (ctypes.c_void_p,)),
+    "PutRendererContextFrame": (None, (ctypes.c_void_p, ctypes.c_void_p)),
+    "ReleaseVideoCap": (None, (ctypes.c_void_p,)),
+    "SaveContextState": (None, (ctypes.c_void_p,)),
+    "RestoreContextState": (ctypes.c_bool, (ctypes.c_void_p,)),
+    "GetBuffer": (None, (ctypes.c_void_p, ctypes.c_void_p)),
+    "GetBufferAsUInt8": (None, (ctypes.c_void_p, ctypes.c_void_p)),
+    "CreateTexture": (ctypes.c_void_p, (ctypes.c_long, ctypes.c_long, ctypes.c_bool, ctypes.c_void_p, ctypes.c_int)),
+    "CreateTextureUInt8": (ctypes.c_void_p, (ctypes.c_long, ctypes.c_long, ctypes.c_bool, ctypes.c_void_p, ctypes.c_int)),
+    "DestroyTexture": (None, (ctypes.c_void_p,)),
+    "CreateTextureFromRenderContext": (ctypes.c_void_p, (ctypes.c_void_p,)),
+    "SetTransform": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "ApplyTransform": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "Scale": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double)),
+    "Translate": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double)),
+    "Rotate": (None, (ctypes.c_void_p, ctypes.c_double)),
+    "TransformPoint": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_void_p, ctypes.c_void_p)),
+    "GetTransform": (None, (ctypes.c_void_p, ctypes.c_void_p)),
+    "GetInverseTransform": (None, (ctypes.c_void_p, ctypes.c_void_p)),
+    "SetPixel": (ctypes.c_bool, (ctypes.c_void_p, ctypes.c_long, ctypes.c_long, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "ApplyPixel": (ctypes.c_bool, (ctypes.c_void_p, ctypes.c_long, ctypes.c_long, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "SetColorTransform": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "ApplyColorTransform": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "SetColor": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "GetColor": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p)),
+    "FillColor": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "DrawTexture": (None, (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_int)),
+    "DrawRect": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "DrawLine": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "FillPolygon": (None, (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_long, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "DrawPolyline": (None, (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_long, ctypes.c_double, ctypes.c_bool, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "DrawCircle": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "ResampleTexture": (ctypes.c_void_p, (ctypes.c_void_p, ctypes.c_long, ctypes.c_long)),
+    "GetTextureWidth": (ctypes.c_long, (ctypes.c_void_p,)),
+    "GetTextureHeight": (ctypes.c_long, (ctypes.c_void_p,)),
+    "GetTextureEnableAlpha": (ctypes.c_bool, (ctypes.c_void_p,)),
+    "GetTexturePixelFormat": (ctypes.c_int, (ctypes.c_void_p,)),
+    "GetTextureMipLevels": (ctypes.c_long, (ctypes.c_void_p,)),
+    "GetRenderContextPixelFormat": (ctypes.c_int, (ctypes.c_void_p,)),
+    "GetAudioClipBufferSizeFromData": (ctypes.c_long, (ctypes.c_long, ctypes.c_long)),
+    "GetAudioClipBufferSize": (ctypes.c_long, (ctypes.c_void_p,)),
+    "CreateAudioClipFromBuffer": (ctypes.c_void_p, (ctypes.c_long, ctypes.c_long, ctypes.c_long, ctypes.c_void_p)),
+    "CreateAudioClipFromInt16Buffer": (ctypes.c_void_p, (ctypes.c_long, ctypes.c_long, ctypes.c_long, ctypes.c_void_p)),
+    "CreateSilentAudioClip": (ctypes.c_void_p, (ctypes.c_long, ctypes.c_long, ctypes.c_long)),
+    "DestroyAudioClip": (None, (ctypes.c_void_p,)),
+    "CloneAudioClip": (ctypes.c_void_p, (ctypes.c_void_p,)),
+    "ApplyResampleAudioClip": (None, (ctypes.c_void_p, ctypes.c_long, ctypes.c_long)),
+    "ResampleAudioClipLike": (None, (ctypes.c_void_p, ctypes.c_void_p)),
+    "OverlayAudioClip": (ctypes.c_long, (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_long, ctypes.c_bool)),
+    "OverlayAudioClipSecond": (ctypes.c_long, (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_double, ctypes.c_bool)),
+    "SaveAudioClipAsWav": (ctypes.c_void_p, (ctypes.c_void_p,)),
+    "GetAudioClipSampleRate": (ctypes.c_long, (ctypes.c_void_p,)),
+    "GetAudioClipChannels": (ctypes.c_long, (ctypes.c_void_p,)),
+    "GetAudioClipNumFrames": (ctypes.c_long, (ctypes.c_void_p,)),
+    "GetAudioClipDuration": (ctypes.c_double, (ctypes.c_void_p,)),
+    "GetWapperedBytesDataPtr": (ctypes.c_void_p, (ctypes.c_void_p,)),
+    "GetWapperedBytesDataSize": (ctypes.c_long, (ctypes.c_void_p,)),
+    "ApplyVolumeGain": (None, (ctypes.c_void_p, ctypes.c_double)),
+    "GetVersion": (ctypes.c_long, ()),
+    "ApplyCutAudioClip": (None, (ctypes.c_void_p, ctypes.c_long, ctypes.c_long)),
+    "ApplySpeedAudioClip": (None, (ctypes.c_void_p, ctypes.c_double)),
+    "DrawVerticalGrd": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "DrawSplittedTexture": (None, (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_int)),
+    "CreateTextureFromRenderContextShared": (ctypes.c_void_p, (ctypes.c_void_p,)),
+    "ResizeRenderContext": (None, (ctypes.c_void_p, ctypes.c_long, ctypes.c_long)),
+    "GetMilthmHitEffectPixel": (None, (ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_void_p)),
+    "CreateMilthmHitEffectTexture": (ctypes.c_void_p, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_int)),
+    "SetRenderThreads": (None, (ctypes.c_long,)),
+    "GetRenderThreads": (ctypes.c_long, ()),
+    "ExecuteCommandBuffer": (ctypes.c_bool, (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_long, ctypes.c_void_p, ctypes.c_long)),
+    "GetRenderContextBuffer": (ctypes.c_void_p, (ctypes.c_void_p,)),
+    "GetTextureBuffer": (ctypes.c_void_p, (ctypes.c_void_p,)),
+    "GetAudioClipBuffer": (ctypes.c_void_p, (ctypes.c_void_p,)),
+    "CreateTextureFromBufferShared": (ctypes.c_void_p, (ctypes.c_long, ctypes.c_long, ctypes.c_bool, ctypes.c_void_p, ctypes.c_int)),
+    "CreateAudioClipFromBufferShared": (ctypes.c_void_p, (ctypes.c_long, ctypes.c_long, ctypes.c_long, ctypes.c_void_p)),
+    "InvalidateTextureMipmaps": (None, (ctypes.c_void_p,)),
+    "SetVideoCapAsyncFrames": (None, (ctypes.c_void_p, ctypes.c_long)),
+    "SetVideoCapOption": (None, (ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p)),
+    "SetVideoCapMuxerOption": (None, (ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p)),
+    "SetVideoCapWriteCallback": (None, (ctypes.c_void_p, ctypes.c_void_p)),
+    "BlitLayer": (None, (ctypes.c_void_p, ctypes.c_void_p)),
+    "SetAntiAlias": (None, (ctypes.c_void_p, ctypes.c_bool)),
+    "DrawEllipse": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "DrawRing": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "DrawArc": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)),
+    "DrawLinearGradient": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_void_p, ctypes.c_long)),
+    "DrawRadialGradient": (None, (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_void_p, ctypes.c_long)),
+    "DrawSpriteBatch": (None, (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_long, ctypes.c_int)),
+    "DrawNineSliceTexture": (None, (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_int)),
+    "GetMilthmHitEffectNoise": (None, (ctypes.c_double, ctypes.c_long, ctypes.c_long, ctypes.c_void_p)),
+    "CreateMilthmHitEffectTextureFromNoise": (ctypes.c_void_p, (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_int)),
+    "DrawProceduralTexture": (None, (ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_int)),
+    "CreateTextureFromMappedFile": (ctypes.c_void_p, (ctypes.c_char_p, ctypes.c_long, ctypes.c_long, ctypes.c_long, ctypes.c_bool, ctypes.c_int)),
+    "DestroyWapperedBytes": (None, (ctypes.c_void_p,)),
+    "SetBufferPoolLimit": (None, (ctypes.c_long,)),
+    "GetBufferPoolSize": (ctypes.c_long, ()),
+    "GetMemoryStats": (None, (ctypes.c_void_p,)),
+    "SetMemorySoftLimit": (None, (ctypes.c_long,)),
+    "GetMemorySoftLimit": (ctypes.c_long, ()),
+    "CheckMemoryLimit": (ctypes.c_bool, (ctypes.c_long,)),
+}
+
+# Loads the library on first use and binds each function from SIGNATURES once, later lookups hit the instance dict.
+class _Lib:
+    def __init__(self, path: str):
+        self._path = path
+        self._dll = None
+    
+    def __getattr__(self, name: str):
+        if name not in SIGNATURES:
+            raise AttributeError(f"{name} is not in SIGNATURES")
+        
+        if self._dll is None:
+            self._dll = ctypes.CDLL(self._path)
+
+        restype, argtypes = SIGNATURES[name]
+        func = getattr(self._dll, name)
+        func.restype = restype
+        func.argtypes = argtypes
+        setattr(self, name, func)
+        return func
+
+lib = _Lib(LIB_PATH)
+
+_HEADER_TYPES = {
+    "i64": ctypes.c_long,
+    "i32": ctypes.c_int,
+    "i16": ctypes.c_short,
+    "f64": ctypes.c_double,
+    "f32": ctypes.c_float,
+    "iu8": ctypes.c_ubyte,
+    "bool": ctypes.c_bool,
+    "void": None,
+    "VideoCapWriteCallback": ctypes.c_void_p,
+}
+
+def _header_type(decl: str):
+    decl = decl.strip()
+    if decl.startswith("const char"):
+        return ctypes.c_char_p
+    if "*" in decl or "[" in decl:
+        return ctypes.c_void_p
+    return _HEADER_TYPES[decl.split()[0]]
+
+def check_signatures(header_path: str = HEADER_PATH):
+    with open(header_path, "r", encoding="utf-8") as f:
+        header = f.read()
+
+    declared = {}
+    for ret, name, args in re.findall(r"^\s+(.+?)\s*\b(\w+)\((.*?)\);", header[header.rindex('extern "C" {'):], re.M):
+        declared[name] = (_header_type(ret), tuple(_header_type(arg) for arg in args.split(",") if arg.strip()))
+    
+    problems = []
+    for name, signature in declared.items():
+        if name not in SIGNATURES:
+            problems.append(f"{name} is declared in the header but missing from SIGNATURES")
+        elif SIGNATURES[name] != signature:
+            problems.append(f"{name} signature differs from the header")
+    
+    for name in SIGNATURES:
+        if name not in declared:
+            problems.append(f"{name} is in SIGNATURES but not declared in the header")
+    
+    # declared is not enough, inline or missing definitions only fail once called
+    dll = ctypes.CDLL(lib._path)
+    for name in SIGNATURES:
+        if not hasattr(dll, name):
+            problems.append(f"{name} is in SIGNATURES but not exported by the library")
+    
+    return problems
+
+VideoCapWriteCallback = ctypes.CFUNCTYPE(ctypes.c_long, ctypes.c_void_p, ctypes.c_long)
+
+# an mp4 written front to back, playable while it grows
+FRAGMENTED_MP4_MOVFLAGS = "frag_keyframe+empty_moov+default_base_moof"
+
+class PixelFormat:
+    F64 = 0
+    F32 = 1
+    U8_PREMULTIPLIED = 2
+
+# memoryview format and ctypes element of each pixel format's storage
+_PIXEL_FORMAT_ELEMENTS = {
+    PixelFormat.F64: ("d", ctypes.c_double),
+    PixelFormat.F32: ("f", ctypes.c_float),
+    PixelFormat.U8_PREMULTIPLIED: ("B", ctypes.c_ubyte),
+}
+
+_NUMPY_PIXEL_FORMATS = {
+    "float64": PixelFormat.F64,
+    "float32": PixelFormat.F32,
+    "uint8": PixelFormat.U8_PREMULTIPLIED,
+}
+
+# Writable view over native memory at address, the view keeps owner alive.
+def _native_view(owner: typing.Any, address: int, fmt: str, ctype: typing.Any, shape: tuple[int, ...]):
+    arr = (ctype * math.prod(shape)).from_address(address)
+    arr._owner = owner
+    return memoryview(arr).cast("B").cast(fmt, shape)
+
+# ctypes array sharing the memory of a writable, C-contiguous buffer of exactly nbytes.
+def _shared_buffer(data: typing.Any, nbytes: int):
+    view = memoryview(data)
+    if view.readonly or not view.c_contiguous:
+        raise ValueError("data must be a writable C-contiguous buffer")
+
+    if view.nbytes != nbytes:
+        raise ValueError("data size not match")
+    
+    return (ctypes.c_char * nbytes).from_buffer(view.cast("B"))
+
+class TextureFilter:
+    NEAREST = 0
+    BILINEAR = 1
+    MIPMAP = 2
 
-lib = ctypes.CDLL("./libNativeCPURenderer.so")
+class ProceduralShader:
+    MILTHM_HIT_EFFECT = 0
+
+# what memory_stats() counts separately, a shared texture's pixels stay with the context they came from
+class MemoryKind:
+    RENDER_CONTEXT = 0
+    TEXTURE = 1
+    AUDIO_CLIP = 2
+    VIDEO_CAP = 3
+    BYTES = 4
+
+_MEMORY_KIND_NAMES = ("render_context", "texture", "audio_clip", "video_cap", "bytes")
+_MEMORY_STATS_FIELDS = ("live_bytes", "peak_bytes", "objects")
+
+class MemoryLimitError(MemoryError):
+    pass
+
+# Raised before allocating when nbytes more would take the live bytes over set_memory_soft_limit().
+def _check_memory_limit(nbytes: int):
+    if not lib.CheckMemoryLimit(nbytes):
+        raise MemoryLimitError(f"allocating {nbytes} bytes would exceed the memory soft limit of {lib.GetMemorySoftLimit()} bytes")
+
+def _pixel_bytes(width: int, height: int, enable_alpha: bool, pixel_format: int):
+    return width * height * (4 if enable_alpha else 3) * lib.GetPixelFormatSize(pixel_format)
+
+# magic, library version, width, height and seed of a cached hit effect noise field, the f64 values follow
+_HIT_EFFECT_NOISE_MAGIC = b"MHENOISE"
+_HIT_EFFECT_NOISE_HEADER = struct.Struct("<8sqqqd")
 
 class Helpers:
     @staticmethod
     def get_wappered_bytes_data_ptr(bytes: int):
-        GetWapperedBytesDataPtr = lib.GetWapperedBytesDataPtr
-        GetWapperedBytesDataPtr.argtypes = (ctypes.c_void_p, )
-        GetWapperedBytesDataPtr.restype = ctypes.c_void_p
-
-        return GetWapperedBytesDataPtr(bytes)
+        return lib.GetWapperedBytesDataPtr(bytes)
     
     @staticmethod
     def get_wappered_bytes_data_size(bytes: int):
-        GetWapperedBytesDataSize = lib.GetWapperedBytesDataSize
-        GetWapperedBytesDataSize.argtypes = (ctypes.c_void_p, )
-        GetWapperedBytesDataSize.restype = ctypes.c_long
-
-        return GetWapperedBytesDataSize(bytes)
+        return lib.GetWapperedBytesDataSize(bytes)
     
     @staticmethod
     def wappered_bytes_to_python(bytes: int):
         ptr = Helpers.get_wappered_bytes_data_ptr(bytes)
         size = Helpers.get_wappered_bytes_data_size(bytes)
-        return ctypes.string_at(ptr, size)
+        data = ctypes.string_at(ptr, size)
+        lib.DestroyWapperedBytes(bytes)
+        return data
     
+    # Noise field behind every hit effect frame of seed, see GetMilthmHitEffectNoise. With cache_dir the field is
+    # kept there in a file named after what it depends on, and later calls map that file instead of generating it.
     @staticmethod
-    def create_milthm_hit_effect_textures(mask: Texture, n: int):
-        CreateMilthmHitEffectTexture = lib.CreateMilthmHitEffectTexture
-        CreateMilthmHitEffectTexture.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        CreateMilthmHitEffectTexture.restype = ctypes.c_void_p
-
-        seed = random.random()
+    def get_milthm_hit_effect_noise(width: int, height: int, seed: float, cache_dir: typing.Optional[str] = None):
+        size = width * height * 8
+        header = _HIT_EFFECT_NOISE_HEADER.pack(_HIT_EFFECT_NOISE_MAGIC, lib.GetVersion(), width, height, seed)
+
+        if cache_dir is None:
+            noise = (ctypes.c_double * (width * height))()
+            lib.GetMilthmHitEffectNoise(seed, width, height, noise)
+            return noise
+        
+        path = os.path.join(cache_dir, f"hiteffect-{hashlib.sha256(header).hexdigest()[:32]}.bin")
+        try:
+            with open(path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            
+            if len(mapped) == len(header) + size and mapped[:len(header)] == header:
+                return (ctypes.c_double * (width * height)).from_buffer(mapped, len(header))
+            mapped.close()
+        except (OSError, ValueError):
+            pass
+        
+        noise = Helpers.get_milthm_hit_effect_noise(width, height, seed)
+
+        # the cache is best effort, a failed write only costs the next run the generation
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(header)
+                f.write(noise)
+            os.replace(temp_path, path)
+        except OSError:
+            pass
+        
+        return noise
+    
+    @staticmethod
+    def create_milthm_hit_effect_textures(mask: Texture, n: int, pixel_format: int = PixelFormat.F64, seed: typing.Optional[float] = None, cache_dir: typing.Optional[str] = None):
+        if seed is None:
+            seed = random.random()
+        
+        noise = Helpers.get_milthm_hit_effect_noise(mask.width, mask.height, seed, cache_dir)
 
         texs = []
         for i in range(n):
+            _check_memory_limit(_pixel_bytes(mask.width, mask.height, True, pixel_format))
             p = i / (n - 1)
-            texs.append(PtrCreatedTexture(CreateMilthmHitEffectTexture(
-                mask._ptr, seed, p, 0x96 / 0xff, 0x90 / 0xff, 0xfd / 0xff
+            texs.append(PtrCreatedTexture(lib.CreateMilthmHitEffectTextureFromNoise(
+                mask._ptr, noise, p, 0x96 / 0xff, 0x90 / 0xff, 0xfd / 0xff, pixel_format
             )))
         
         return texs
 
 class RenderContext:
-    def __init__(self, width: int, height: int, enable_alpha: bool):
+    def __init__(self, width: int, height: int, enable_alpha: bool, pixel_format: int = PixelFormat.F64):
+        self._can_release = False
+        _check_memory_limit(_pixel_bytes(width, height, enable_alpha, pixel_format))
+
         self.width = width
         self.height = height
         self.enable_alpha = enable_alpha
+        self.pixel_format = pixel_format
         
-        CreateRenderContext = lib.CreateRenderContext
-        CreateRenderContext.argtypes = (ctypes.c_long, ctypes.c_long, ctypes.c_bool)
-        CreateRenderContext.restype = ctypes.c_void_p
-
-        self._ptr = lib.CreateRenderContext(width, height, enable_alpha)
+        self._ptr = lib.CreateRenderContext(width, height, enable_alpha, pixel_format)
         self._can_release = True
     
     def __del__(self):
         if not self._can_release:
             return
 
-        DestroyRenderContext = lib.DestroyRenderContext
-        DestroyRenderContext.argtypes = (ctypes.c_void_p,)
-        DestroyRenderContext.restype = None
-        DestroyRenderContext(self._ptr)
+        lib.DestroyRenderContext(self._ptr)
         self._ptr = 0
 
     def get_buffer_size(self):
-        GetBufferSize = lib.GetBufferSize
-        GetBufferSize.argtypes = (ctypes.c_void_p, )
-        GetBufferSize.restype = ctypes.c_long
-
-        return GetBufferSize(self._ptr)
-
-    def get_buffer(self):
-        GetBuffer = lib.GetBuffer
-        GetBuffer.argtypes = (ctypes.c_void_p, ctypes.c_void_p)
-        GetBuffer.restype = None
+        return lib.GetBufferSize(self._ptr)
 
+    # straight f64 color, written into out when given
+    def get_buffer(self, out: typing.Optional[array.array] = None):
         buffer_size = self.get_buffer_size()
-        buffer = (ctypes.c_double * buffer_size)()
-        GetBuffer(self._ptr, ctypes.byref(buffer))
-        return list(buffer)
+        if out is None:
+            out = array.array("d", bytes(buffer_size * 8))
+        elif out.typecode != "d" or len(out) != buffer_size:
+            raise ValueError("out must be an array('d') of get_buffer_size() items")
+        
+        lib.GetBuffer(self._ptr, out.buffer_info()[0])
+        return out
     
-    def get_buffer_as_uint8(self):
-        GetBufferAsUInt8 = lib.GetBufferAsUInt8
-        GetBufferAsUInt8.argtypes = (ctypes.c_void_p, ctypes.c_void_p)
-        GetBufferAsUInt8.restype = None
-
-        buffer = bytearray(self.get_buffer_size())
-        GetBufferAsUInt8(self._ptr, (ctypes.c_byte * len(buffer)).from_buffer(buffer))
+    # straight 8-bit color, written into out (any writable buffer) when given
+    def get_buffer_as_uint8(self, out: typing.Optional[typing.Any] = None):
+        buffer = bytearray(self.get_buffer_size()) if out is None else out
+        lib.GetBufferAsUInt8(self._ptr, _shared_buffer(buffer, self.get_buffer_size()))
         return buffer
     
+    # the context memory itself as (height, width, channels) in its pixel format, premultiplied for U8_PREMULTIPLIED.
+    # resize() reallocates it, views taken before then must not be used.
+    def get_buffer_view(self):
+        fmt, ctype = _PIXEL_FORMAT_ELEMENTS[self.pixel_format]
+        return _native_view(self, lib.GetRenderContextBuffer(self._ptr), fmt, ctype, (self.height, self.width, 4 if self.enable_alpha else 3))
+    
+    def as_numpy(self):
+        import numpy
+        return numpy.asarray(self.get_buffer_view())
+    
     def fill_color(self, r: float, g: float, b: float, a: float):
-        FillColor = lib.FillColor
-        FillColor.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        FillColor.restype = None
-
-        FillColor(self._ptr, r, g, b, a)
+        lib.FillColor(self._ptr, r, g, b, a)
     
-    def draw_texture(self, tex: Texture, x: float, y: float, w: float, h: float):
-        DrawTexture = lib.DrawTexture
-        DrawTexture.argtypes = (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        DrawTexture.restype = None
-
-        DrawTexture(self._ptr, tex._ptr, x, y, w, h)
+    def draw_texture(self, tex: Texture, x: float, y: float, w: float, h: float, filter: int = TextureFilter.MIPMAP):
+        lib.DrawTexture(self._ptr, tex._ptr, x, y, w, h, filter)
     
     def resize(self, width: int, height: int):
-        ResizeRenderContext = lib.ResizeRenderContext
-        ResizeRenderContext.argtypes = (ctypes.c_void_p, ctypes.c_long, ctypes.c_long)
-        ResizeRenderContext.restype = None
-        
-        ResizeRenderContext(self._ptr, width, height)
+        _check_memory_limit(_pixel_bytes(width, height, self.enable_alpha, self.pixel_format))
+        lib.ResizeRenderContext(self._ptr, width, height)
         self.width = width
         self.height = height
     
-    def draw_splitted_texture(self, tex: Texture, x: float, y: float, width: float, height: flaot, u_start: float, u_end: float, v_start: float, v_end: float):
-        DrawSplittedTexture = lib.DrawSplittedTexture
-        DrawSplittedTexture.argtypes = (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        DrawSplittedTexture.restype = None
-
-        DrawSplittedTexture(self._ptr, tex._ptr, x, y, width, height, u_start, u_end, v_start, v_end)
+    def draw_splitted_texture(self, tex: Texture, x: float, y: float, width: float, height: flaot, u_start: float, u_end: float, v_start: float, v_end: float, filter: int = TextureFilter.MIPMAP):
+        lib.DrawSplittedTexture(self._ptr, tex._ptr, x, y, width, height, u_start, u_end, v_start, v_end, filter)
 
     def apply_transform(self, a: float, b: float, c: float, d: float, e: float, f: float):
-        ApplyTransform = lib.ApplyTransform
-        ApplyTransform.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        ApplyTransform.restype = None
-        
-        ApplyTransform(self._ptr, a, b, c, d, e, f)
+        lib.ApplyTransform(self._ptr, a, b, c, d, e, f)
     
     def scale(self, sx: float, sy: float):
-        Scale = lib.Scale
-        Scale.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double)
-        Scale.restype = None
-        
-        Scale(self._ptr, sx, sy)
+        lib.Scale(self._ptr, sx, sy)
     
     def rotate(self, angle: float):
-        Rotate = lib.Rotate
-        Rotate.argtypes = (ctypes.c_void_p, ctypes.c_double)
-        Rotate.restype = None
-        
-        Rotate(self._ptr, angle)
+        lib.Rotate(self._ptr, angle)
     
     def translate(self, tx: float, ty: float):
-        Translate = lib.Translate
-        Translate.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double)
-        Translate.restype = None
-        
-        Translate(self._ptr, tx, ty)
+        lib.Translate(self._ptr, tx, ty)
     
     def rotate_degree(self, deg: float):
         self.rotate(deg * math.pi / 180)
     
     def save_state(self):
-        SaveContextState = lib.SaveContextState
-        SaveContextState.argtypes = (ctypes.c_void_p,)
-        SaveContextState.restype = None
-
-        SaveContextState(self._ptr)
+        lib.SaveContextState(self._ptr)
     
     def restore_state(self):
-        RestoreContextState = lib.RestoreContextState
-        RestoreContextState.argtypes = (ctypes.c_void_p,)
-        RestoreContextState.restype = None
+        lib.RestoreContextState(self._ptr)
+    
+    # identity transform and color transform, no anti-aliasing and an empty state stack
+    def reset_state(self):
+        while lib.RestoreContextState(self._ptr):
+            pass
 
-        RestoreContextState(self._ptr)
+        lib.SetTransform(self._ptr, 1, 0, 0, 1, 0, 0)
+        lib.SetColorTransform(self._ptr, 1, 1, 1, 1)
+        lib.SetAntiAlias(self._ptr, False)
+    
+    # edge coverage instead of the binary pixel test, saved and restored with the transforms
+    def set_anti_alias(self, enabled: bool):
+        lib.SetAntiAlias(self._ptr, enabled)
     
     def draw_line(self, x0: float, y0: float, x1: float, y1: float, width: float, r: float, g: float, b: float, a: float):
-        DrawLine = lib.DrawLine
-        DrawLine.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        DrawLine.restype = None
-
-        DrawLine(self._ptr, x0, y0, x1, y1, width, r, g, b, a)
+        lib.DrawLine(self._ptr, x0, y0, x1, y1, width, r, g, b, a)
+    
+    def fill_polygon(self, points: typing.Sequence[tuple[float, float]], r: float, g: float, b: float, a: float):
+        data = (ctypes.c_double * (len(points) * 2))(*(v for p in points for v in p))
+        lib.FillPolygon(self._ptr, data, len(points), r, g, b, a)
+    
+    def draw_polyline(self, points: typing.Sequence[tuple[float, float]], width: float, r: float, g: float, b: float, a: float, closed: bool = False):
+        data = (ctypes.c_double * (len(points) * 2))(*(v for p in points for v in p))
+        lib.DrawPolyline(self._ptr, data, len(points), width, closed, r, g, b, a)
     
     def draw_rect(self, x: float, y: float, width: float, height: float, r: float, g: float, b: float, a: float):
-        DrawRect = lib.DrawRect
-        DrawRect.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        DrawRect.restype = None
-
-        DrawRect(self._ptr, x, y, width, height, r, g, b, a)
+        lib.DrawRect(self._ptr, x, y, width, height, r, g, b, a)
     
     def get_transform(self):
-        GetTransform = lib.GetTransform
-        GetTransform.argtypes = (ctypes.c_void_p, ctypes.c_void_p)
-        GetTransform.restype = None
-
         out = (ctypes.c_double * 6)()
-        GetTransform(self._ptr, ctypes.byref(out))
+        lib.GetTransform(self._ptr, ctypes.byref(out))
         return tuple(out)
     
     def get_inverse_transform(self):
-        GetInverseTransform = lib.GetInverseTransform
-        GetInverseTransform.argtypes = (ctypes.c_void_p, ctypes.c_void_p)
-        GetInverseTransform.restype = None
-        
         out = (ctypes.c_double * 6)()
-        GetInverseTransform(self._ptr, ctypes.byref(out))
+        lib.GetInverseTransform(self._ptr, ctypes.byref(out))
         return tuple(out)
     
     def apply_pixel(self, x: int, y: int, r: float, g: float, b: float, a: float):
-        ApplyPixel = lib.ApplyPixel
-        ApplyPixel.argtypes = (ctypes.c_void_p, ctypes.c_long, ctypes.c_long, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        ApplyPixel.restype = None
-
-        ApplyPixel(self._ptr, x, y, r, g, b, a)
+        lib.ApplyPixel(self._ptr, x, y, r, g, b, a)
     
     def draw_circle(self, x: float, y: float, radius: float, r: float, g: float, b: float, a: float):
-        DrawCircle = lib.DrawCircle
-        DrawCircle.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        DrawCircle.restype = None
-
-        DrawCircle(self._ptr, x, y, radius, r, g, b, a)
+        lib.DrawCircle(self._ptr, x, y, radius, r, g, b, a)
+    
+    def draw_ellipse(self, x: float, y: float, radius_x: float, radius_y: float, r: float, g: float, b: float, a: float):
+        lib.DrawEllipse(self._ptr, x, y, radius_x, radius_y, r, g, b, a)
+    
+    def draw_ring(self, x: float, y: float, inner_radius: float, outer_radius: float, r: float, g: float, b: float, a: float):
+        lib.DrawRing(self._ptr, x, y, inner_radius, outer_radius, r, g, b, a)
+    
+    # angles in radians like rotate, inner_radius 0 draws a pie slice
+    def draw_arc(self, x: float, y: float, inner_radius: float, outer_radius: float, start_angle: float, end_angle: float, r: float, g: float, b: float, a: float):
+        lib.DrawArc(self._ptr, x, y, inner_radius, outer_radius, start_angle, end_angle, r, g, b, a)
     
     def set_transform(self, a: float, b: float, c: float, d: float, e: float, f: float):
-        SetTransform = lib.SetTransform
-        SetTransform.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        SetTransform.restype = None
-
-        SetTransform(self._ptr, a, b, c, d, e, f)
+        lib.SetTransform(self._ptr, a, b, c, d, e, f)
     
     def set_color_transform(self, r: float, g: float, b: float, a: float):
-        SetColorTransform = lib.SetColorTransform
-        SetColorTransform.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        SetColorTransform.restype = None
-
-        SetColorTransform(self._ptr, r, g, b, a)
+        lib.SetColorTransform(self._ptr, r, g, b, a)
     
     def apply_color_transform(self, r: float, g: float, b: float, a: float):
-        ApplyColorTransform = lib.ApplyColorTransform
-        ApplyColorTransform.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        ApplyColorTransform.restype = None
-
-        ApplyColorTransform(self._ptr, r, g, b, a)
+        lib.ApplyColorTransform(self._ptr, r, g, b, a)
     
     def set_pixel(self, x: int, y: int, r: float, g: float, b: float, a: float):
-        SetPixel = lib.SetPixel
-        SetPixel.argtypes = (ctypes.c_void_p, ctypes.c_long, ctypes.c_long, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        SetPixel.restype = None
-
-        SetPixel(self._ptr, x, y, r, g, b, a)
+        lib.SetPixel(self._ptr, x, y, r, g, b, a)
 
     def set_color(self, r: float, g: float, b: float, a: float):
-        SetColor = lib.SetColor
-        SetColor.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        SetColor.restype = None
-
-        SetColor(self._ptr, r, g, b, a)
+        lib.SetColor(self._ptr, r, g, b, a)
     
     def get_color(self, x: int, y: int):
-        GetColor = lib.GetColor
-        GetColor.argtypes = (ctypes.c_void_p, ctypes.c_long, ctypes.c_long, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p)
-        GetColor.restype = None
-
         out = (ctypes.c_double(), ctypes.c_double(), ctypes.c_double(), ctypes.c_double())
-        GetColor(self._ptr, x, y, ctypes.byref(out[0]), ctypes.byref(out[1]), ctypes.byref(out[2]), ctypes.byref(out[3]))
+        lib.GetColor(self._ptr, x, y, ctypes.byref(out[0]), ctypes.byref(out[1]), ctypes.byref(out[2]), ctypes.byref(out[3]))
         return tuple(map(lambda x: x.value, out))
     
     def draw_vertical_grd(self, x: float, y: float, width: float, height: float, top_r: float, top_g: float, top_b: float, top_a: float, bottom_r: float, bottom_g: float, bottom_b: float, bottom_a: float):
-        DrawVerticalGrd = lib.DrawVerticalGrd
-        DrawVerticalGrd.argtypes = (ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double)
-        DrawVerticalGrd.restype = None
-
-        DrawVerticalGrd(self._ptr, x, y, width, height, top_r, top_g, top_b, top_a, bottom_r, bottom_g, bottom_b, bottom_a)
+        lib.DrawVerticalGrd(self._ptr, x, y, width, height, top_r, top_g, top_b, top_a, bottom_r, bottom_g, bottom_b, bottom_a)
+    
+    # stops are (position, (r, g, b, a)) with positions along the gradient in [0, 1]
+    def draw_linear_gradient(self, x: float, y: float, width: float, height: float, x0: float, y0: float, x1: float, y1: float, stops: typing.Sequence[tuple[float, tuple[float, float, float, float]]]):
+        data = (ctypes.c_double * (len(stops) * 5))(*(v for p, c in stops for v in (p, *c)))
+        lib.DrawLinearGradient(self._ptr, x, y, width, height, x0, y0, x1, y1, data, len(stops))
     
+    def draw_radial_gradient(self, x: float, y: float, width: float, height: float, cx: float, cy: float, radius: float, stops: typing.Sequence[tuple[float, tuple[float, float, float, float]]]):
+        data = (ctypes.c_double * (len(stops) * 5))(*(v for p, c in stops for v in (p, *c)))
+        lib.DrawRadialGradient(self._ptr, x, y, width, height, cx, cy, radius, data, len(stops))
+    
+    # the part of the rect between the first and the last step, in one pass
     def draw_vertical_mut_grd(self, x: float, y: float, width: float, height: float, steps: list[tuple[tuple[float, float, float, float, float]]]):
-        for i, (p, s) in enumerate(steps):
-            if i == len(steps) - 1:
-                break
+        if len(steps) < 2:
+            return
 
-            np, ns = steps[i + 1]
-            ty = y + height * p
-            theight = height * (np - p)
-            self.draw_vertical_grd(x, ty, width, theight, s[0], s[1], s[2], s[3], ns[0], ns[1], ns[2], ns[3])
+        top, bottom = steps[0][0], steps[-1][0]
+        self.draw_linear_gradient(x, y + height * top, width, height * (bottom - top), x, y, x, y + height, steps)
 
     def as_texure(self):
-        CreateTextureFromRenderContext = lib.CreateTextureFromRenderContext
-        CreateTextureFromRenderContext.argtypes = (ctypes.c_void_p,)
-        CreateTextureFromRenderContext.restype = ctypes.c_void_p
-
-        return PtrCreatedTexture(CreateTextureFromRenderContext(self._ptr))
+        _check_memory_limit(_pixel_bytes(self.width, self.height, self.enable_alpha, self.pixel_format))
+        return PtrCreatedTexture(lib.CreateTextureFromRenderContext(self._ptr))
     
     def as_texture_shared(self):
-        CreateTextureFromRenderContextShared = lib.CreateTextureFromRenderContextShared
-        CreateTextureFromRenderContextShared.argtypes = (ctypes.c_void_p,)
-        CreateTextureFromRenderContextShared.restype = ctypes.c_void_p
-
-        res = PtrCreatedTexture(CreateTextureFromRenderContextShared(self._ptr))
-        res._can_release = False
-        return res
+        return PtrCreatedTexture(lib.CreateTextureFromRenderContextShared(self._ptr))
     
     def as_pilimg(self):
         from PIL import Image
         return Image.frombytes("RGBA", (self.width, self.height), self.get_buffer_as_uint8())
+    
+    def draw_sprite_batch(self, batch: SpriteBatch):
+        sprites, size = batch.sprites.buffer_info()
+        lib.DrawSpriteBatch(self._ptr, batch.texture._ptr, sprites, len(batch), batch.filter)
+    
+    # evaluates shader for every covered pixel at the size it is drawn, mask alpha is stretched over the rect
+    def draw_procedural_texture(self, shader: int, mask: Texture, x: float, y: float, width: float, height: float, seed: float, t: float, r: float, g: float, b: float, filter: int = TextureFilter.MIPMAP):
+        lib.DrawProceduralTexture(self._ptr, shader, mask._ptr, x, y, width, height, seed, t, r, g, b, filter)
+    
+    # borders are src_* texels of tex drawn dst_* wide, zero top and bottom give a horizontal three-slice
+    def draw_nine_slice_texture(self, tex: Texture, x: float, y: float, width: float, height: float, src_left: float, src_top: float, src_right: float, src_bottom: float, dst_left: float, dst_top: float, dst_right: float, dst_bottom: float, filter: int = TextureFilter.MIPMAP):
+        lib.DrawNineSliceTexture(self._ptr, tex._ptr, x, y, width, height, src_left, src_top, src_right, src_bottom, dst_left, dst_top, dst_right, dst_bottom, filter)
+    
+    # copies layer over this context as is, see Layer
+    def blit_layer(self, layer: RenderContext):
+        lib.BlitLayer(self._ptr, layer._ptr)
+    
+    def execute_command_buffer(self, buffer: CommandBuffer):
+        commands, size = buffer.commands.buffer_info()
+        textures = (ctypes.c_void_p * len(buffer.textures))(*(tex._ptr for tex in buffer.textures))
+        if not lib.ExecuteCommandBuffer(self._ptr, commands, size, textures, len(buffer.textures)):
+            raise ValueError("malformed command buffer")
+
+# Offscreen context for content that stays the same across frames. update() redraws it only when its key
+# changes, frames then start with ctx.blit_layer(layer.context) instead of repeating the draws. Each redraw
+# allocates a new context, so calls recorded by MultiThreadedVideoRenderContextPreparer keep the old content.
+class Layer:
+    def __init__(self, width: int, height: int, enable_alpha: bool, pixel_format: int = PixelFormat.F64):
+        self.width = width
+        self.height = height
+        self.enable_alpha = enable_alpha
+        self.pixel_format = pixel_format
+        self.context = None
+        self._key = None
+    
+    # draw gets a context cleared to transparent black with no transform, returns whether it was called
+    def update(self, key: typing.Hashable, draw: typing.Callable[[RenderContext], typing.Any]):
+        if self.context is not None and key == self._key:
+            return False
+        
+        ctx = RenderContext(self.width, self.height, self.enable_alpha, self.pixel_format)
+        ctx.set_color(0, 0, 0, 0)
+        draw(ctx)
+        ctx.reset_state()
+
+        self.context = ctx
+        self._key = key
+        return True
+    
+    def invalidate(self):
+        self.context = None
+
+# Quads of one texture collected for a single RenderContext.draw_sprite_batch call. Every sprite carries its own
+# transform on top of the context's and a tint multiplied into the color transform, so there is no
+# save_state / restore_state per sprite. MultiThreadedVideoRenderContextPreparer replays the batch later, so
+# start a new one rather than clearing a batch that was drawn there.
+class SpriteBatch:
+    STRIDE = 18
+
+    def __init__(self, texture: Texture, filter: int = TextureFilter.MIPMAP):
+        self.texture = texture
+        self.filter = filter
+        self.sprites = array.array("d")
+    
+    def __len__(self):
+        return len(self.sprites) // self.STRIDE
+    
+    def clear(self):
+        del self.sprites[:]
+    
+    def add(
+        self,
+        x: float, y: float, width: float, height: float,
+        u_start: float = 0.0, u_end: float = 1.0, v_start: float = 0.0, v_end: float = 1.0,
+        transform: tuple[float, float, float, float, float, float] = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0),
+        tint: tuple[float, float, float, float] = (1.0, 1.0, 1.0, 1.0)
+    ):
+        self.sprites.extend((*transform, x, y, width, height, u_start, u_end, v_start, v_end, *tint))
+
+class Command:
+    SAVE_STATE = 0
+    RESTORE_STATE = 1
+    SET_TRANSFORM = 2
+    APPLY_TRANSFORM = 3
+    SCALE = 4
+    TRANSLATE = 5
+    ROTATE = 6
+    SET_COLOR_TRANSFORM = 7
+    APPLY_COLOR_TRANSFORM = 8
+    SET_COLOR = 9
+    FILL_COLOR = 10
+    SET_PIXEL = 11
+    APPLY_PIXEL = 12
+    DRAW_TEXTURE = 13
+    DRAW_SPLITTED_TEXTURE = 14
+    DRAW_RECT = 15
+    DRAW_LINE = 16
+    DRAW_CIRCLE = 17
+    DRAW_VERTICAL_GRD = 18
+    FILL_POLYGON = 19
+    DRAW_POLYLINE = 20
+    SET_ANTI_ALIAS = 21
+    DRAW_ELLIPSE = 22
+    DRAW_RING = 23
+    DRAW_ARC = 24
+    DRAW_LINEAR_GRADIENT = 25
+    DRAW_RADIAL_GRADIENT = 26
+    DRAW_SPRITE_BATCH = 27
+    DRAW_NINE_SLICE_TEXTURE = 28
+    DRAW_PROCEDURAL_TEXTURE = 29
+
+# Records RenderContext calls into one packed f64 array that RenderContext.execute_command_buffer replays natively,
+# the transform is mirrored with the native arithmetic so get_transform needs no call into the library.
+class CommandBuffer:
+    def __init__(self, transform: tuple[float, float, float, float, float, float] = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)):
+        self.initial_transform = tuple(transform)
+        self.clear()
+    
+    def clear(self):
+        self.commands = array.array("d")
+        self.textures: list[Texture] = []
+        self._texture_indices: dict[int, int] = {}
+        self._transform = list(self.initial_transform)
+        self._state_stack: list[list[float]] = []
+    
+    def _push(self, *values: float):
+        self.commands.extend(values)
+    
+    def _texture_index(self, tex: Texture):
+        index = self._texture_indices.get(tex._ptr)
+        if index is None:
+            index = self._texture_indices[tex._ptr] = len(self.textures)
+            self.textures.append(tex)
+        return index
+    
+    def _apply_transform(self, a: float, b: float, c: float, d: float, e: float, f: float):
+        old = self._transform
+        self._transform = [
+            old[0] * a + old[2] * b,
+            old[1] * a + old[3] * b,
+            old[0] * c + old[2] * d,
+            old[1] * c + old[3] * d,
+            old[0] * e + old[2] * f + old[4],
+            old[1] * e + old[3] * f + old[5],
+        ]
+    
+    def fill_color(self, r: float, g: float, b: float, a: float):
+        self._push(Command.FILL_COLOR, r, g, b, a)
+    
+    def draw_texture(self, tex: Texture, x: float, y: float, w: float, h: float, filter: int = TextureFilter.MIPMAP):
+        self._push(Command.DRAW_TEXTURE, self._texture_index(tex), x, y, w, h, filter)
+    
+    def draw_splitted_texture(self, tex: Texture, x: float, y: float, width: float, height: float, u_start: float, u_end: float, v_start: float, v_end: float, filter: int = TextureFilter.MIPMAP):
+        self._push(Command.DRAW_SPLITTED_TEXTURE, self._texture_index(tex), x, y, width, height, u_start, u_end, v_start, v_end, filter)
+    
+    def apply_transform(self, a: float, b: float, c: float, d: float, e: float, f: float):
+        self._push(Command.APPLY_TRANSFORM, a, b, c, d, e, f)
+        self._apply_transform(a, b, c, d, e, f)
+    
+    def scale(self, sx: float, sy: float):
+        self._push(Command.SCALE, sx, sy)
+        self._apply_transform(sx, 0, 0, sy, 0, 0)
+    
+    def rotate(self, angle: float):
+        self._push(Command.ROTATE, angle)
+        s, c = math.sin(angle), math.cos(angle)
+        self._apply_transform(c, s, -s, c, 0, 0)
+    
+    def translate(self, tx: float, ty: float):
+        self._push(Command.TRANSLATE, tx, ty)
+        self._apply_transform(1, 0, 0, 1, tx, ty)
+    
+    rotate_degree = RenderContext.rotate_degree
+    
+    def save_state(self):
+        self._push(Command.SAVE_STATE)
+        self._state_stack.append(self._transform)
+    
+    def restore_state(self):
+        self._push(Command.RESTORE_STATE)
+        if self._state_stack:
+            self._transform = self._state_stack.pop()
+    
+    def set_transform(self, a: float, b: float, c: float, d: float, e: float, f: float):
+        self._push(Command.SET_TRANSFORM, a, b, c, d, e, f)
+        self._transform = [a, b, c, d, e, f]
+    
+    def get_transform(self):
+        return tuple(self._transform)
+    
+    def set_color_transform(self, r: float, g: float, b: float, a: float):
+        self._push(Command.SET_COLOR_TRANSFORM, r, g, b, a)
+    
+    def apply_color_transform(self, r: float, g: float, b: float, a: float):
+        self._push(Command.APPLY_COLOR_TRANSFORM, r, g, b, a)
+    
+    def set_anti_alias(self, enabled: bool):
+        self._push(Command.SET_ANTI_ALIAS, enabled)
+    
+    def set_color(self, r: float, g: float, b: float, a: float):
+        self._push(Command.SET_COLOR, r, g, b, a)
+    
+    def set_pixel(self, x: int, y: int, r: float, g: float, b: float, a: float):
+        self._push(Command.SET_PIXEL, x, y, r, g, b, a)
+    
+    def apply_pixel(self, x: int, y: int, r: float, g: float, b: float, a: float):
+        self._push(Command.APPLY_PIXEL, x, y, r, g, b, a)
+    
+    def draw_line(self, x0: float, y0: float, x1: float, y1: float, width: float, r: float, g: float, b: float, a: float):
+        self._push(Command.DRAW_LINE, x0, y0, x1, y1, width, r, g, b, a)
+    
+    def fill_polygon(self, points: typing.Sequence[tuple[float, float]], r: float, g: float, b: float, a: float):
+        self._push(Command.FILL_POLYGON, len(points), *(v for p in points for v in p), r, g, b, a)
+    
+    def draw_polyline(self, points: typing.Sequence[tuple[float, float]], width: float, r: float, g: float, b: float, a: float, closed: bool = False):
+        self._push(Command.DRAW_POLYLINE, len(points), width, closed, *(v for p in points for v in p), r, g, b, a)
+    
+    def draw_rect(self, x: float, y: float, width: float, height: float, r: float, g: float, b: float, a: float):
+        self._push(Command.DRAW_RECT, x, y, width, height, r, g, b, a)
+    
+    def draw_circle(self, x: float, y: float, radius: float, r: float, g: float, b: float, a: float):
+        self._push(Command.DRAW_CIRCLE, x, y, radius, r, g, b, a)
+    
+    def draw_ellipse(self, x: float, y: float, radius_x: float, radius_y: float, r: float, g: float, b: float, a: float):
+        self._push(Command.DRAW_ELLIPSE, x, y, radius_x, radius_y, r, g, b, a)
+    
+    def draw_ring(self, x: float, y: float, inner_radius: float, outer_radius: float, r: float, g: float, b: float, a: float):
+        self._push(Command.DRAW_RING, x, y, inner_radius, outer_radius, r, g, b, a)
+    
+    def draw_arc(self, x: float, y: float, inner_radius: float, outer_radius: float, start_angle: float, end_angle: float, r: float, g: float, b: float, a: float):
+        self._push(Command.DRAW_ARC, x, y, inner_radius, outer_radius, start_angle, end_angle, r, g, b, a)
+    
+    def draw_vertical_grd(self, x: float, y: float, width: float, height: float, top_r: float, top_g: float, top_b: float, top_a: float, bottom_r: float, bottom_g: float, bottom_b: float, bottom_a: float):
+        self._push(Command.DRAW_VERTICAL_GRD, x, y, width, height, top_r, top_g, top_b, top_a, bottom_r, bottom_g, bottom_b, bottom_a)
+    
+    def draw_linear_gradient(self, x: float, y: float, width: float, height: float, x0: float, y0: float, x1: float, y1: float, stops: typing.Sequence[tuple[float, tuple[float, float, float, float]]]):
+        self._push(Command.DRAW_LINEAR_GRADIENT, len(stops), x, y, width, height, x0, y0, x1, y1, *(v for p, c in stops for v in (p, *c)))
+    
+    def draw_radial_gradient(self, x: float, y: float, width: float, height: float, cx: float, cy: float, radius: float, stops: typing.Sequence[tuple[float, tuple[float, float, float, float]]]):
+        self._push(Command.DRAW_RADIAL_GRADIENT, len(stops), x, y, width, height, cx, cy, radius, *(v for p, c in stops for v in (p, *c)))
+    
+    draw_vertical_mut_grd = RenderContext.draw_vertical_mut_grd
+    
+    def draw_sprite_batch(self, batch: SpriteBatch):
+        self._push(Command.DRAW_SPRITE_BATCH, self._texture_index(batch.texture), batch.filter, len(batch))
+        self.commands.extend(batch.sprites)
+    
+    def draw_nine_slice_texture(self, tex: Texture, x: float, y: float, width: float, height: float, src_left: float, src_top: float, src_right: float, src_bottom: float, dst_left: float, dst_top: float, dst_right: float, dst_bottom: float, filter: int = TextureFilter.MIPMAP):
+        self._push(Command.DRAW_NINE_SLICE_TEXTURE, self._texture_index(tex), x, y, width, height, src_left, src_top, src_right, src_bottom, dst_left, dst_top, dst_right, dst_bottom, filter)
+    
+    def draw_procedural_texture(self, shader: int, mask: Texture, x: float, y: float, width: float, height: float, seed: float, t: float, r: float, g: float, b: float, filter: int = TextureFilter.MIPMAP):
+        self._push(Command.DRAW_PROCEDURAL_TEXTURE, self._texture_index(mask), shader, x, y, width, height, seed, t, r, g, b, filter)
 
 class MultiThreadedVideoRenderContextPreparer(RenderContext):
-    def __init__(self, v_cap: VideoCap, *args, **kwargs):
+    # Records drawing calls per frame and replays block_size frames at a time, each into its own context on its
+    # own thread (ctypes releases the GIL), feeding v_cap in frame order. Every frame starts from reset_state(),
+    # so frames must not rely on state or pixels left by the previous one.
+    def __init__(self, v_cap: VideoCap, *args, block_size: int = 0, **kwargs):
         super().__init__(*args, **kwargs)
-        self.frames = []
+        self.frames = [[]]
         self.v_cap = v_cap
-        self.end_of_frame()
+        self.block_size = block_size if block_size > 0 else (os.cpu_count() or 1)
+        self._ctxs = []
+        self._executor = None
+        self._immediate = False
 
         proxy_methods = (
             "fill_color",
@@ -318,6 +808,8 @@ class MultiThreadedVideoRenderContextPreparer(RenderContext):
             "save_state",
             "restore_state",
             "draw_line",
+            "fill_polygon",
+            "draw_polyline",
             "draw_rect",
             "apply_pixel",
             "draw_circle",
@@ -326,9 +818,19 @@ class MultiThreadedVideoRenderContextPreparer(RenderContext):
             "apply_color_transform",
             "set_pixel",
             "set_color",
-            "get_color",
             "draw_vertical_grd",
-            "draw_vertical_mut_grd"
+            "draw_vertical_mut_grd",
+            "execute_command_buffer",
+            "blit_layer",
+            "set_anti_alias",
+            "draw_ellipse",
+            "draw_ring",
+            "draw_arc",
+            "draw_linear_gradient",
+            "draw_radial_gradient",
+            "draw_sprite_batch",
+            "draw_nine_slice_texture",
+            "draw_procedural_texture"
         )
 
         call_immediate_methods = (
@@ -347,83 +849,152 @@ class MultiThreadedVideoRenderContextPreparer(RenderContext):
         for method_name in proxy_methods:
             def dec(name: str):
                 def wappered(*args, **kwargs):
+                    # calls made by an immediate method (rotate_degree -> rotate) are already covered by its record
+                    if self._immediate:
+                        return getattr(RenderContext, name)(self, *args, **kwargs)
+                    
                     self.frames[-1].append((name, args, kwargs))
 
                     if name in call_immediate_methods:
-                        getattr(RenderContext, name)(self, *args, **kwargs)
+                        self._immediate = True
+                        try:
+                            getattr(RenderContext, name)(self, *args, **kwargs)
+                        finally:
+                            self._immediate = False
                 
                 setattr(self, method_name, wappered)
             
             dec(method_name)
     
     def end_of_frame(self):
+        self.reset_state()
         self.frames.append([])
+
+        if len(self.frames) > self.block_size:
+            self._render_frames()
+    
+    def resize(self, width: int, height: int):
+        self._render_frames()
+        super().resize(width, height)
     
+    # pixels are only drawn when recorded frames are replayed on other contexts, this one has none to read
+    def get_color(self, x: int, y: int):
+        raise RuntimeError("get_color() cannot read pixels of a frame that is still being recorded")
+    
+    # renders every recorded frame, call once after the last end_of_frame() and before releasing v_cap
     def renderer(self):
-        block_size = 60
-        ctxs = [RenderContext(self.width, self.height, self.enable_alpha) for _ in range(block_size)]
+        if self.frames[-1]:
+            self.end_of_frame()
+        
+        self._render_frames()
 
-        def runner():
-            pass
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        
+        self._ctxs = []
+    
+    @staticmethod
+    def _replay(ctx: RenderContext, calls: list):
+        ctx.reset_state()
+        for name, args, kwargs in calls:
+            getattr(RenderContext, name)(ctx, *args, **kwargs)
+
+    # replays the finished frames and keeps only the one being recorded
+    def _render_frames(self):
+        frames = self.frames[:-1]
+        self.frames = self.frames[-1:]
+        
+        self._ctxs = [ctx for ctx in self._ctxs if (ctx.width, ctx.height) == (self.width, self.height)]
+        while len(self._ctxs) < self.block_size:
+            self._ctxs.append(RenderContext(self.width, self.height, self.enable_alpha, self.pixel_format))
+        
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.block_size)
+
+        for i in range(0, len(frames), self.block_size):
+            block = frames[i:i + self.block_size]
+            futures = [self._executor.submit(self._replay, ctx, calls) for ctx, calls in zip(self._ctxs, block)]
+
+            # frames are encoded as soon as they finish in order, while later ones of the block still render
+            for ctx, future in zip(self._ctxs, futures):
+                future.result()
+                self.v_cap.put_renderer_context_frame(ctx)
     
 class Texture:
-    def __init__(self, width: int, height: int, enableAlpha: bool, data: typing.ByteString, is_uint8: bool = True):
+    def __init__(self, width: int, height: int, enableAlpha: bool, data: typing.ByteString, is_uint8: bool = True, pixel_format: int = PixelFormat.F64):
+        self._ptr = 0
         if width * height * (3 if not enableAlpha else 4) * (1 if is_uint8 else 8) != len(data):
             raise ValueError("data size not match")
+        
+        _check_memory_limit(_pixel_bytes(width, height, enableAlpha, pixel_format))
 
         self.width = width
         self.height = height
         self.enableAlpha = enableAlpha
+        self.pixel_format = pixel_format
         
         data = bytearray(data)
 
         if is_uint8:
-            CreateTextureUInt8 = lib.CreateTextureUInt8
-            CreateTextureUInt8.argtypes = (ctypes.c_long, ctypes.c_long, ctypes.c_bool, ctypes.c_void_p)
-            CreateTextureUInt8.restype = ctypes.c_void_p
-
-            self._ptr = CreateTextureUInt8(width, height, enableAlpha, (ctypes.c_byte * len(data)).from_buffer(data))
+            self._ptr = lib.CreateTextureUInt8(width, height, enableAlpha, (ctypes.c_byte * len(data)).from_buffer(data), pixel_format)
         else:
-            CreateTexture = lib.CreateTexture
-            CreateTexture.argtypes = (ctypes.c_long, ctypes.c_long, ctypes.c_bool, ctypes.c_void_p)
-            CreateTexture.restype = ctypes.c_void_p
-
-            self._ptr = CreateTexture(width, height, enableAlpha, (ctypes.c_double * len(data) // 8).from_buffer(data))
+            self._ptr = lib.CreateTexture(width, height, enableAlpha, (ctypes.c_double * (len(data) // 8)).from_buffer(data), pixel_format)
         
+    # 0 when __init__ raised before the texture was created
     def __del__(self):
-        DestroyTexture = lib.DestroyTexture
-        DestroyTexture.argtypes = (ctypes.c_void_p,)
-        DestroyTexture.restype = None
-
-        DestroyTexture(self._ptr)
+        if self._ptr:
+            lib.DestroyTexture(self._ptr)
     
     def _update_props(self):
-        GetTextureWidth = lib.GetTextureWidth
-        GetTextureWidth.argtypes = (ctypes.c_void_p,)
-        GetTextureWidth.restype = ctypes.c_long
-
-        GetTextureHeight = lib.GetTextureHeight
-        GetTextureHeight.argtypes = (ctypes.c_void_p,)
-        GetTextureHeight.restype = ctypes.c_long
-
-        GetTextureEnableAlpha = lib.GetTextureEnableAlpha
-        GetTextureEnableAlpha.argtypes = (ctypes.c_void_p,)
-        GetTextureEnableAlpha.restype = ctypes.c_bool
-
-        self.width = GetTextureWidth(self._ptr)
-        self.height = GetTextureHeight(self._ptr)
-        self.enableAlpha = GetTextureEnableAlpha(self._ptr)
+        self.width = lib.GetTextureWidth(self._ptr)
+        self.height = lib.GetTextureHeight(self._ptr)
+        self.enableAlpha = lib.GetTextureEnableAlpha(self._ptr)
+        self.pixel_format = lib.GetTexturePixelFormat(self._ptr)
     
     def resample(self, width: int, height: int):
-        ResampleTexture = lib.ResampleTexture
-        ResampleTexture.argtypes = (ctypes.c_void_p, ctypes.c_long, ctypes.c_long)
-        ResampleTexture.restype = ctypes.c_void_p
-
-        new = ResampleTexture(self._ptr, width, height)
+        _check_memory_limit(_pixel_bytes(width, height, self.enableAlpha, self.pixel_format))
+        new = lib.ResampleTexture(self._ptr, width, height)
         return PtrCreatedTexture(new)
     
+    def get_mip_levels(self):
+        return lib.GetTextureMipLevels(self._ptr)
+    
+    # the texel memory as (height, width, channels) in its pixel format, call invalidate_mipmaps() after writing
+    def get_buffer_view(self):
+        fmt, ctype = _PIXEL_FORMAT_ELEMENTS[self.pixel_format]
+        return _native_view(self, lib.GetTextureBuffer(self._ptr), fmt, ctype, (self.height, self.width, 4 if self.enableAlpha else 3))
+    
+    def as_numpy(self):
+        import numpy
+        return numpy.asarray(self.get_buffer_view())
+    
+    def invalidate_mipmaps(self):
+        lib.InvalidateTextureMipmaps(self._ptr)
+    
+    # Shares data without copying, it must already be in pixel_format storage (premultiplied for U8_PREMULTIPLIED).
+    # Like as_texture_shared() the texture is never mipmapped.
+    @staticmethod
+    def from_buffer(width: int, height: int, enable_alpha: bool, data: typing.Any, pixel_format: int = PixelFormat.F64):
+        nbytes = width * height * (4 if enable_alpha else 3) * lib.GetPixelFormatSize(pixel_format)
+        shared = _shared_buffer(data, nbytes)
+        res = PtrCreatedTexture(lib.CreateTextureFromBufferShared(width, height, enable_alpha, shared, pixel_format))
+        res._shared = shared
+        return res
+    
+    # (height, width, 3 or 4) array, the pixel format follows the dtype: float64, float32 or premultiplied uint8
     @staticmethod
-    def from_pilimg(img):
+    def from_numpy(arr):
+        if arr.ndim != 3 or arr.shape[2] not in (3, 4):
+            raise ValueError("arr must have shape (height, width, 3 or 4)")
+        
+        if arr.dtype.name not in _NUMPY_PIXEL_FORMATS:
+            raise TypeError("arr dtype must be float64, float32 or uint8")
+        
+        return Texture.from_buffer(arr.shape[1], arr.shape[0], arr.shape[2] == 4, arr, _NUMPY_PIXEL_FORMATS[arr.dtype.name])
+    
+    @staticmethod
+    def from_pilimg(img, pixel_format: int = PixelFormat.F64):
         from PIL import Image
 
         if not isinstance(img, Image.Image):
@@ -432,100 +1003,199 @@ class Texture:
         if img.mode not in ("RGB", "RGBA"):
             img = img.convert("RGBA")
         
-        return Texture(img.width, img.height, img.mode == "RGBA", img.tobytes())
+        return Texture(img.width, img.height, img.mode == "RGBA", img.tobytes(), pixel_format=pixel_format)
     
 class PtrCreatedTexture(Texture):
     def __init__(self, ptr: int):
         self._ptr = ptr
         self._update_props()
 
+# magic, library version, width, height, enable alpha and pixel format of a stored texture, padded so the texels
+# that follow stay aligned
+_TEXTURE_STORE_MAGIC = b"NCRTEX\0\0"
+_TEXTURE_STORE_HEADER = struct.Struct("<8sqqqqq16x")
+
+# Decoded textures kept in cache_dir in their native layout, keyed by the bytes they were decoded from and what
+# was done to them since. Stored textures are mapped with CreateTextureFromMappedFile, so a hit neither decodes
+# nor copies. With cache_dir None every call decodes as usual.
+class TextureStore:
+    def __init__(self, cache_dir: typing.Optional[str]):
+        self.cache_dir = cache_dir
+    
+    def _path(self, key: str):
+        digest = hashlib.sha256(f"{lib.GetVersion()}:{key}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"texture-{digest[:32]}.bin")
+    
+    def _map(self, path: str):
+        try:
+            with open(path, "rb") as f:
+                header = f.read(_TEXTURE_STORE_HEADER.size)
+        except OSError:
+            return None
+        
+        if len(header) != _TEXTURE_STORE_HEADER.size:
+            return None
+        
+        magic, version, width, height, enable_alpha, pixel_format = _TEXTURE_STORE_HEADER.unpack(header)
+        if magic != _TEXTURE_STORE_MAGIC or version != lib.GetVersion():
+            return None
+        
+        ptr = lib.CreateTextureFromMappedFile(path.encode(), _TEXTURE_STORE_HEADER.size, width, height, bool(enable_alpha), pixel_format)
+        return PtrCreatedTexture(ptr) if ptr else None
+    
+    def _write(self, path: str, tex: Texture):
+        nbytes = tex.width * tex.height * (4 if tex.enableAlpha else 3) * lib.GetPixelFormatSize(tex.pixel_format)
+        header = _TEXTURE_STORE_HEADER.pack(_TEXTURE_STORE_MAGIC, lib.GetVersion(), tex.width, tex.height, tex.enableAlpha, tex.pixel_format)
+
+        # like the hit effect noise the store is best effort
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(header)
+                f.write(ctypes.string_at(lib.GetTextureBuffer(tex._ptr), nbytes))
+            os.replace(temp_path, path)
+        except OSError:
+            pass
+    
+    # the stored texture for key, create() makes and stores it on a miss
+    def get(self, key: str, create: typing.Callable[[], Texture]):
+        if self.cache_dir is None:
+            return create()
+        
+        path = self._path(key)
+        tex = self._map(path)
+        if tex is None:
+            tex = create()
+            self._write(path, tex)
+        
+        tex._store_key = key
+        return tex
+    
+    # data is an encoded image, anything PIL opens
+    def load_image(self, data: bytes, pixel_format: int = PixelFormat.F64):
+        def create():
+            from PIL import Image
+            return Texture.from_pilimg(Image.open(io.BytesIO(data)), pixel_format)
+        
+        return self.get(f"image:{hashlib.sha256(data).hexdigest()}:{pixel_format}", create)
+    
+    # tex.resample(width, height), stored too when tex came from this store
+    def resample(self, tex: Texture, width: int, height: int):
+        key = getattr(tex, "_store_key", None)
+        if key is None:
+            return tex.resample(width, height)
+        
+        return self.get(f"{key}:resample:{width}x{height}", lambda: tex.resample(width, height))
+
+# first exception raised by a VideoCap's write callable
+class _VideoCapWriteState:
+    def __init__(self):
+        self.error = None
+
 class VideoCap:
     def __init__(self, width: int, height: int, frame_rate: float):
         self.width = width
         self.height = height
         self.frame_rate = frame_rate
 
-        CreateVideoCap = lib.CreateVideoCap
-        CreateVideoCap.argtypes = (ctypes.c_long, ctypes.c_long, ctypes.c_double)
-        CreateVideoCap.restype = ctypes.c_void_p
-
-        self._ptr = CreateVideoCap(width, height, frame_rate)
+        self._ptr = lib.CreateVideoCap(width, height, frame_rate)
     
     def initialize(
         self,
-        path: str, hasAudio: bool = False,
+        path: str | int | typing.Callable[[bytes], typing.Any], hasAudio: bool = False,
         a_clip: typing.Optional[AudioClip] = None,
-        a_bitrate: int = 80000
+        a_bitrate: int = 80000,
+        options: typing.Optional[dict[str, typing.Any]] = None,
+        muxer_options: typing.Optional[dict[str, typing.Any]] = None
     ):
-        InitializeVideoCap = lib.InitializeVideoCap
-        InitializeVideoCap.argtypes = (ctypes.c_void_p, ctypes.c_char_p, ctypes.c_bool, ctypes.c_void_p, ctypes.c_long)
-        InitializeVideoCap.restype = ctypes.c_bool
+        # path is a file path or url, a file descriptor such as a pipe, or a callable that gets the muxed bytes as
+        # they are written. The last two are never sought, so an mp4 there is fragmented unless movflags is given.
+        muxer_options = dict(muxer_options or {})
+        if not isinstance(path, str) and (options or {}).get("container", "mp4") == "mp4":
+            muxer_options.setdefault("movflags", FRAGMENTED_MP4_MOVFLAGS)
+
+        if isinstance(path, int):
+            path = f"pipe:{path}"
+        elif callable(path):
+            self._write_state = _VideoCapWriteState()
+            self._write_callback = VideoCapWriteCallback(VideoCap._make_writer(path, self._write_state))
+            lib.SetVideoCapWriteCallback(self._ptr, self._write_callback)
+            path = ""
+
+        # encoder, container, preset, tune, crf, bitrate, gop, bframes, thread_count, thread_type or any other
+        # option of the encoder, see SetVideoCapOption
+        for key, value in (options or {}).items():
+            lib.SetVideoCapOption(self._ptr, str(key).encode("utf-8"), str(value).encode("utf-8"))
+        
+        for key, value in muxer_options.items():
+            lib.SetVideoCapMuxerOption(self._ptr, str(key).encode("utf-8"), str(value).encode("utf-8"))
 
-        res = InitializeVideoCap(
+        res = lib.InitializeVideoCap(
             self._ptr, path.encode("utf-8"), hasAudio,
             a_clip._ptr if a_clip is not None else 0,
             a_bitrate
         )
 
         if not res:
+            self._raise_write_error()
             raise Exception("failed")
     
-    def __del__(self):
-        DestroyVideoCap = lib.DestroyVideoCap
-        DestroyVideoCap.argtypes = (ctypes.c_void_p,)
-        DestroyVideoCap.restype = None
+    # The muxer only sees a failed write, the exception itself is raised again by release(). The writer only
+    # holds state, not the cap, so the cap is still freed by reference counting.
+    @staticmethod
+    def _make_writer(write: typing.Callable[[bytes], typing.Any], state: _VideoCapWriteState):
+        def writer(data: int, size: int):
+            if state.error is not None:
+                return -1
+            
+            try:
+                write(ctypes.string_at(data, size))
+            except Exception as e:
+                state.error = e
+                return -1
+            return size
         
-        DestroyVideoCap(self._ptr)
+        return writer
+    
+    # Raised once and dropped from here, a stored or local exception would tie its traceback's frames, and so the
+    # cap, into a cycle.
+    def _raise_write_error(self):
+        state = getattr(self, "_write_state", None)
+        if state is not None and state.error is not None:
+            error, state.error = state.error, None
+            try:
+                raise error
+            finally:
+                del error
+    
+    def __del__(self):
+        lib.DestroyVideoCap(self._ptr)
     
     def put_renderer_context_frame(self, ctx: RenderContext):
-        PutRendererContextFrame = lib.PutRendererContextFrame
-        PutRendererContextFrame.argtypes = (ctypes.c_void_p, ctypes.c_void_p)
-        PutRendererContextFrame.restype = None
-        
-        PutRendererContextFrame(self._ptr, ctx._ptr)
+        lib.PutRendererContextFrame(self._ptr, ctx._ptr)
+    
+    # Queue up to frames copies of the context and encode them on a native thread, put_renderer_context_frame()
+    # then returns once its copy is taken. 0 encodes inline; release() drains the queue.
+    def set_async_frames(self, frames: int):
+        lib.SetVideoCapAsyncFrames(self._ptr, frames)
     
     def release(self):
-        ReleaseVideoCap = lib.ReleaseVideoCap
-        ReleaseVideoCap.argtypes = (ctypes.c_void_p, )
-        ReleaseVideoCap.restype = None
-        
-        ReleaseVideoCap(self._ptr)
+        lib.ReleaseVideoCap(self._ptr)
+        self._raise_write_error()
     
-    def put_audio(self, audio: AudioClip, bit_rate: int = 80000):
-        PutAudioIntoVideoCap = lib.PutAudioIntoVideoCap
-        PutAudioIntoVideoCap.argtypes = (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_long)
-        PutAudioIntoVideoCap.restype = ctypes.c_bool
-
-        res = PutAudioIntoVideoCap(self._ptr, audio._ptr, bit_rate)
-        if not res:
-            raise Exception("failed")
-        
 class AudioClip:
     def __init__(self, sample_rate: int, channels: int, data: typing.Iterable[float]):
-        CreateAudioClipFromBuffer = lib.CreateAudioClipFromBuffer
-        CreateAudioClipFromBuffer.argtypes = (ctypes.c_long, ctypes.c_long, ctypes.c_long, c_void_p)
-        CreateAudioClipFromBuffer.restype = ctypes.c_void_p
-
+        self._ptr = 0
+        _check_memory_limit(len(data) * 8)
         buffer = (ctypes.c_double * len(data)).from_buffer(data)
-        self._ptr = CreateAudioClipFromBuffer(sample_rate, channels, len(data), buffer)
+        self._ptr = lib.CreateAudioClipFromBuffer(sample_rate, channels, len(data) // channels, buffer)
         self._update_props()
     
     def _update_props(self):
-        GetAudioClipSampleRate = lib.GetAudioClipSampleRate
-        GetAudioClipSampleRate.argtypes = (ctypes.c_void_p,)
-        GetAudioClipSampleRate.restype = ctypes.c_long
-
-        GetAudioClipChannels = lib.GetAudioClipChannels
-        GetAudioClipChannels.argtypes = (ctypes.c_void_p,)
-        GetAudioClipChannels.restype = ctypes.c_long
-
-        GetAudioClipNumFrames = lib.GetAudioClipNumFrames
-        GetAudioClipNumFrames.argtypes = (ctypes.c_void_p,)
-        GetAudioClipNumFrames.restype = ctypes.c_long
-
-        self._sample_rate = GetAudioClipSampleRate(self._ptr)
-        self._channels = GetAudioClipChannels(self._ptr)
-        self._num_frames = GetAudioClipNumFrames(self._ptr)
+        self._sample_rate = lib.GetAudioClipSampleRate(self._ptr)
+        self._channels = lib.GetAudioClipChannels(self._ptr)
+        self._num_frames = lib.GetAudioClipNumFrames(self._ptr)
 
     @staticmethod
     def from_pydub_seg(seg):
@@ -542,32 +1212,20 @@ class AudioClip:
     
     @staticmethod
     def slient(sample_rate: int, channels: int, num_frames: int):
-        CreateSilentAudioClip = lib.CreateSilentAudioClip
-        CreateSilentAudioClip.argtypes = (ctypes.c_long, ctypes.c_long, ctypes.c_long)
-        CreateSilentAudioClip.restype = ctypes.c_void_p
-
-        return PtrCreatedAudioClip(CreateSilentAudioClip(sample_rate, channels, num_frames))
+        _check_memory_limit(num_frames * channels * 8)
+        return PtrCreatedAudioClip(lib.CreateSilentAudioClip(sample_rate, channels, num_frames))
     
     def clone(self):
-        CloneAudioClip = lib.CloneAudioClip
-        CloneAudioClip.argtypes = (ctypes.c_void_p,)
-        CloneAudioClip.restype = ctypes.c_void_p
-
-        return PtrCreatedAudioClip(CloneAudioClip(self._ptr))
+        _check_memory_limit(lib.GetAudioClipNumFrames(self._ptr) * lib.GetAudioClipChannels(self._ptr) * 8)
+        return PtrCreatedAudioClip(lib.CloneAudioClip(self._ptr))
     
     def resample(self, sample_rate: int, channels: int):
-        ApplyResampleAudioClip = lib.ApplyResampleAudioClip
-        ApplyResampleAudioClip.argtypes = (ctypes.c_void_p, ctypes.c_long, ctypes.c_long)
-        ApplyResampleAudioClip.restype = None
-
-        ApplyResampleAudioClip(self._ptr, sample_rate, channels)
+        num_frames = lib.GetAudioClipNumFrames(self._ptr) * sample_rate // lib.GetAudioClipSampleRate(self._ptr)
+        _check_memory_limit(num_frames * channels * 8)
+        lib.ApplyResampleAudioClip(self._ptr, sample_rate, channels)
     
     def resample_like(clip: AudioClip, like: AudioClip):
-        ResampleAudioClipLike = lib.ResampleAudioClipLike
-        ResampleAudioClipLike.argtypes = (ctypes.c_void_p, ctypes.c_void_p)
-        ResampleAudioClipLike.restype = None
-
-        ResampleAudioClipLike(clip._ptr, like._ptr)
+        lib.ResampleAudioClipLike(clip._ptr, like._ptr)
     
     def overlay(target: AudioClip, source: AudioClip, start_time: int|float, *, time_unit: typing.Literal["frame", "second"] = "frame", auto_resample: bool = False):
         if time_unit not in ("frame", "second"):
@@ -577,9 +1235,6 @@ class AudioClip:
             start_time = int(start_time)
 
         OverlayAudioClip = lib.OverlayAudioClip if time_unit == "frame" else lib.OverlayAudioClipSecond
-        OverlayAudioClip.argtypes = (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_double, ctypes.c_bool)
-        OverlayAudioClip.restype = ctypes.c_long
-
         res = OverlayAudioClip(target._ptr, source._ptr, start_time, auto_resample)
 
         if res != 0:
@@ -589,27 +1244,16 @@ class AudioClip:
                 case _: raise ValueError(f"unknown error code: {res}")
     
     def save_as_wav(self):
-        SaveAudioClipAsWav = lib.SaveAudioClipAsWav
-        SaveAudioClipAsWav.argtypes = (ctypes.c_void_p, )
-        SaveAudioClipAsWav.restype = ctypes.c_void_p
-
-        wappered = SaveAudioClipAsWav(self._ptr)
+        _check_memory_limit(lib.GetAudioClipNumFrames(self._ptr) * lib.GetAudioClipChannels(self._ptr) * 2 + 44)
+        wappered = lib.SaveAudioClipAsWav(self._ptr)
         return Helpers.wappered_bytes_to_python(wappered)
 
     @property
     def duration(self):
-        GetAudioClipDuration = lib.GetAudioClipDuration
-        GetAudioClipDuration.argtypes = (ctypes.c_void_p,)
-        GetAudioClipDuration.restype = ctypes.c_double
-
-        return GetAudioClipDuration(self._ptr)
+        return lib.GetAudioClipDuration(self._ptr)
     
     def apply_volume_gain(self, gain: float):
-        ApplyVolumeGain = lib.ApplyVolumeGain
-        ApplyVolumeGain.argtypes = (ctypes.c_void_p, ctypes.c_double)
-        ApplyVolumeGain.restype = None
-        
-        ApplyVolumeGain(self._ptr, gain)
+        lib.ApplyVolumeGain(self._ptr, gain)
     
     def cut(self, start: int|float, end: int|float, *, time_unit: typing.Literal["frame", "second"] = "frame"):
         if time_unit not in ("frame", "second"):
@@ -622,35 +1266,56 @@ class AudioClip:
             start = int(start * self._sample_rate)
             end = int(end * self._sample_rate)
         
-        ApplyCutAudioClip = lib.ApplyCutAudioClip
-        ApplyCutAudioClip.argtypes = (ctypes.c_void_p, ctypes.c_long, ctypes.c_long)
-        ApplyCutAudioClip.restype = None
-
-        ApplyCutAudioClip(self._ptr, start, end)
+        lib.ApplyCutAudioClip(self._ptr, start, end)
     
     def apply_speed(self, speed: float):
-        ApplySpeedAudioClip = lib.ApplySpeedAudioClip
-        ApplySpeedAudioClip.argtypes = (ctypes.c_void_p, ctypes.c_double)
-        ApplySpeedAudioClip.restype = None
+        lib.ApplySpeedAudioClip(self._ptr, speed)
+    
+    # interleaved samples as (num_frames, channels) f64, resample() and cut() reallocate them
+    def get_buffer_view(self):
+        shape = (lib.GetAudioClipNumFrames(self._ptr), lib.GetAudioClipChannels(self._ptr))
+        return _native_view(self, lib.GetAudioClipBuffer(self._ptr), "d", ctypes.c_double, shape)
+    
+    def as_numpy(self):
+        import numpy
+        return numpy.asarray(self.get_buffer_view())
+    
+    # Shares interleaved f64 samples without copying until resample() or cut() moves the clip into its own buffer.
+    @staticmethod
+    def from_buffer(sample_rate: int, channels: int, data: typing.Any):
+        view = memoryview(data)
+        if view.nbytes % (channels * 8) != 0:
+            raise ValueError("data size not match")
+        
+        num_frames = view.nbytes // (channels * 8)
+        shared = _shared_buffer(data, num_frames * channels * 8)
+        res = PtrCreatedAudioClip(lib.CreateAudioClipFromBufferShared(sample_rate, channels, num_frames, shared))
+        res._shared = shared
+        return res
+    
+    # float64 array of shape (num_frames, channels), or (num_frames,) for mono
+    @staticmethod
+    def from_numpy(arr, sample_rate: int):
+        if arr.ndim not in (1, 2):
+            raise ValueError("arr must have shape (num_frames, channels) or (num_frames,)")
+        
+        if arr.dtype.name != "float64":
+            raise TypeError("arr dtype must be float64")
         
-        ApplySpeedAudioClip(self._ptr, speed)
+        return AudioClip.from_buffer(sample_rate, 1 if arr.ndim == 1 else arr.shape[1], arr)
     
+    # 0 when __init__ raised before the clip was created
     def __del__(self):
-        DestroyAudioClip = lib.DestroyAudioClip
-        DestroyAudioClip.argtypes = (ctypes.c_void_p,)
-        DestroyAudioClip.restype = None
-        
-        DestroyAudioClip(self._ptr)
+        if self._ptr:
+            lib.DestroyAudioClip(self._ptr)
 
 class Int16CreatedAudioClip(AudioClip):
     def __init__(self, sample_rate: int, channels: int, data: typing.Iterable[int]):
-        CreateAudioClipFromInt16Buffer = lib.CreateAudioClipFromInt16Buffer
-        CreateAudioClipFromInt16Buffer.argtypes = (ctypes.c_long, ctypes.c_long, ctypes.c_long, ctypes.c_void_p)
-        CreateAudioClipFromInt16Buffer.restype = ctypes.c_void_p
-
+        self._ptr = 0
+        _check_memory_limit(len(data) * 8)
         buffer = (ctypes.c_short * len(data)).from_buffer(data)
         
-        self._ptr = CreateAudioClipFromInt16Buffer(sample_rate, channels, len(data) // channels, buffer)
+        self._ptr = lib.CreateAudioClipFromInt16Buffer(sample_rate, channels, len(data) // channels, buffer)
         self._update_props()
 
 class PtrCreatedAudioClip(AudioClip):
@@ -659,11 +1324,42 @@ class PtrCreatedAudioClip(AudioClip):
         self._update_props()
 
 def get_version():
-    GetVersion = lib.GetVersion
-    GetVersion.argtypes = ()
-    GetVersion.restype = ctypes.c_long
+    return lib.GetVersion()
+
+def set_render_threads(n: int):
+    lib.SetRenderThreads(n)
+
+def get_render_threads():
+    return lib.GetRenderThreads()
+
+# Released pixel and sample buffers are kept for reuse up to this many bytes, 0 frees them right away.
+def set_buffer_pool_limit(n: int):
+    lib.SetBufferPoolLimit(n)
+
+def get_buffer_pool_size():
+    return lib.GetBufferPoolSize()
+
+# {kind: {"live_bytes", "peak_bytes", "objects"}} for every MemoryKind and "total", with "pooled_bytes" held for
+# reuse and the "soft_limit" on top
+def memory_stats():
+    values = (ctypes.c_long * ((len(_MEMORY_KIND_NAMES) + 1) * len(_MEMORY_STATS_FIELDS)))()
+    lib.GetMemoryStats(values)
+
+    stats = {}
+    for i, kind in enumerate(_MEMORY_KIND_NAMES + ("total",)):
+        row = values[i * len(_MEMORY_STATS_FIELDS):(i + 1) * len(_MEMORY_STATS_FIELDS)]
+        stats[kind] = dict(zip(_MEMORY_STATS_FIELDS, row))
+    
+    stats["pooled_bytes"] = lib.GetBufferPoolSize()
+    stats["soft_limit"] = lib.GetMemorySoftLimit() or None
+    return stats
+
+# Live bytes of all kinds may not go over n, allocations that would raise MemoryLimitError instead. None removes it.
+def set_memory_soft_limit(n: typing.Optional[int]):
+    lib.SetMemorySoftLimit(n or 0)
 
-    return GetVersion()
+def get_memory_soft_limit():
+    return lib.GetMemorySoftLimit() or None
 
 if __name__ == "__main__":
     from PIL import Image
@@ -675,6 +1371,7 @@ if __name__ == "__main__":
     ctxS = 4
     ctx = RenderContext(1024 // ctxS, 1024 // ctxS, True)
     ctx.scale(1 / ctxS, 1 / ctxS)
+    ctx.set_anti_alias(True)
     cap = VideoCap(1024, 1024, 60)
 
     seg = AudioSegment.from_file("./../test_files/audio.ogg")
@@ -9,10 +9,10 @@ import typing
 import logging
 import math
 import random
+import os
 
 import pydub
 import tqdm
-from PIL import Image
 
 import libNativeCPURendererPybind as CPURenderer
 
@@ -27,9 +27,17 @@ aparser.add_argument("-ns", "--note-scale", type=float, default=1.0)
 aparser.add_argument("-fs", "--flow-speed", type=float, default=1.66)
 aparser.add_argument("-d", "--debug", action="store_true")
 aparser.add_argument("-sl", "--silent", action="store_true")
+aparser.add_argument("-t", "--threads", type=int, default=0)
+aparser.add_argument("-pf", "--pixel-format", type=str, choices=("f64", "f32", "u8"), default="f64")
+aparser.add_argument("-tpf", "--texture-pixel-format", type=str, choices=("f64", "f32", "u8"), default=None, help="storage of loaded and generated textures, the context pixel format when omitted")
+aparser.add_argument("-m", "--mode", type=int, choices=(0, 1), default=0)
+aparser.add_argument("-eo", "--encoder-option", type=str, action="append", default=[], metavar="KEY=VALUE")
+aparser.add_argument("-aa", "--anti-alias", action="store_true")
+aparser.add_argument("-c", "--cache-dir", type=str, default=os.path.join(os.path.expanduser("~"), ".cache", "milrenderer"), help="directory for decoded textures and hit effect noise, empty to disable")
+aparser.add_argument("-phe", "--procedural-hit-effects", action="store_true", help="evaluate hit effects per frame at their drawn size instead of preparing textures")
 
 args = aparser.parse_args()
-mode = 0
+mode = args.mode
 
 logging.basicConfig(
     level = logging.INFO if not args.debug else logging.DEBUG,
@@ -43,6 +51,19 @@ logging.info(f"output video size: {w}x{h}")
 logging.info(f"output video fps: {fps}")
 logging.info(f"output video file: {args.output}")
 
+CPURenderer.set_render_threads(args.threads)
+logging.info(f"render threads: {CPURenderer.get_render_threads()}")
+
+pixel_formats = {
+    "f64": CPURenderer.PixelFormat.F64,
+    "f32": CPURenderer.PixelFormat.F32,
+    "u8": CPURenderer.PixelFormat.U8_PREMULTIPLIED,
+}
+ctx_pixel_format = pixel_formats[args.pixel_format]
+tex_pixel_format = pixel_formats[args.texture_pixel_format or args.pixel_format]
+logging.info(f"context pixel format: {args.pixel_format}")
+logging.info(f"texture pixel format: {args.texture_pixel_format or args.pixel_format}")
+
 MIL_SCRW = 1920
 MIL_SCRH = 1080
 logging.debug(f"{MIL_SCRW=}, {MIL_SCRH=}")
@@ -111,11 +132,11 @@ easings: list[list[typing.Callable[[float], float]]] = [
 ]
 
 logging.info("creating render context")
-ctx = CPURenderer.MultiThreadedVideoRenderContextPreparer(w, h, enable_alpha=False) if mode == 1 else CPURenderer.RenderContext(w, h, enable_alpha=False)
 cap = CPURenderer.VideoCap(w, h, fps)
+ctx = CPURenderer.MultiThreadedVideoRenderContextPreparer(cap, w, h, enable_alpha=False, pixel_format=ctx_pixel_format) if mode == 1 else CPURenderer.RenderContext(w, h, enable_alpha=False, pixel_format=ctx_pixel_format)
 
 def error(msg: str):
-    print(f"Error: {msg}")
+    print(f"Error: {msg}", file=sys.stderr)
     sys.exit(1)
 
 try:
@@ -824,52 +845,73 @@ logging.info("mixing bgm")
 mixbgm(bgm)
 
 logging.info("initializing video cap")
-cap.initialize(args.output, hasAudio=not args.silent, a_clip=bgm)
+encoder_options = dict(opt.split("=", 1) for opt in args.encoder_option)
+logging.info(f"encoder options: {encoder_options}")
+# "-" streams a fragmented mp4 (or the -eo container) to stdout as it renders
+cap.initialize(sys.stdout.fileno() if args.output == "-" else args.output, hasAudio=not args.silent, a_clip=bgm, options=encoder_options)
+# encode frame n while frame n + 1 is drawn
+cap.set_async_frames(2)
 num_frames = int(bgm.duration * cap.frame_rate) + 1
 
+# decoded and resampled textures are kept in the cache, later runs map them instead of decoding again
+texture_store = CPURenderer.TextureStore(args.cache_dir or None)
+
+def loadResTexture(path: str):
+    with open(getResPath(path), "rb") as f:
+        return texture_store.load_image(f.read(), tex_pixel_format)
+
 logging.info("resizing bg image")
-bg_tex = CPURenderer.Texture.from_pilimg(Image.open(io.BytesIO(readFile(meta["image_file"]))))
+bg_tex = texture_store.load_image(readFile(meta["image_file"]), tex_pixel_format)
 ratio_bg = bg_tex.width / bg_tex.height
 ratio_scr = cap.width / cap.height
 
 if ratio_bg > ratio_scr:
-    bg_tex = bg_tex.resample(int(cap.height / bg_tex.height * bg_tex.width), cap.height)
+    bg_tex = texture_store.resample(bg_tex, int(cap.height / bg_tex.height * bg_tex.width), cap.height)
 else:
-    bg_tex = bg_tex.resample(cap.width, int(cap.width / bg_tex.width * bg_tex.height))
+    bg_tex = texture_store.resample(bg_tex, cap.width, int(cap.width / bg_tex.width * bg_tex.height))
 
 logging.debug(f"bg_tex: {bg_tex.width}x{bg_tex.height}")
 
 logging.info("loading game textures")
 game_res = {
-    "tap": CPURenderer.Texture.from_pilimg(Image.open(getResPath("tap.png"))),
-    "tap_double": CPURenderer.Texture.from_pilimg(Image.open(getResPath("tap_double.png"))),
-    "extap": CPURenderer.Texture.from_pilimg(Image.open(getResPath("extap.png"))),
-    "extap_double": CPURenderer.Texture.from_pilimg(Image.open(getResPath("extap_double.png"))),
-    "hold": CPURenderer.Texture.from_pilimg(Image.open(getResPath("hold.png"))),
-    "hold_double": CPURenderer.Texture.from_pilimg(Image.open(getResPath("hold_double.png"))),
-    "exhold": CPURenderer.Texture.from_pilimg(Image.open(getResPath("exhold.png"))),
-    "exhold_double": CPURenderer.Texture.from_pilimg(Image.open(getResPath("exhold_double.png"))),
-    "drag": CPURenderer.Texture.from_pilimg(Image.open(getResPath("drag.png"))),
-    "drag_double": CPURenderer.Texture.from_pilimg(Image.open(getResPath("drag_double.png"))),
-    "line_head": CPURenderer.Texture.from_pilimg(Image.open(getResPath("line_head.png"))),
+    "tap": loadResTexture("tap.png"),
+    "tap_double": loadResTexture("tap_double.png"),
+    "extap": loadResTexture("extap.png"),
+    "extap_double": loadResTexture("extap_double.png"),
+    "hold": loadResTexture("hold.png"),
+    "hold_double": loadResTexture("hold_double.png"),
+    "exhold": loadResTexture("exhold.png"),
+    "exhold_double": loadResTexture("exhold_double.png"),
+    "drag": loadResTexture("drag.png"),
+    "drag_double": loadResTexture("drag_double.png"),
+    "line_head": loadResTexture("line_head.png"),
     "meta": json.load(open(getResPath("meta.json"), "r", encoding="utf-8")),
-    "perfect_circ": CPURenderer.Texture.from_pilimg(Image.open(getResPath("perfect_circ.png"))).resample(512, 512)
+    "perfect_circ": texture_store.resample(loadResTexture("perfect_circ.png"), 512, 512)
 }
 
-logging.info("preparing hit effect textures")
-hit_effect_texs = [CPURenderer.Helpers.create_milthm_hit_effect_textures(game_res["perfect_circ"], int(fps * HIT_EFFECT_DUR)) for _ in range(HITEFFECT_PREPARE_GROUP_NUM)]
+# fixed seeds per group, so the noise of every group can come from the cache on later runs
+hit_effect_seeds = [group / HITEFFECT_PREPARE_GROUP_NUM for group in range(HITEFFECT_PREPARE_GROUP_NUM)]
+hit_effect_color = (0x96 / 0xff, 0x90 / 0xff, 0xfd / 0xff)
+hit_effect_texs = []
+if not args.procedural_hit_effects:
+    logging.info("preparing hit effect textures")
+    hit_effect_texs = [
+        CPURenderer.Helpers.create_milthm_hit_effect_textures(
+            game_res["perfect_circ"], int(fps * HIT_EFFECT_DUR), tex_pixel_format,
+            seed = seed,
+            cache_dir = args.cache_dir or None
+        )
+        for seed in hit_effect_seeds
+    ]
 current_hit_effects = []
 
-logging.info("rendering")
+# background, dim and bottom gradient only change with their inputs, so they are drawn once into a layer
+bg_layer = CPURenderer.Layer(w, h, False, ctx_pixel_format)
 
-for frame_i in tqdm.trange(num_frames, desc="Preparing" if mode == 1 else "Rendering"):
-    ctx.set_color(0, 0, 0, 0)
-    t = frame_i / cap.frame_rate
-    chart.update(t)
-
-    ctx.draw_texture(bg_tex, w / 2 - bg_tex.width / 2, h / 2 - bg_tex.height / 2, bg_tex.width, bg_tex.height)
-    ctx.fill_color(0, 0, 0, chart.meta.background_dim)
-    ctx.draw_vertical_mut_grd(0, h * 0.6, w, h * 0.4, [
+def draw_background(layer_ctx: CPURenderer.RenderContext):
+    layer_ctx.draw_texture(bg_tex, w / 2 - bg_tex.width / 2, h / 2 - bg_tex.height / 2, bg_tex.width, bg_tex.height)
+    layer_ctx.fill_color(0, 0, 0, chart.meta.background_dim)
+    layer_ctx.draw_vertical_mut_grd(0, h * 0.6, w, h * 0.4, [
         (0.0, (0, 0, 0, 0.0)),
         (0.25, (0, 0, 0, 0.3)),
         (0.5, (0, 0, 0, 0.6)),
@@ -877,6 +919,16 @@ for frame_i in tqdm.trange(num_frames, desc="Preparing" if mode == 1 else "Rende
         (1.0, (0, 0, 0, 1.0)),
     ])
 
+logging.info("rendering")
+
+for frame_i in tqdm.trange(num_frames, desc="Preparing" if mode == 1 else "Rendering"):
+    frame = CPURenderer.CommandBuffer()
+    if args.anti_alias: frame.set_anti_alias(True)
+    t = frame_i / cap.frame_rate
+    chart.update(t)
+
+    bg_layer.update((bg_tex, chart.meta.background_dim), draw_background)
+
     for line in chart.lines:
         linePos = milpos2scrpos(line.acollection.get_value(EnumAnimationKey.PositionX), line.acollection.get_value(EnumAnimationKey.PositionY))
         lineTransp = line.acollection.get_value(EnumAnimationKey.Transparency)
@@ -897,32 +949,34 @@ for frame_i in tqdm.trange(num_frames, desc="Preparing" if mode == 1 else "Rende
         lineHeadPxBorder = (w + h) * LINE_HEAD_BORDER * lineSize
 
         if lineSize > 0.0:
-            ctx.save_state()
-            ctx.apply_color_transform(*lineColor)
-            ctx.apply_color_transform(1, 1, 1, lineTransp * lineHeadTransp)
-            ctx.draw_texture(
+            frame.save_state()
+            frame.apply_color_transform(*lineColor)
+            frame.apply_color_transform(1, 1, 1, lineTransp * lineHeadTransp)
+            frame.draw_texture(
                 game_res["line_head"],
                 lineCen[0] - lineHeadPxSize / 2,
                 lineCen[1] - lineHeadPxSize / 2,
                 lineHeadPxSize, lineHeadPxSize,
             )
-            ctx.restore_state()
+            frame.restore_state()
 
-            ctx.save_state()
-            ctx.apply_color_transform(*lineColor)
-            ctx.apply_color_transform(1, 1, 1, lineTransp * lineBodyTransp)
+            frame.save_state()
+            frame.apply_color_transform(*lineColor)
+            frame.apply_color_transform(1, 1, 1, lineTransp * lineBodyTransp)
             lineBodyP1 = rotate_point(*lineCen, lineRot + 180, max(lineHeadPxSize / 2 - 1.0, 0.0))
             lineBodyP2 = rotate_point(*lineBodyP1, lineRot + 180, h * 2.5)
-            ctx.draw_line(*lineBodyP1, *lineBodyP2, lineHeadPxBorder * 0.75, 1, 1, 1, 0.8)
-            ctx.restore_state()
+            frame.draw_line(*lineBodyP1, *lineBodyP2, lineHeadPxBorder * 0.75, 1, 1, 1, 0.8)
+            frame.restore_state()
         
         if not line.notes:
             continue
         
-        ctx.save_state()
-        ctx.translate(*lineCen)
-        ctx.rotate_degree(lineRot - 90)
-        ctx.scale(lineSize, lineSize)
+        frame.save_state()
+        frame.translate(*lineCen)
+        frame.rotate_degree(lineRot - 90)
+        frame.scale(lineSize, lineSize)
+        lineTransform = frame.get_transform()
+        noteBatch = None
         for ngroup in line.note_groups:
             for i, (note, rm) in enumerate(ngroup):
                 noteClicked = note.time <= t
@@ -973,14 +1027,10 @@ for frame_i in tqdm.trange(num_frames, desc="Preparing" if mode == 1 else "Rende
                 if note.ishold:
                     noteTransp *= 1.0 - fixorp((t - note.endTime) / HOLD_DISAPPEAR_TIME)
                 
-                ctx.save_state()
-                ctx.apply_color_transform(*map(lambda x: x / 255, note.acollection.get_value(EnumAnimationKey.Color)))
-                ctx.apply_color_transform(1, 1, 1, noteTransp)
-                ctx.translate(*notePos)
-                ctx.rotate_degree(noteRot)
-                ctx.scale(noteSize, noteSize)
-
-                wtf = WebCanvas2DTransform(ctx.get_transform())
+                noteColor = tuple(map(lambda x: x / 255, note.acollection.get_value(EnumAnimationKey.Color)))
+                noteTint = (noteColor[0], noteColor[1], noteColor[2], noteColor[3] * noteTransp)
+                noteLocal = WebCanvas2DTransform().translate(*notePos).rotateDegree(noteRot).scale(noteSize, noteSize)
+                wtf = WebCanvas2DTransform(lineTransform).transform(*noteLocal.matrix)
 
                 if not note.ishold:
                     noteHeight = noteWidth / noteTex.width * noteTex.height
@@ -996,20 +1046,36 @@ for frame_i in tqdm.trange(num_frames, desc="Preparing" if mode == 1 else "Rende
                         getLineLength(w / 2, h / 2, *wtf.getPoint(0, (1 if noteFpMult > 0 else -1))) - 
                         getLineLength(w / 2, h / 2, *wtf.getPoint(0, 0)) > 0.0
                     ) or noteFpMult == 0.0):
-                        ctx.restore_state()
                         break
 
+                # consecutive taps and drags of one texture go out as one batch, anything else flushes it first to keep the order
+                if noteBatch is not None and (note.ishold or noteBatch.texture is not noteTex):
+                    frame.draw_sprite_batch(noteBatch)
+                    noteBatch = None
+
                 if not note.ishold:
-                    ctx.draw_texture(noteTex, -noteHeight / 2, -noteWidth / 2, noteHeight, noteWidth)
+                    if noteBatch is None:
+                        noteBatch = CPURenderer.SpriteBatch(noteTex)
+                    noteBatch.add(-noteHeight / 2, -noteWidth / 2, noteHeight, noteWidth, transform = noteLocal.matrix, tint = noteTint)
                 else:
-                    ctx.draw_splitted_texture(noteTex, -holdHeadHeight, -noteWidth / 2, holdHeadHeight + 1, noteWidth, 0, altas[0] / noteTex.width, 0.0, 1.0)
-                    ctx.draw_splitted_texture(noteTex, 0, -noteWidth / 2, holdLength + 1, noteWidth, altas[0] / noteTex.width, 1.0 - altas[1] / noteTex.width, 0.0, 1.0)
-                    ctx.draw_splitted_texture(noteTex, holdLength, -noteWidth / 2, holdTailHeight + 1, noteWidth, 1.0 - altas[1] / noteTex.width, 1.0, 0.0, 1.0)
+                    frame.save_state()
+                    frame.apply_color_transform(*noteTint)
+                    frame.apply_transform(*noteLocal.matrix)
+                    frame.draw_nine_slice_texture(
+                        noteTex,
+                        -holdHeadHeight, -noteWidth / 2,
+                        holdHeadHeight + holdLength + holdTailHeight, noteWidth,
+                        altas[0], 0, altas[1], 0,
+                        holdHeadHeight, 0, holdTailHeight, 0
+                    )
+                    frame.restore_state()
                 
-                note.transform = ctx.get_transform()
-                ctx.restore_state()
+                note.transform = wtf.matrix
         
-        ctx.restore_state()
+        if noteBatch is not None:
+            frame.draw_sprite_batch(noteBatch)
+        
+        frame.restore_state()
 
     current_hit_effects.sort(key = lambda x: x.t)
     removes_hit_effects = []
@@ -1018,23 +1084,35 @@ for frame_i in tqdm.trange(num_frames, desc="Preparing" if mode == 1 else "Rende
             removes_hit_effects.append(hite)
             continue
 
-        ctx.save_state()
-        ctx.set_transform(*hite.note.transform)
+        frame.save_state()
+        frame.set_transform(*hite.note.transform)
 
         p = 1.0 - (hite.t + HIT_EFFECT_DUR - t) / HIT_EFFECT_DUR
         size = (w + h) * HITEFFECT_SIZE * (1.0 - (1.0 - p) ** 3)
-        texgroup = hit_effect_texs[hite.group]
-        tex = texgroup[int(p * (len(texgroup) - 1))]
-
-        ctx.draw_texture(tex, -size / 2, -size / 2, size, size)
-        ctx.restore_state()
+        if args.procedural_hit_effects:
+            frame.draw_procedural_texture(
+                CPURenderer.ProceduralShader.MILTHM_HIT_EFFECT, game_res["perfect_circ"],
+                -size / 2, -size / 2, size, size,
+                hit_effect_seeds[hite.group], p, *hit_effect_color
+            )
+        else:
+            texgroup = hit_effect_texs[hite.group]
+            tex = texgroup[int(p * (len(texgroup) - 1))]
+            frame.draw_texture(tex, -size / 2, -size / 2, size, size)
+        frame.restore_state()
     
     for hite in removes_hit_effects:
         current_hit_effects.remove(hite)
 
+    ctx.blit_layer(bg_layer.context)
+    ctx.execute_command_buffer(frame)
+
     if mode == 1:
         ctx.end_of_frame()
     else:
         cap.put_renderer_context_frame(ctx)
 
+if mode == 1:
+    ctx.renderer()
+
 cap.release()